@@ -1,7 +1,40 @@
 import argparse
-from lib.hybrid_search import normalize_command, weighted_search_command, rrf_search_command
-from lib.search_utils import HYBRID_A, DEFAULT_SEARCH_LIMIT, RRF_K
+import time
+from lib.hybrid_search import normalize_command, weighted_search_command, rrf_search_command, fused_search_command
+from lib.search_utils import SNAPSHOTS_KEPT, HYBRID_A, DEFAULT_SEARCH_LIMIT, RRF_K, ENHANCE_TIME_BUDGET, LEG_TIMEOUT, RERANK_BATCH_SIZE, RERANK_PROCESSES, BUILD_SHARD_SIZE, INGEST_BATCH_SIZE, BM25_K1, BM25_B, doctors_json_path
 from lib.evaluation import llm_evaluation_command
+from lib.index_builder import build_all_command, ingest_command, publish_snapshot_command, list_snapshots_command
+from lib.filters import add_filter_arguments, filters_from_args, facet_counts_command
+from lib.expansion import build_expansion_command
+from lib.fusion import FUSION_METHODS
+from lib.snapshots import current_snapshot_name
+from lib.result_cache import result_cache_stats_command, result_cache_clear_command
+
+def add_leg_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--concurrent", action="store_true", help="Run the keyword and semantic legs at the same time")
+    parser.add_argument("--leg-timeout", type=float, default=LEG_TIMEOUT, help="Seconds a concurrent leg may take before the other leg is used alone")
+
+
+def add_depth_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--time-budget", type=float, help="Seconds after which the candidate depth stops widening")
+    parser.add_argument("--depth", type=int, help="Fixed candidate depth per leg instead of the adaptive one")
+    parser.add_argument("--stats", action="store_true", help="Print the candidate depths and time used")
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--no-cache", action="store_true", help="Always search, neither read nor store the result cache")
+
+
+def print_search_stats(response: dict) -> None:
+    stats = response["search_stats"]
+    if response.get("cache") in ("memory", "disk"):
+        print(f"Served from the result cache ({response["cache"]})")
+    print(f"Candidate depths: {stats["depths"]} ({stats["rounds"]} rounds, stopped: {stats["stop"]}), {stats["seconds"] * 1000:.1f} ms\n")
+    rerank_stats = response.get("rerank_stats")
+    if rerank_stats:
+        processes = f" over {rerank_stats["processes"]} processes" if rerank_stats["processes"] > 1 else ""
+        print(f"Cross encoder: {rerank_stats["pairs"]} pairs, {rerank_stats["cached"]} cached, {rerank_stats["scored"]} scored{processes}, {rerank_stats["seconds"] * 1000:.1f} ms\n")
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
@@ -14,14 +47,68 @@ def main() -> None:
     weighted_search_parser.add_argument("query", type=str, help="query for search")
     weighted_search_parser.add_argument("--alpha", type=float, default=HYBRID_A, help="modifiable alpha variable for semantic and keyword search weighting")
     weighted_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="limit of search results")
+    add_filter_arguments(weighted_search_parser)
+    add_leg_arguments(weighted_search_parser)
+    add_depth_arguments(weighted_search_parser)
+    add_cache_arguments(weighted_search_parser)
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="RRF hybrid search")
     rrf_search_parser.add_argument("query", type=str, help="query for search")
     rrf_search_parser.add_argument("--k", type=int, default=RRF_K, help="modifiable K parameter. Control the decline of scores of high vs low results")
     rrf_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="limit of search results")
-    rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "rewrite", "expand"], help="Query enhancement method",)
+    rrf_search_parser.add_argument("--enhance", type=str, choices=["spell", "spell-local", "rewrite", "expand", "expand-local"], help="Query enhancement method",)
+    rrf_search_parser.add_argument("--speculative", action="store_true", help="Retrieve for the raw query while the enhancement runs and only redo the legs it changes")
+    rrf_search_parser.add_argument("--enhance-budget", type=float, default=ENHANCE_TIME_BUDGET, help="Seconds a speculative search waits for the enhancement before using the raw query results")
     rrf_search_parser.add_argument("--rerank-method", type=str, choices=["individual", "batch", "cross_encoder"], help="Result rerank method")
+    rrf_search_parser.add_argument("--rerank-batch-size", type=int, default=RERANK_BATCH_SIZE, help="Pairs per cross encoder forward pass")
+    rrf_search_parser.add_argument("--rerank-processes", type=int, default=RERANK_PROCESSES, help="Worker processes the cross encoder spreads large candidate sets over")
     rrf_search_parser.add_argument("--evaluate", action="store_true", help="LLM result evaluation")
+    add_filter_arguments(rrf_search_parser)
+    add_leg_arguments(rrf_search_parser)
+    add_depth_arguments(rrf_search_parser)
+    add_cache_arguments(rrf_search_parser)
+
+    fused_search_parser = subparsers.add_parser("fused-search", help="Hybrid search with a selectable score fusion method")
+    fused_search_parser.add_argument("query", type=str, help="query for search")
+    fused_search_parser.add_argument("--method", type=str, choices=FUSION_METHODS, default="rrf", help="How the keyword and semantic scores are fused")
+    fused_search_parser.add_argument("--alpha", type=float, default=HYBRID_A, help="Keyword weight of the weighted method")
+    fused_search_parser.add_argument("--k", type=int, default=RRF_K, help="K parameter of the rrf method")
+    fused_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="limit of search results")
+    add_filter_arguments(fused_search_parser)
+    add_leg_arguments(fused_search_parser)
+    add_depth_arguments(fused_search_parser)
+    add_cache_arguments(fused_search_parser)
+
+    build_all_parser = subparsers.add_parser("build-all", help="Build the keyword index and the embeddings in parallel shards (resumable)")
+    build_all_parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
+    build_all_parser.add_argument("--shard-size", type=int, default=BUILD_SHARD_SIZE, help="Doctors per shard")
+    build_all_parser.add_argument("--keyword-only", action="store_true", help="Skip the embeddings")
+    build_all_parser.add_argument("--k1", type=float, default=BM25_K1, help="BM25 K1 parameter used for the precomputed scores")
+    build_all_parser.add_argument("--b", type=float, default=BM25_B, help="BM25 B parameter used for the precomputed scores")
+    build_all_parser.add_argument("--no-publish", action="store_true", help="Only update the working files, do not publish a snapshot")
+
+    ingest_parser = subparsers.add_parser("ingest", help="Stream a JSON array or JSON Lines file and build the keyword index and embeddings in one pass")
+    ingest_parser.add_argument("--source", type=str, default=doctors_json_path, help="Doctors file (.json array or .jsonl)")
+    ingest_parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Doctors tokenized and encoded per batch")
+    ingest_parser.add_argument("--k1", type=float, default=BM25_K1, help="BM25 K1 parameter used for the precomputed scores")
+    ingest_parser.add_argument("--b", type=float, default=BM25_B, help="BM25 B parameter used for the precomputed scores")
+    ingest_parser.add_argument("--no-publish", action="store_true", help="Only update the working files, do not publish a snapshot")
+
+    publish_parser = subparsers.add_parser("publish-snapshot", help="Sync the keyword index and embeddings with the doctors and publish them as the snapshot searches read")
+    publish_parser.add_argument("--source", type=str, help="Doctors file (default: the one the doctor store was built from)")
+    publish_parser.add_argument("--keep", type=int, default=SNAPSHOTS_KEPT, help="Snapshots kept on disk, the new one included")
+
+    subparsers.add_parser("snapshots", help="List the published snapshots")
+
+    subparsers.add_parser("cache-stats", help="Show the result cache hit and miss counters")
+    subparsers.add_parser("cache-clear", help="Empty the result cache and reset its counters")
+
+    build_expansions_parser = subparsers.add_parser("build-expansions", help="Mine the local query expansion table (--enhance expand-local) from the corpus")
+    build_expansions_parser.add_argument("--no-embeddings", action="store_true", help="Only use term co-occurrence, skip the embedding neighbours")
+
+    facets_parser = subparsers.add_parser("facets", help="Count doctors per specialty and age bucket, optionally within filters")
+    facets_parser.add_argument("--top", type=int, default=20, help="Number of specialties to show")
+    add_filter_arguments(facets_parser)
 
     args = parser.parse_args()
 
@@ -33,15 +120,25 @@ def main() -> None:
                 print(f"* {n_s:.4f}")
 
         case "weighted-search":
-            results = weighted_search_command(args.query, args.alpha, args.enhance, args.limit)
-            for i, result in enumerate(results):
+            response = weighted_search_command(args.query, args.alpha, args.limit, filters_from_args(args), args.concurrent, args.leg_timeout, args.time_budget, args.depth, not args.no_cache)
+            if args.stats:
+                print_search_stats(response)
+            for i, result in enumerate(response["results"]):
                 print(f"{i}. {result["doc"]["name"]}\n Hybrid Score: {result["hybrid_score"]} \n BM25: {result["bm25_normalized"]}, Semantic: {result["semantic_normalized"]} \n")
         
         case "rrf-search":
-            limit = args.limit * 5 if args.rerank_method else args.limit
-                
-            response = rrf_search_command(args.query, limit, args.k, args.enhance, args.rerank_method)
-            if response["enhanced_query"]:
+            response = rrf_search_command(args.query, args.limit, args.k, args.enhance, args.rerank_method, filters_from_args(args), args.speculative, args.enhance_budget, args.concurrent, args.leg_timeout, args.time_budget, args.depth, not args.no_cache,
+                                          args.rerank_batch_size, args.rerank_processes)
+            if args.stats:
+                print_search_stats(response)
+            for leg, status in response["leg_status"].items():
+                if status != "ok":
+                    print(f"The {leg} leg {"timed out" if status == "timeout" else "failed"}, results use the other leg only\n")
+            if response["enhance_status"] in ("timeout", "failed"):
+                print(f"Enhancement ({args.enhance}) {response["enhance_status"]}, showing results for the original query\n")
+            elif response["enhance_status"] == "unchanged":
+                print(f"Enhancement ({args.enhance}) left the query unchanged\n")
+            elif response["enhanced_query"]:
                 print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{response["enhanced_query"]}'\n")
             if args.rerank_method:
                 print(f"Re-ranking top {args.limit} results using {args.rerank_method} method...")
@@ -64,6 +161,61 @@ def main() -> None:
                 for r in results:
                     print(r)
 
+        case "fused-search":
+            response = fused_search_command(args.query, args.method, args.limit, args.alpha, args.k, filters_from_args(args), args.concurrent, args.leg_timeout, args.time_budget, args.depth, not args.no_cache)
+            if args.stats:
+                print_search_stats(response)
+            for i, result in enumerate(response["results"], start=1):
+                print(f"{i}. {result["doc"]["name"]}\n {args.method} score: {result["score"]:.4f} \n BM25: {result["bm25_normalized"]:.3f} (rank {result["bm25_rank"]}), Semantic: {result["semantic_normalized"]:.3f} (rank {result["semantic_rank"]}) \n")
+
+        case "build-all":
+            idx, semantic_search = build_all_command(args.workers, args.shard_size, not args.keyword_only, args.k1, args.b, not args.no_publish)
+            print(f"Build successful: {len(idx.doc_ids)} doctors indexed, {len(idx.terms)} terms")
+            if semantic_search is not None:
+                print(f"Embeddings: {semantic_search.embeddings.shape[0]} vectors in {semantic_search.embeddings.shape[1]} dimensions")
+
+        case "ingest":
+            idx, semantic_search = ingest_command(args.source, args.batch_size, args.k1, args.b, not args.no_publish)
+            print(f"Ingest successful: {len(idx.doc_ids)} doctors indexed, {len(idx.terms)} terms, {semantic_search.embeddings.shape[0]} embeddings")
+
+        case "publish-snapshot":
+            snapshot = publish_snapshot_command(args.source, args.keep)
+            print(f"{snapshot.manifest["doctors"]} doctors, corpus hash {snapshot.manifest["corpus_hash"][:12]}")
+
+        case "snapshots":
+            snapshots = list_snapshots_command()
+            for snapshot in snapshots:
+                marker = "*" if snapshot.name == current_snapshot_name() else " "
+                print(f"{marker} {snapshot.name}: {snapshot.manifest["doctors"]} doctors, corpus hash {snapshot.manifest["corpus_hash"][:12]}, created {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot.manifest["created"]))}")
+            if not snapshots:
+                print("No snapshots published, searches read the working files")
+
+        case "cache-stats":
+            stats = result_cache_stats_command()
+            for scope, counters in stats.items():
+                lookups = counters["memory_hits"] + counters["disk_hits"] + counters["misses"]
+                hit_rate = (counters["memory_hits"] + counters["disk_hits"]) / lookups if lookups else 0.0
+                print(f"{scope}: {counters["memory_hits"]} memory hits, {counters["disk_hits"]} disk hits, {counters["misses"]} misses ({hit_rate:.0%} hit rate), {counters["stores"]} stored")
+            print(f"Entries on disk: {stats["total"]["entries"]}")
+
+        case "cache-clear":
+            result_cache_clear_command()
+            print("Result cache cleared")
+
+        case "build-expansions":
+            table = build_expansion_command(not args.no_embeddings)
+            print(f"Expansion table built: {len(table.terms)} terms, {len(table.neighbours)} related terms")
+
+        case "facets":
+            total, counts = facet_counts_command(filters_from_args(args))
+            print(f"{total} doctors match")
+            print("Specialties:")
+            for specialty, count in sorted(counts["specialty"].items(), key=lambda item: (-item[1], item[0]))[:args.top]:
+                print(f"- {specialty}: {count}")
+            print("Ages:")
+            for bucket, count in counts["age"].items():
+                print(f"- {bucket}: {count}")
+
         case _: 
             parser.print_help()
 
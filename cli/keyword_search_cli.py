@@ -2,15 +2,20 @@
 
 import argparse
 
-from lib.keyword_search import search_command, build_command, tf_command, idf_command, tfidf_command, bm25idf_command, bm25tf_command, bm25_search_command
+from lib.keyword_search import search_command, build_command, sync_command, tf_command, idf_command, tfidf_command, bm25idf_command, bm25tf_command, bm25_search_command
 from lib.search_utils import DEFAULT_SEARCH_LIMIT, BM25_K1, BM25_B
+from lib.filters import add_filter_arguments, filters_from_args
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    subparsers.add_parser("build", help="Build Inverted Index and save to disk")
+    build_parser = subparsers.add_parser("build", help="Build Inverted Index and save to disk")
+    build_parser.add_argument("--k1", type=float, default=BM25_K1, help="BM25 K1 parameter used for the precomputed scores")
+    build_parser.add_argument("--b", type=float, default=BM25_B, help="BM25 B parameter used for the precomputed scores")
+
+    subparsers.add_parser("sync", help="Apply added, edited and removed doctors to the saved index without a full rebuild")
 
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
@@ -39,6 +44,7 @@ def main() -> None:
     bm25_search_parser = subparsers.add_parser("bm25search", help="Search doctors using bm25 scoring")
     bm25_search_parser.add_argument("query", type=str, help="Search query")
     bm25_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Optional results limit")
+    add_filter_arguments(bm25_search_parser)
 
     args = parser.parse_args()
 
@@ -47,9 +53,13 @@ def main() -> None:
         
         case "build":
             print(f"Building the Inverted Index")
-            build_command()
+            build_command(args.k1, args.b)
             print(f"Build successful")
 
+        case "sync":
+            changes = sync_command()
+            print(f"Index synced: {changes["added"]} added, {changes["updated"]} updated, {changes["removed"]} removed")
+
         case "search":
             print(f"Searching for doctor info: {args.query}")
             results = search_command(args.query, args.limit)
@@ -77,7 +87,7 @@ def main() -> None:
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf_score:.2f}")
 
         case "bm25search":
-            results = bm25_search_command(args.query, args.limit)
+            results = bm25_search_command(args.query, args.limit, filters_from_args(args))
             for result in results:
                 print(result)
 
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+from .search_utils import ANN_NLIST, ANN_NPROBE, ANN_KMEANS_ITERATIONS, normalize_rows, top_k_indices
+
+ASSIGN_CHUNK_SIZE = 65536
+
+
+class IVFIndex:
+    # Inverted file index: a spherical k-means coarse quantizer splits the (normalized) embeddings
+    # into `nlist` cells and a query only scores the rows of its `nprobe` closest cells.
+    def __init__(self, nlist: int = ANN_NLIST, nprobe: int = ANN_NPROBE) -> None:
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.list_ids = None
+        self.list_offsets = None
+        self.rows = None # Number of embeddings indexed
+        self.manifest_hash = None # Digest of the embeddings manifest the index was built from (see SemanticSearch.manifest_digest)
+
+    def build(self, embeddings: np.ndarray, iterations: int = ANN_KMEANS_ITERATIONS, seed: int = 0) -> None:
+        if embeddings is None or len(embeddings) == 0:
+            raise ValueError("No embeddings to index.")
+        rng = np.random.default_rng(seed)
+        self.rows = len(embeddings)
+        self.nlist = max(1, min(self.nlist, len(embeddings)))
+        self.centroids = np.array(embeddings[rng.choice(len(embeddings), self.nlist, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assignments = self._assign(embeddings)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, embeddings)
+            counts = np.bincount(assignments, minlength=self.nlist)
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = embeddings[rng.choice(len(embeddings), len(empty), replace=False)]
+            self.centroids = normalize_rows(sums)
+        assignments = self._assign(embeddings)
+        self.list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=self.nlist)))).astype(np.int64)
+
+    def _assign(self, embeddings: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), ASSIGN_CHUNK_SIZE):
+            chunk = embeddings[start:start + ASSIGN_CHUNK_SIZE]
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def search(self, q_embedding: np.ndarray, embeddings: np.ndarray, limit: int, nprobe: int = None) -> tuple[np.ndarray, np.ndarray]:
+        if self.centroids is None:
+            raise ValueError("The ANN index is empty. Build or load it first.")
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        cells = top_k_indices(self.centroids @ q_embedding, nprobe)
+        candidates = np.sort(np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in cells]))
+        scores = embeddings[candidates] @ q_embedding
+        best = top_k_indices(scores, limit)
+        return candidates[best], scores[best]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, centroids=self.centroids, list_ids=self.list_ids, list_offsets=self.list_offsets, nprobe=self.nprobe,
+                 rows=self.rows, manifest_hash=self.manifest_hash or "")
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The ANN index was not found at: {path}. Run `ann_build` first.")
+        with np.load(path) as data:
+            self.centroids = data["centroids"]
+            self.list_ids = data["list_ids"]
+            self.list_offsets = data["list_offsets"]
+            self.nprobe = int(data["nprobe"])
+            # Indexes saved before these were recorded are treated as stale
+            self.rows = int(data["rows"]) if "rows" in data.files else None
+            self.manifest_hash = (str(data["manifest_hash"]) or None) if "manifest_hash" in data.files else None # Saved as "" when there was no manifest
+        self.nlist = len(self.centroids)
+
+    def matches(self, rows: int, manifest_hash: str) -> bool:
+        # list_ids are row numbers of the embeddings it was built from, only valid for the exact same rows
+        return self.rows == rows and self.manifest_hash == manifest_hash
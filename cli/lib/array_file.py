@@ -0,0 +1,59 @@
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b"MEDIBOT\0"
+ALIGNMENT = 64
+WRITE_CHUNK_SIZE = 1 << 24 # Bytes copied per write, so memory-mapped arrays are written without loading them whole
+PREAMBLE = struct.Struct("<8sII Q") # magic, format version, reserved, header length
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_array_file(path: str, version: int, metadata: dict, arrays: dict[str, np.ndarray]) -> None:
+    # Layout: preamble | JSON header (metadata + array table) | 64-byte aligned raw arrays
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        table[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({"metadata": metadata, "arrays": table}).encode("utf-8")
+    data_start = _aligned(PREAMBLE.size + len(header))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, version, 0, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]["offset"])
+            data = array.reshape(-1).view(np.uint8)
+            for start in range(0, len(data), WRITE_CHUNK_SIZE):
+                f.write(data[start:start + WRITE_CHUNK_SIZE])
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_array_file(path: str, version: int) -> tuple[dict, dict[str, np.ndarray]]:
+    # Arrays are read-only views over a memory map of the file, nothing is copied or unpickled
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The file was not found at: {path}")
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, file_version, _, header_length = PREAMBLE.unpack(bytes(buffer[:PREAMBLE.size]))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a MediBot array file.")
+    if file_version != version:
+        raise ValueError(f"{path} has format version {file_version}, expected {version}. Rebuild it.")
+    header = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + header_length]))
+    data_start = _aligned(PREAMBLE.size + header_length)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+    return header["metadata"], arrays
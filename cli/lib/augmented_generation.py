@@ -1,20 +1,13 @@
-import os
-from dotenv import load_dotenv
-from google import genai
+from .gemini import get_client
 
-from .search_utils import load_doctors, DEFAULT_SEARCH_LIMIT
-from .hybrid_search import HybridSearch
-
-load_dotenv()
-api_key = os.environ.get("GEMINI_API_KEY")
-if not api_key:
-    raise RuntimeError("GEMINI_API_KEY environment variable not set")
-client = genai.Client(api_key=api_key)
+from .search_utils import DEFAULT_SEARCH_LIMIT
+from .hybrid_search import get_hybrid_search
+from .search_daemon import served
 
 
+@served
 def rag_command(query: str) -> tuple[list[tuple[str, dict]], str]:
-    drs_docs = load_doctors()
-    hybryd_search = HybridSearch(drs_docs)   
+    hybryd_search = get_hybrid_search()
     results = hybryd_search.rrf_search(query, k=60, limit=DEFAULT_SEARCH_LIMIT)
     docs = [f"{i}. Name: {r[1]["doc"]["name"]} - Age:{r[1]["doc"]["age"]}. Specialty: {r[1]["doc"]["specialty"]}. Bio: {r[1]["doc"]["bio"]}. Availability: {r[1]["doc"]["availability"]}" for i, r in enumerate(results)]
     prompt= f"""Answer the question or provide information based on the provided documents. This should be tailored to the hospital patients.
@@ -25,14 +18,14 @@ def rag_command(query: str) -> tuple[list[tuple[str, dict]], str]:
             {docs}
 
             Provide a comprehensive answer that addresses the query:"""
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     corrected = (response.text or "").strip().strip('"')
     return results, corrected if corrected else query
 
+@served
 def summarize_command(query: str, limit: int) -> tuple[list[tuple[str, dict]], str]:
-    drs_docs = load_doctors()
-    hybryd_search = HybridSearch(drs_docs)   
+    hybryd_search = get_hybrid_search()
     results = hybryd_search.rrf_search(query, k=60, limit=DEFAULT_SEARCH_LIMIT)
     docs = [f"{i}. Name: {r[1]["doc"]["name"]} - Age:{r[1]["doc"]["age"]}. Specialty: {r[1]["doc"]["specialty"]}. Bio: {r[1]["doc"]["bio"]}. Availability: {r[1]["doc"]["availability"]}" for i, r in enumerate(results)]
 
@@ -53,14 +46,14 @@ def summarize_command(query: str, limit: int) -> tuple[list[tuple[str, dict]], s
             key differences in their specialties or schedules:
             """
     
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     corrected = (response.text or "").strip().strip('"')
     return results, corrected if corrected else query
 
+@served
 def citations_command(query: str, limit: int) -> tuple[list[tuple[str, dict]], str]:
-    drs_docs = load_doctors()
-    hybryd_search = HybridSearch(drs_docs)   
+    hybryd_search = get_hybrid_search()
     results = hybryd_search.rrf_search(query, k=60, limit=DEFAULT_SEARCH_LIMIT)
     docs = [f"{i}. Name: {r[1]["doc"]["name"]} - Age:{r[1]["doc"]["age"]}. Specialty: {r[1]["doc"]["specialty"]}. Bio: {r[1]["doc"]["bio"]}. Availability: {r[1]["doc"]["availability"]}" for i, r in enumerate(results)]
 
@@ -84,14 +77,14 @@ def citations_command(query: str, limit: int) -> tuple[list[tuple[str, dict]], s
 
             Answer:"""
         
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     corrected = (response.text or "").strip().strip('"')
     return results, corrected if corrected else query
 
+@served
 def question_command(question: str, limit: int, chat_history: list[dict[str, str]]) -> tuple[list[tuple[str, dict]], str]:
-    drs_docs = load_doctors()
-    hybryd_search = HybridSearch(drs_docs)   
+    hybryd_search = get_hybrid_search()
     results = hybryd_search.rrf_search(question, k=60, limit=DEFAULT_SEARCH_LIMIT)
     docs = [f"{i}. Name: {r[1]["doc"]["name"]} - Age:{r[1]["doc"]["age"]}. Specialty: {r[1]["doc"]["specialty"]}. Bio: {r[1]["doc"]["bio"]}. Availability: {r[1]["doc"]["availability"]}" for i, r in enumerate(results)]
     history_string = "\n".join([
@@ -135,7 +128,7 @@ def question_command(question: str, limit: int, chat_history: list[dict[str, str
                 Answer:
                 """
         
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     corrected = (response.text or "").strip().strip('"')
     return results, corrected if corrected else question
@@ -0,0 +1,92 @@
+import re
+import numpy as np
+from datetime import datetime
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+WEEK_SLOTS = 7 * SLOTS_PER_DAY
+ALWAYS_AVAILABLE = re.compile(r"24/7|anytime", re.IGNORECASE)
+DAY_PATTERN = r"(Mon|Tue|Wed|Thu|Fri|Sat|Sun)[a-z]*\.?"
+SCHEDULE = re.compile(rf"{DAY_PATTERN}(?:\s*-\s*{DAY_PATTERN})?\s+(\d{{1,2}}):(\d{{2}})\s*-\s*(\d{{1,2}}):(\d{{2}})", re.IGNORECASE)
+TIME_WINDOW = re.compile(r"(\d{1,2}):(\d{2})(?:\s*-\s*(\d{1,2}):(\d{2}))?")
+
+
+def _day_index(day: str) -> int:
+    name = day.strip()[:3].capitalize()
+    if name not in DAYS:
+        raise ValueError(f"Unknown weekday '{day}'. Use one of: {', '.join(DAYS)}.")
+    return DAYS.index(name)
+
+
+def _minutes(hours: str, minutes: str) -> int:
+    value = int(hours) * 60 + int(minutes)
+    if not 0 <= value <= 24 * 60 or int(minutes) >= 60:
+        raise ValueError(f"Invalid time {hours}:{minutes}.")
+    return value
+
+
+def _mark(slots: np.ndarray, day: int, start: int, end: int) -> None:
+    # start/end are minutes from the day's midnight; a shift ending at or before it starts runs past midnight
+    if end <= start:
+        end += 24 * 60
+    first = day * SLOTS_PER_DAY + start // SLOT_MINUTES
+    last = day * SLOTS_PER_DAY + -(-end // SLOT_MINUTES)
+    slots[np.arange(first, last) % WEEK_SLOTS] = True
+
+
+def parse_availability(text: str) -> np.ndarray | None:
+    # "Mon-Wed 08:00-12:00" -> bool array with one entry per 15-minute slot of the week (Mon 00:00 first).
+    # Day ranges may wrap around the week (Fri-Mon) and shifts may cross midnight (20:00-02:00).
+    # Returns None when the text has no parsable schedule (e.g. "Rotating Shifts").
+    if ALWAYS_AVAILABLE.search(text):
+        return np.ones(WEEK_SLOTS, dtype=bool)
+    schedules = SCHEDULE.findall(text)
+    if not schedules:
+        return None
+    slots = np.zeros(WEEK_SLOTS, dtype=bool)
+    for first_day, last_day, start_h, start_m, end_h, end_m in schedules:
+        first = _day_index(first_day)
+        last = _day_index(last_day) if last_day else first
+        start, end = _minutes(start_h, start_m), _minutes(end_h, end_m)
+        for day in range(first, first + (last - first) % 7 + 1):
+            _mark(slots, day % 7, start, end)
+    return slots
+
+
+def time_window(day: str = None, time: str = None) -> np.ndarray:
+    # Slots a doctor has to overlap: `time` is "HH:MM" (a single slot) or "HH:MM-HH:MM", on `day` or on any day
+    window = np.zeros(WEEK_SLOTS, dtype=bool)
+    days = [_day_index(day)] if day else range(7)
+    if time:
+        match = TIME_WINDOW.fullmatch(time.strip())
+        if match is None:
+            raise ValueError(f"Invalid time '{time}'. Use HH:MM or HH:MM-HH:MM.")
+        start = _minutes(match[1], match[2])
+        end = _minutes(match[3], match[4]) if match[3] else start + SLOT_MINUTES
+    else:
+        start, end = 0, 24 * 60
+    for day_index in days:
+        _mark(window, day_index, start, end)
+    return window
+
+
+def now_window(now: datetime = None) -> np.ndarray:
+    now = now or datetime.now()
+    return time_window(DAYS[now.weekday()], f"{now.hour:02d}:{now.minute:02d}")
+
+
+def pack_slots(slots: list[np.ndarray | None]) -> tuple[np.ndarray, np.ndarray]:
+    # One row of WEEK_SLOTS bits (84 bytes) per doctor, plus whether the schedule could be parsed at all
+    known = np.array([row is not None for row in slots], dtype=bool)
+    matrix = np.zeros((len(slots), WEEK_SLOTS), dtype=bool)
+    for i, row in enumerate(slots):
+        if row is not None:
+            matrix[i] = row
+    return np.packbits(matrix, axis=1), known
+
+
+def available_rows(packed_slots: np.ndarray, known: np.ndarray, window: np.ndarray) -> np.ndarray:
+    # Doctors whose schedule overlaps any slot of the window; unparsable schedules never match a time filter
+    overlap = np.bitwise_and(packed_slots, np.packbits(window)).any(axis=1)
+    return overlap & known
@@ -0,0 +1,202 @@
+import os
+import shutil
+import numpy as np
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from .search_utils import cache_path, doctors_json_path, doctor_hash, iter_doctors, INGEST_BATCH_SIZE
+from .array_file import read_array_file, write_array_file
+from .availability import parse_availability, pack_slots, available_rows, WEEK_SLOTS
+
+DOC_STORE_FORMAT_VERSION = 2
+TEXT_COLUMNS = ["id", "name", "specialty", "availability", "bio", "hash"]
+DOCTOR_FIELDS = ["id", "name", "age", "specialty", "availability", "bio"]
+doc_store_path = os.path.join(cache_path, "doctors_store.bin")
+
+
+class DoctorRecord:
+    # Lightweight read-only view of one doctor: fields are decoded from the store columns only when accessed
+    __slots__ = ("store", "row")
+
+    def __init__(self, store: "DocStore", row: int) -> None:
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, field: str):
+        return self.store.field(self.row, field)
+
+    def get(self, field: str, default=None):
+        return self.store.field(self.row, field) if field in DOCTOR_FIELDS else default
+
+    def __contains__(self, field: str) -> bool:
+        return field in DOCTOR_FIELDS
+
+    def keys(self) -> list[str]:
+        return DOCTOR_FIELDS
+
+    def to_dict(self) -> dict:
+        return {field: self[field] for field in DOCTOR_FIELDS}
+
+    def __repr__(self) -> str:
+        return f"DoctorRecord({self.to_dict()})"
+
+
+class DocStore:
+    # Doctors stored column by column in one memory-mapped file: each text column is a byte blob plus an offsets
+    # array (row i is data[offsets[i]:offsets[i + 1]]), ages are an int16 array and `id_order` sorts rows by id.
+    # Availability is also parsed once here into per-doctor bitsets of 15-minute week slots.
+    def __init__(self, path: str = doc_store_path) -> None:
+        self.path = path
+        self.source = None
+        self.columns: dict[str, np.ndarray] = {}
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, row: int) -> DoctorRecord:
+        if not 0 <= row < self.count:
+            raise IndexError(f"Row {row} is out of range for {self.count} doctors.")
+        return DoctorRecord(self, row)
+
+    def __iter__(self) -> Iterator[DoctorRecord]:
+        return (DoctorRecord(self, row) for row in range(self.count))
+
+    def __contains__(self, doc_id: str) -> bool:
+        return self.row_of(doc_id) is not None
+
+    def field(self, row: int, field: str) -> str | int:
+        if field == "age":
+            return int(self.columns["age"][row])
+        if field not in TEXT_COLUMNS:
+            raise KeyError(field)
+        offsets = self.columns[f"{field}_offsets"]
+        return self.columns[f"{field}_data"][offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+    def ids(self) -> list[str]:
+        return self.__decode_column("id")
+
+    def hashes(self) -> list[str]:
+        return self.__decode_column("hash")
+
+    def specialties(self) -> list[str]:
+        return self.__decode_column("specialty")
+
+    def __decode_column(self, field: str) -> list[str]:
+        data = self.columns[f"{field}_data"].tobytes()
+        offsets = self.columns[f"{field}_offsets"].tolist()
+        return [data[offsets[row]:offsets[row + 1]].decode("utf-8") for row in range(self.count)]
+
+    def row_of(self, doc_id: str) -> int | None:
+        id_order = self.columns["id_order"]
+        position = bisect_left(range(self.count), doc_id, key=lambda i: self.field(int(id_order[i]), "id"))
+        if position < self.count and self.field(int(id_order[position]), "id") == doc_id:
+            return int(id_order[position])
+        return None
+
+    def get(self, doc_id: str) -> DoctorRecord:
+        row = self.row_of(doc_id)
+        if row is None:
+            raise KeyError(f"Doctor {doc_id} is not in the doctor store.")
+        return DoctorRecord(self, row)
+
+    def available_rows(self, window: np.ndarray) -> np.ndarray:
+        return available_rows(self.columns["availability_slots"], self.columns["availability_known"], window)
+
+    def build(self, doctors: Iterable[dict], source: dict = None, batch_size: int = INGEST_BATCH_SIZE) -> None:
+        writer = DocStoreWriter(self.path)
+        for batch in batched(doctors, batch_size):
+            writer.add_many(batch)
+        writer.finish(source)
+        self.load()
+
+    def load(self) -> None:
+        metadata, self.columns = read_array_file(self.path, DOC_STORE_FORMAT_VERSION)
+        self.count = metadata["count"]
+        self.source = metadata["source"]
+
+
+class DocStoreWriter:
+    # Builds the store one batch of doctors at a time: every column is appended to its own spill file (text
+    # columns as bytes plus int64 end offsets), so only the current batch is held in memory. finish() copies the
+    # spill files into the store file through memory maps.
+    def __init__(self, path: str = doc_store_path) -> None:
+        self.path = path
+        self.spill_path = path + ".columns"
+        shutil.rmtree(self.spill_path, ignore_errors=True)
+        os.makedirs(self.spill_path)
+        names = [f"{field}_{part}" for field in TEXT_COLUMNS for part in ("data", "offsets")] + ["age", "availability_slots", "availability_known"]
+        self.files = {name: open(os.path.join(self.spill_path, name), "wb") for name in names}
+        self.sizes = {field: 0 for field in TEXT_COLUMNS} # Bytes written so far per text column
+        self.count = 0
+        for field in TEXT_COLUMNS:
+            np.zeros(1, dtype=np.int64).tofile(self.files[f"{field}_offsets"])
+
+    def add_many(self, doctors: list[dict]) -> None:
+        for field in TEXT_COLUMNS:
+            values = [str(doctor_hash(doctor) if field == "hash" else doctor[field]).encode("utf-8") for doctor in doctors]
+            self.files[f"{field}_data"].write(b"".join(values))
+            ends = self.sizes[field] + np.cumsum([len(value) for value in values], dtype=np.int64)
+            ends.tofile(self.files[f"{field}_offsets"])
+            self.sizes[field] = int(ends[-1]) if len(ends) else self.sizes[field]
+        np.array([doctor["age"] for doctor in doctors], dtype=np.int16).tofile(self.files["age"])
+        packed_slots, known = pack_slots([parse_availability(str(doctor["availability"])) for doctor in doctors])
+        packed_slots.tofile(self.files["availability_slots"])
+        known.tofile(self.files["availability_known"])
+        self.count += len(doctors)
+
+    def __column(self, name: str, dtype: type, shape: tuple) -> np.ndarray:
+        path = os.path.join(self.spill_path, name)
+        if os.path.getsize(path) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    def finish(self, source: dict = None) -> None:
+        for f in self.files.values():
+            f.close()
+        columns = {
+            "age": self.__column("age", np.int16, (self.count,)),
+            "availability_slots": self.__column("availability_slots", np.uint8, (self.count, WEEK_SLOTS // 8)),
+            "availability_known": self.__column("availability_known", np.bool_, (self.count,)),
+        }
+        for field in TEXT_COLUMNS:
+            columns[f"{field}_offsets"] = self.__column(f"{field}_offsets", np.int64, (self.count + 1,))
+            columns[f"{field}_data"] = self.__column(f"{field}_data", np.uint8, (self.sizes[field],))
+        # The id sort is the one step that holds a value per doctor (the ids themselves)
+        id_data, id_offsets = columns["id_data"], columns["id_offsets"]
+        ids = [bytes(id_data[id_offsets[row]:id_offsets[row + 1]]).decode("utf-8") for row in range(self.count)]
+        columns["id_order"] = np.array(sorted(range(self.count), key=ids.__getitem__), dtype=np.int64)
+        del ids
+        write_array_file(self.path, DOC_STORE_FORMAT_VERSION, {"count": self.count, "source": source}, columns)
+        del columns, id_data, id_offsets
+        shutil.rmtree(self.spill_path)
+
+
+def source_fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def open_doc_store(source: str = None, path: str = doc_store_path) -> DocStore:
+    # Reuses the saved store while its source file is unchanged, otherwise rebuilds it by streaming the source.
+    # Without an explicit source, the file the store was last built from is checked (doctors.json by default).
+    store = DocStore(path)
+    if os.path.exists(path):
+        try:
+            store.load()
+        except ValueError:
+            store.source = None
+        recorded_source = store.source["path"] if store.source else None
+        source_path = source or recorded_source or doctors_json_path
+        if store.source is not None and os.path.exists(source_path) and store.source == source_fingerprint(source_path):
+            return store
+    else:
+        source_path = source or doctors_json_path
+    store.build(iter_doctors(source_path), source_fingerprint(source_path))
+    return store
+
+
+def ids_and_hashes(drs_docs: DocStore | list[dict]) -> tuple[list[str], list[str]]:
+    if isinstance(drs_docs, DocStore):
+        return drs_docs.ids(), drs_docs.hashes()
+    return [doctor["id"] for doctor in drs_docs], [doctor_hash(doctor) for doctor in drs_docs]
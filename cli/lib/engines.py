@@ -0,0 +1,129 @@
+import os
+import threading
+from typing import Callable, TypeVar
+from .doc_store import DocStore, open_doc_store, source_fingerprint
+from .snapshots import Snapshot, current_snapshot_name, current_snapshot
+
+T = TypeVar("T")
+
+# Process-wide search engines, so the indexes, embeddings and models are loaded once per process (or daemon) and
+# shared by every command. When a snapshot has been published the engines are loaded from the one CURRENT names;
+# without snapshots they are loaded from the working files in cache/ and reused while those are unchanged.
+# A generation is one doctor store with the engines loaded against it. A new one is loaded next to the one in use
+# and replaces it in a single assignment, so searches never wait for a load and the ones already running keep the
+# engines they started with.
+
+
+class _Generation:
+    def __init__(self, drs_docs: DocStore, snapshot: Snapshot | None) -> None:
+        self.drs_docs = drs_docs
+        self.snapshot = snapshot
+        self.engines: dict[str, tuple[list, object, Callable, list[str]]] = {} # key: (fingerprints, engine, factory, watched)
+        self.lock = threading.Lock()
+        self.key_locks: dict[str, threading.Lock] = {} # One load per engine at a time, other engines are not held up
+
+    def key_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+
+_generation: _Generation | None = None
+_swap_lock = threading.Lock() # One generation loaded at a time
+_pinned = False
+_building = threading.local() # The generation whose engines this thread is loading, see get_engine
+
+
+def _fingerprints(paths: list[str]) -> list[dict | None]:
+    return [source_fingerprint(path) if os.path.exists(path) else None for path in paths]
+
+
+def _load_generation() -> _Generation:
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        drs_docs = DocStore(snapshot.file("doc_store"))
+        drs_docs.load()
+        return _Generation(drs_docs, snapshot)
+    return _Generation(open_doc_store(), None)
+
+
+def _is_current(generation: _Generation) -> bool:
+    # A pinned process (the search daemon) keeps its snapshot until swap_engines replaces it
+    if generation.snapshot is not None or current_snapshot_name() is not None:
+        return _pinned or generation.snapshot is not None and generation.snapshot.name == current_snapshot_name()
+    source = generation.drs_docs.source
+    return source is not None and os.path.exists(source["path"]) and source == source_fingerprint(source["path"])
+
+
+def _current_generation() -> _Generation:
+    building = getattr(_building, "generation", None)
+    if building is not None:
+        return building
+    generation = _generation
+    if generation is not None and _is_current(generation):
+        return generation
+    with _swap_lock:
+        return _swap(warm=False) if _generation is None or not _is_current(_generation) else _generation
+
+
+def _swap(warm: bool) -> _Generation:
+    global _generation
+    old, generation = _generation, _load_generation()
+    if warm and old is not None:
+        for key, (_, _, factory, watched) in list(old.engines.items()):
+            try:
+                get_engine(key, factory, watched, generation)
+            except Exception as e:
+                print(f"Could not load the {key} engine, it will be loaded on first use: {e}")
+    _generation = generation
+    return generation
+
+
+def swap_engines() -> Snapshot | None:
+    # Loads the doctor store of CURRENT (or the working files) and every engine loaded so far, then replaces the
+    # generation in use. Returns the snapshot the engines now come from.
+    with _swap_lock:
+        return _swap(warm=True).snapshot
+
+
+def pin_engines() -> None:
+    # Searches stop checking CURRENT themselves: a newly published snapshot is only used once swap_engines has
+    # loaded it, so no request pays for the load
+    global _pinned
+    _pinned = True
+
+
+def get_doc_store() -> DocStore:
+    return _current_generation().drs_docs
+
+
+def get_snapshot() -> Snapshot | None:
+    # The snapshot the current engines are loaded from, None when they use the working files
+    return _current_generation().snapshot
+
+
+def get_engine(key: str, factory: Callable[[DocStore, Snapshot | None], T], watched: list[str] = (), generation: _Generation = None) -> T:
+    # factory(drs_docs, snapshot) builds the engine. Without a snapshot, `watched` are the working files it loads,
+    # fingerprinted after it ran since building an engine may also write them (e.g. a synced keyword index).
+    # Engines the factory gets in turn (e.g. the hybrid search's keyword index) come from the same generation.
+    generation = generation or _current_generation()
+    paths = [] if generation.snapshot is not None else list(watched)
+    entry = generation.engines.get(key)
+    if entry is not None and entry[0] == _fingerprints(paths):
+        return entry[1]
+    with generation.key_lock(key):
+        entry = generation.engines.get(key)
+        if entry is not None and entry[0] == _fingerprints(paths):
+            return entry[1]
+        outer, _building.generation = getattr(_building, "generation", None), generation
+        try:
+            engine = factory(generation.drs_docs, generation.snapshot)
+        finally:
+            _building.generation = outer
+        generation.engines[key] = (_fingerprints(paths), engine, factory, list(watched))
+        return engine
+
+
+def reset_engines() -> None:
+    global _generation
+    with _swap_lock:
+        _generation = None
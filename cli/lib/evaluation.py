@@ -1,32 +1,22 @@
-import os, json
-from dotenv import load_dotenv
-from google import genai
+import json
+from .gemini import get_client
 
-from .search_utils import load_golden_dataset, load_doctors
-from .hybrid_search import HybridSearch
-from .semantic_search import SemanticSearch
-
-
-load_dotenv()
-api_key = os.environ.get("GEMINI_API_KEY")
-if not api_key:
-    raise RuntimeError("GEMINI_API_KEY environment variable not set")
-client = genai.Client(api_key=api_key)
+from .search_utils import load_golden_dataset
+from .hybrid_search import get_hybrid_search
+from .search_daemon import served
 
+@served
 def evaluation_command(limit: int) -> list[dict]:
-    drs_docs = load_doctors()
     test_cases = load_golden_dataset() 
 
-    semantic_search = SemanticSearch()
-    semantic_search.load_or_create_embeddings(drs_docs)
-    hybryd_search = HybridSearch(drs_docs)   
+    hybryd_search = get_hybrid_search()
+    all_results = hybryd_search.rrf_search_many([case["query"] for case in test_cases], k=60, limit=limit)
 
     for i, case in enumerate(test_cases):
-        query = case["query"]
         relevant_docs_ids = [doc["id"] for doc in case["relevant_docs"]]
         relevant_docs_names = [doc["name"] for doc in case["relevant_docs"]]
         relevant_retrieved = 0
-        results = hybryd_search.rrf_search(query, k=60, limit=limit)
+        results = all_results[i]
         retrieved = []
         for result in results:
             if result[1]["doc"]["id"] in relevant_docs_ids:
@@ -43,6 +33,7 @@ def evaluation_command(limit: int) -> list[dict]:
 
     return test_cases
 
+@served
 def llm_evaluation_command(query: str, formatted_results: list[str]) -> list[str]:
     prompt= f"""Rate how relevant each result is to this query on a 0-3 scale:
 
@@ -63,7 +54,7 @@ def llm_evaluation_command(query: str, formatted_results: list[str]) -> list[str
 
             [2, 0, 3, 2, 0, 1]"""
     
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     scores = json.loads(response.text)
     for i, f_r in enumerate(formatted_results):
@@ -0,0 +1,208 @@
+import os
+import numpy as np
+from itertools import batched
+from .search_utils import cache_path, normalize_rows
+from .array_file import read_array_file, write_array_file
+from .doc_store import DocStore, open_doc_store
+from .semantic_search import SemanticSearch
+from .tokenizer import get_tokenizer, TOKENIZE_BATCH_SIZE
+from .engines import get_engine
+from .snapshots import Snapshot
+
+EXPANSION_TABLE_FORMAT_VERSION = 1
+EXPANSION_MIN_DF = 2 # Terms seen in fewer doctors have no reliable co-occurrence statistics
+EXPANSION_MIN_COOCCURRENCE = 2
+EXPANSION_MIN_NPMI = 0.3
+EXPANSION_MIN_COSINE = 0.6
+EXPANSIONS_PER_TERM = 3
+EXPANSION_MAX_TERMS = 10
+PAIR_CHUNK_SIZE = 1 << 22 # Term pairs gathered before they are merged into the co-occurrence counts
+NEIGHBOUR_CHUNK_SIZE = 1024 # Terms whose embedding similarities to the whole vocabulary are computed at once
+expansion_table_path = os.path.join(cache_path, "expansion_table.bin")
+
+
+class ExpansionTable:
+    # Related terms per lemma, mined offline from the doctors' specialties and bios: terms that tend to appear in the
+    # same doctors (normalized PMI of document co-occurrence) and neighbours in the sentence embedding space. Stored as CSR-style arrays:
+    # `neighbours[offsets[t]:offsets[t + 1]]` are term t's expansions, strongest first.
+    def __init__(self, path: str = expansion_table_path) -> None:
+        self.path = path
+        self.source = None
+        self.terms: list[str] = []
+        self.term_ids: dict[str, int] = {}
+        self.word_lemmas: dict[str, str] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.neighbours = np.empty(0, dtype=np.int32)
+        self.scores = np.empty(0, dtype=np.float16)
+
+    def build(self, drs_docs: DocStore, model=None) -> None:
+        # Names and availability are left out: they would relate every term to a few doctors' names or shifts.
+        # Everything is sparse: co-occurrence counts only exist for term pairs seen together, and the embedding
+        # neighbours are searched a chunk of terms at a time, so memory never grows with the vocabulary squared.
+        word_lemmas = {}
+        token_ids: dict[str, int] = {}
+        documents = [] # Distinct token ids per doctor
+        tokenizer = get_tokenizer()
+        for batch in batched(drs_docs, TOKENIZE_BATCH_SIZE):
+            for tokens in tokenizer.tokenize_many([f"{doctor['specialty']}. {doctor['bio']}" for doctor in batch], word_lemmas):
+                documents.append(np.array(sorted({token_ids.setdefault(token, len(token_ids)) for token in tokens}), dtype=np.int64))
+        tokens = list(token_ids)
+        document_frequencies = np.bincount(np.concatenate(documents), minlength=len(tokens)) if documents else np.zeros(len(tokens), dtype=np.int64)
+        self.terms = sorted(token for token, df in zip(tokens, document_frequencies.tolist()) if df >= EXPANSION_MIN_DF and token.isalpha())
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        term_of_token = np.full(len(tokens), -1, dtype=np.int64)
+        for term, term_id in self.term_ids.items():
+            term_of_token[token_ids[term]] = term_id
+        documents = [np.sort(term_ids[term_ids >= 0]) for term_ids in (term_of_token[document] for document in documents)]
+        term_frequencies = np.array([document_frequencies[token_ids[term]] for term in self.terms], dtype=np.float64)
+
+        candidates = [self.__npmi(documents, term_frequencies)]
+        if model is not None and self.terms:
+            candidates.append(self.__embedding_neighbours(normalize_rows(model.encode(self.terms))))
+        rows, neighbours, scores = (np.concatenate(parts) for parts in zip(*candidates))
+        self.offsets, self.neighbours, self.scores = self.__strongest(rows, neighbours, scores)
+        # Only the surface words whose lemma can be expanded are kept for the query-time lookup
+        self.word_lemmas = {word: lemma for word, lemma in word_lemmas.items() if lemma in self.term_ids}
+        self.source = drs_docs.source
+
+    def __npmi(self, documents: list[np.ndarray], document_frequencies: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Counts every pair of terms that appear in the same doctor, keyed as first * terms + second (first < second)
+        # and merged chunk by chunk, then scores the pairs that co-occur often enough, in both directions
+        total_doctors, term_count = len(documents), len(self.terms)
+        keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        pending, pending_size = [], 0
+        pair_indices = {}
+        for term_ids in documents + [None]:
+            if term_ids is not None and len(term_ids) > 1:
+                if len(term_ids) not in pair_indices:
+                    pair_indices[len(term_ids)] = np.triu_indices(len(term_ids), 1)
+                first, second = pair_indices[len(term_ids)]
+                pending.append(term_ids[first] * term_count + term_ids[second])
+                pending_size += len(first)
+            if pending and (term_ids is None or pending_size >= PAIR_CHUNK_SIZE):
+                merged, inverse = np.unique(np.concatenate([keys] + pending), return_inverse=True)
+                counts = np.bincount(inverse, weights=np.concatenate((counts, np.ones(pending_size, dtype=np.int64))), minlength=len(merged)).astype(np.int64)
+                keys, pending, pending_size = merged, [], 0
+        first, second = keys // max(term_count, 1), keys % max(term_count, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p_joint = counts / total_doctors
+            pmi = np.log(p_joint / (document_frequencies[first] / total_doctors * document_frequencies[second] / total_doctors))
+            npmi = (pmi / -np.log(p_joint)).astype(np.float32)
+            keep = (counts >= EXPANSION_MIN_COOCCURRENCE) & np.isfinite(npmi) & (npmi >= EXPANSION_MIN_NPMI)
+        first, second, npmi = first[keep], second[keep], npmi[keep]
+        return np.concatenate((first, second)), np.concatenate((second, first)), np.concatenate((npmi, npmi))
+
+    def __embedding_neighbours(self, embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # The EXPANSIONS_PER_TERM most similar terms of each term above EXPANSION_MIN_COSINE, a chunk of terms at a time
+        count = min(EXPANSIONS_PER_TERM, len(embeddings) - 1)
+        rows, neighbours, scores = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+        if count <= 0:
+            return rows[0], neighbours[0], scores[0]
+        for start in range(0, len(embeddings), NEIGHBOUR_CHUNK_SIZE):
+            similarities = embeddings[start:start + NEIGHBOUR_CHUNK_SIZE] @ embeddings.T
+            chunk_rows = np.arange(len(similarities))
+            similarities[chunk_rows, start + chunk_rows] = -np.inf # A term is not its own expansion
+            best = np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+            best_scores = np.take_along_axis(similarities, best, axis=1)
+            keep = best_scores >= EXPANSION_MIN_COSINE
+            rows.append(np.broadcast_to(start + chunk_rows[:, None], best.shape)[keep])
+            neighbours.append(best[keep].astype(np.int64))
+            scores.append(best_scores[keep].astype(np.float32))
+        return np.concatenate(rows), np.concatenate(neighbours), np.concatenate(scores)
+
+    def __strongest(self, rows: np.ndarray, neighbours: np.ndarray, scores: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # A pair found by both sources keeps its higher score, then every term keeps its EXPANSIONS_PER_TERM best
+        # neighbours (ties go to the lower term id) as CSR-style arrays
+        keys = rows * len(self.terms) + neighbours
+        order = np.lexsort((-scores, keys))
+        keys, rows, neighbours, scores = keys[order], rows[order], neighbours[order], scores[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        rows, neighbours, scores = rows[first], neighbours[first], scores[first]
+        order = np.lexsort((neighbours, -scores, rows))
+        rows, neighbours, scores = rows[order], neighbours[order], scores[order]
+        keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < EXPANSIONS_PER_TERM
+        rows, neighbours, scores = rows[keep], neighbours[keep], scores[keep]
+        offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=len(self.terms)))
+        return offsets, neighbours.astype(np.int32), scores.astype(np.float16)
+
+    def save(self) -> None:
+        metadata = {"source": self.source, "terms": self.terms, "word_lemmas": self.word_lemmas}
+        write_array_file(self.path, EXPANSION_TABLE_FORMAT_VERSION, metadata, {"offsets": self.offsets, "neighbours": self.neighbours, "scores": self.scores})
+
+    def load(self) -> None:
+        metadata, arrays = read_array_file(self.path, EXPANSION_TABLE_FORMAT_VERSION)
+        self.source = metadata["source"]
+        self.terms = metadata["terms"]
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.word_lemmas = metadata["word_lemmas"]
+        self.offsets, self.neighbours, self.scores = arrays["offsets"], arrays["neighbours"], arrays["scores"]
+
+    def related(self, term: str) -> list[tuple[str, float]]:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return []
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return [(self.terms[neighbour], float(score)) for neighbour, score in zip(self.neighbours[start:end].tolist(), self.scores[start:end])]
+
+    def expand(self, query: str) -> str:
+        # Appends the related terms of every query word, strongest first, without repeating words already present
+        tokenizer = get_tokenizer()
+        words = [word for word in tokenizer.words(query) if word not in tokenizer.stopwords]
+        seen = set(words) | {self.word_lemmas.get(word, word) for word in words}
+        candidates = []
+        for word in words:
+            candidates.extend(self.related(self.word_lemmas.get(word, word)))
+        added = []
+        for term, _ in sorted(candidates, key=lambda candidate: -candidate[1]):
+            if term not in seen and len(added) < EXPANSION_MAX_TERMS:
+                seen.add(term)
+                added.append(term)
+        return " ".join([query] + added)
+
+
+def build_expansion_command(embed: bool = True) -> ExpansionTable:
+    model = SemanticSearch().model if embed else None
+    table = ExpansionTable()
+    table.build(open_doc_store(), model)
+    table.save()
+    from .index_builder import republish_snapshot # index_builder imports this module
+    republish_snapshot()
+    return table
+
+
+def expansion_table_matches(drs_docs: DocStore, path: str = expansion_table_path) -> bool:
+    # Whether the table at `path` was mined from these doctors, so a snapshot of them may carry it
+    if not os.path.exists(path):
+        return False
+    try:
+        metadata, _ = read_array_file(path, EXPANSION_TABLE_FORMAT_VERSION)
+    except ValueError:
+        return False
+    return metadata["source"] == drs_docs.source
+
+
+def _load_expansion_table(drs_docs: DocStore, snapshot: Snapshot | None) -> ExpansionTable:
+    # Building the table loads the sentence model and scans the corpus, so a search never does it: a missing or
+    # outdated table is an error until build-expansions is run again. A snapshot uses the copy published with it.
+    if snapshot is not None:
+        if not snapshot.has("expansion_table"):
+            raise FileNotFoundError(f"Snapshot {snapshot.name} has no query expansion table. Run `hybrid_search_cli.py build-expansions`, which publishes it.")
+        table = ExpansionTable(snapshot.file("expansion_table"))
+    else:
+        table = ExpansionTable()
+        if not os.path.exists(table.path):
+            raise FileNotFoundError(f"The query expansion table was not found at: {table.path}. Run `hybrid_search_cli.py build-expansions` first.")
+    table.load()
+    if table.source != drs_docs.source:
+        raise ValueError("The query expansion table was mined from other doctors than the ones searched. Run `hybrid_search_cli.py build-expansions` again.")
+    return table
+
+
+def get_expansion_table() -> ExpansionTable:
+    return get_engine("expansion", _load_expansion_table, [expansion_table_path])
+
+
+def expand_local(query: str) -> str:
+    return get_expansion_table().expand(query)
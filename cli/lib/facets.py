@@ -0,0 +1,120 @@
+import os
+import numpy as np
+from .search_utils import cache_path, FACET_AGE_BUCKET_SIZE
+from .array_file import read_array_file, write_array_file
+from .doc_store import DocStore
+
+FACET_INDEX_FORMAT_VERSION = 1
+FACETS = ["specialty", "age"]
+facet_index_path = os.path.join(cache_path, "facet_index.bin")
+
+
+def age_bucket(age: int) -> str:
+    start = age // FACET_AGE_BUCKET_SIZE * FACET_AGE_BUCKET_SIZE
+    return f"{start}-{start + FACET_AGE_BUCKET_SIZE - 1}"
+
+
+class FacetIndex:
+    # One packed bitmap per facet value (bit i = doctor store row i), stacked per facet as a (values, bytes) matrix.
+    # Bitmaps are combined with bitwise OR within a facet and AND across facets without touching the doctors.
+    def __init__(self, path: str = facet_index_path) -> None:
+        self.path = path
+        self.source = None
+        self.count = 0
+        self.values: dict[str, list[str]] = {}
+        self.value_rows: dict[str, dict[str, int]] = {}
+        self.bitmaps: dict[str, np.ndarray] = {}
+
+    def build(self, drs_docs: DocStore) -> None:
+        self.count = len(drs_docs)
+        self.source = drs_docs.source
+        ages = drs_docs.columns["age"]
+        columns = {"specialty": drs_docs.specialties(), "age": [age_bucket(int(age)) for age in ages]}
+        for facet in FACETS:
+            values = sorted(set(columns[facet]), key=lambda value: (len(value), value) if facet == "age" else value.lower())
+            rows = {value: i for i, value in enumerate(values)}
+            matrix = np.zeros((len(values), self.count), dtype=bool)
+            matrix[[rows[value] for value in columns[facet]], np.arange(self.count)] = True
+            self.values[facet] = values
+            self.bitmaps[facet] = np.packbits(matrix, axis=1)
+        self.__index_values()
+
+    def __index_values(self) -> None:
+        self.value_rows = {facet: {value.lower(): i for i, value in enumerate(values)} for facet, values in self.values.items()}
+
+    def save(self) -> None:
+        write_array_file(self.path, FACET_INDEX_FORMAT_VERSION, {"source": self.source, "count": self.count, "values": self.values}, self.bitmaps)
+
+    def load(self) -> None:
+        metadata, self.bitmaps = read_array_file(self.path, FACET_INDEX_FORMAT_VERSION)
+        self.source = metadata["source"]
+        self.count = metadata["count"]
+        self.values = metadata["values"]
+        self.__index_values()
+
+    def empty(self) -> np.ndarray:
+        return np.zeros((self.count + 7) // 8, dtype=np.uint8)
+
+    def full(self) -> np.ndarray:
+        return np.packbits(np.ones(self.count, dtype=bool))
+
+    def bitmap(self, facet: str, value: str) -> np.ndarray:
+        row = self.value_rows[facet].get(value.lower())
+        return self.empty() if row is None else self.bitmaps[facet][row]
+
+    def any_of(self, facet: str, values: list[str]) -> np.ndarray:
+        # OR of the requested values; for specialties a value also matches every specialty containing it
+        # ("pediatric" -> "Pediatrics", "Pediatric Cardiology"), exact matches are just the common case
+        rows = set()
+        for value in values:
+            value = value.lower().strip()
+            if facet == "specialty":
+                rows.update(row for name, row in self.value_rows[facet].items() if value in name)
+            elif value in self.value_rows[facet]:
+                rows.add(self.value_rows[facet][value])
+        if not rows:
+            return self.empty()
+        return np.bitwise_or.reduce(self.bitmaps[facet][sorted(rows)], axis=0)
+
+    def age_range(self, drs_docs: DocStore, min_age: int = None, max_age: int = None) -> np.ndarray:
+        # Buckets fully inside the range are taken as whole bitmaps, only the boundary buckets check exact ages
+        low = min_age if min_age is not None else -np.inf
+        high = max_age if max_age is not None else np.inf
+        result, partial = self.empty(), self.empty()
+        for value, bitmap in zip(self.values["age"], self.bitmaps["age"]):
+            start = int(value.split("-")[0])
+            end = start + FACET_AGE_BUCKET_SIZE - 1
+            if end < low or start > high:
+                continue
+            if low <= start and end <= high:
+                result |= bitmap
+            else:
+                partial |= bitmap
+        if partial.any():
+            ages = drs_docs.columns["age"]
+            result |= partial & np.packbits((ages >= low) & (ages <= high))
+        return result
+
+    def counts(self, facet: str, within: np.ndarray = None) -> dict[str, int]:
+        bitmaps = self.bitmaps[facet] if within is None else self.bitmaps[facet] & within
+        counts = np.bitwise_count(bitmaps).sum(axis=1)
+        return {value: int(count) for value, count in zip(self.values[facet], counts) if count}
+
+    def to_mask(self, bitmap: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bitmap, count=self.count).astype(bool)
+
+
+def open_facet_index(drs_docs: DocStore, path: str = facet_index_path) -> FacetIndex:
+    # The saved facets are reused while they were built from the same doctor store source
+    facets = FacetIndex(path)
+    if os.path.exists(path):
+        try:
+            facets.load()
+            if facets.source == drs_docs.source and facets.count == len(drs_docs):
+                return facets
+        except ValueError:
+            pass
+    facets = FacetIndex(path)
+    facets.build(drs_docs)
+    facets.save()
+    return facets
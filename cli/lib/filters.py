@@ -0,0 +1,55 @@
+import argparse
+import numpy as np
+from .availability import time_window, now_window
+from .doc_store import DocStore
+from .facets import FACETS, open_facet_index
+from .engines import get_doc_store
+from .search_daemon import served
+
+
+def add_filter_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--day", type=str, help="Only doctors available on this weekday (e.g. Thu)")
+    parser.add_argument("--time", type=str, help="Only doctors available at this time (HH:MM) or during this window (HH:MM-HH:MM)")
+    parser.add_argument("--open-now", action="store_true", help="Only doctors available right now")
+    parser.add_argument("--specialty", type=str, action="append", help="Only doctors whose specialty contains this text (repeat to allow several)")
+    parser.add_argument("--min-age", type=int, help="Only doctors at least this old")
+    parser.add_argument("--max-age", type=int, help="Only doctors at most this old")
+
+
+def filters_from_args(args: argparse.Namespace) -> dict:
+    return {"day": args.day, "time": args.time, "open_now": args.open_now, "specialty": args.specialty, "min_age": args.min_age, "max_age": args.max_age}
+
+
+def resolve_filters(drs_docs: DocStore, filters: dict | None) -> np.ndarray | None:
+    # Turns the filter options into a bool mask over the doctor store rows, or None when nothing is filtered.
+    # Facets are ANDed as packed bitmaps first; engines apply the mask to their candidates before scoring.
+    if not filters:
+        return None
+    mask = None
+    if filters.get("specialty") or filters.get("min_age") is not None or filters.get("max_age") is not None:
+        facets = open_facet_index(drs_docs)
+        bitmap = facets.full()
+        if filters.get("specialty"):
+            bitmap &= facets.any_of("specialty", filters["specialty"])
+        if filters.get("min_age") is not None or filters.get("max_age") is not None:
+            bitmap &= facets.age_range(drs_docs, filters.get("min_age"), filters.get("max_age"))
+        mask = facets.to_mask(bitmap)
+    if filters.get("open_now"):
+        if filters.get("day") or filters.get("time"):
+            raise ValueError("--open-now cannot be combined with --day or --time.")
+        available = drs_docs.available_rows(now_window())
+        mask = available if mask is None else mask & available
+    elif filters.get("day") or filters.get("time"):
+        available = drs_docs.available_rows(time_window(filters.get("day"), filters.get("time")))
+        mask = available if mask is None else mask & available
+    return mask
+
+
+@served
+def facet_counts_command(filters: dict = None) -> tuple[int, dict[str, dict[str, int]]]:
+    drs_docs = get_doc_store()
+    facets = open_facet_index(drs_docs)
+    mask = resolve_filters(drs_docs, filters)
+    within = None if mask is None else np.packbits(mask)
+    total = len(drs_docs) if mask is None else int(mask.sum())
+    return total, {facet: facets.counts(facet, within) for facet in FACETS}
@@ -0,0 +1,45 @@
+import numpy as np
+from .search_utils import RRF_K, top_k_indices
+
+FUSION_METHODS = ["weighted", "rrf", "combsum", "combmnz"]
+
+
+def empty_leg() -> tuple[np.ndarray, np.ndarray]:
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+
+def fuse(legs: list[tuple[np.ndarray, np.ndarray]], size: int, method: str, limit: int, weights: list[float] = None, k: int = RRF_K) -> dict[str, np.ndarray]:
+    # Every leg is a ranked (rows, scores) pair over the same doctor row space. The legs are scattered onto dense
+    # per-row arrays, so matching doctors across legs is plain indexing, and every doctor returned by any leg is
+    # fused. Returns the top `limit` rows with their fused score and, per leg, their min-max normalized score
+    # (0 where the leg did not return the doctor) and 1-based rank (0 where it did not).
+    #   weighted: sum of weights[i] * normalized score
+    #   rrf:      sum of 1 / (k + rank) over the legs that returned the doctor
+    #   combsum:  sum of normalized scores
+    #   combmnz:  combsum times the number of legs that returned the doctor
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method '{method}'. Choose one of: {', '.join(FUSION_METHODS)}")
+    weights = weights if weights is not None else [1.0] * len(legs)
+    normalized = np.zeros((len(legs), size))
+    ranks = np.zeros((len(legs), size), dtype=np.int64)
+    for leg, (rows, scores) in enumerate(legs):
+        if len(rows):
+            scores = np.asarray(scores, dtype=np.float64)
+            low, high = scores.min(), scores.max()
+            normalized[leg, rows] = (scores - low) / (high - low) if high > low else 1.0
+            ranks[leg, rows] = np.arange(1, len(rows) + 1)
+    candidates = np.flatnonzero((ranks > 0).any(axis=0))
+    normalized, ranks = normalized[:, candidates], ranks[:, candidates]
+
+    match method:
+        case "weighted":
+            fused = np.asarray(weights, dtype=np.float64) @ normalized
+        case "rrf":
+            fused = np.where(ranks > 0, 1 / (k + ranks), 0.0).sum(axis=0)
+        case "combsum":
+            fused = normalized.sum(axis=0)
+        case "combmnz":
+            fused = normalized.sum(axis=0) * (ranks > 0).sum(axis=0)
+
+    best = top_k_indices(fused, limit)
+    return {"rows": candidates[best], "scores": fused[best], "normalized": normalized[:, best], "ranks": ranks[:, best]}
@@ -0,0 +1,17 @@
+import os
+from dotenv import load_dotenv
+from google import genai
+
+_client = None
+
+
+def get_client() -> genai.Client:
+    # Created on first use, so commands that never call the LLM also run without an API key or network access
+    global _client
+    if _client is None:
+        load_dotenv()
+        api_key = os.environ.get("GEMINI_API_KEY")
+        if not api_key:
+            raise RuntimeError("GEMINI_API_KEY environment variable not set")
+        _client = genai.Client(api_key=api_key)
+    return _client
@@ -1,91 +1,347 @@
-import os
-
-from .keyword_search import InvertedIndex
-from .semantic_search import SemanticSearch
-from .search_utils import HYBRID_A, DEFAULT_SEARCH_LIMIT, load_doctors, RRF_K
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from .keyword_search import InvertedIndex, get_inverted_index
+from .semantic_search import SemanticSearch, get_semantic_search
+from .search_utils import HYBRID_A, DEFAULT_SEARCH_LIMIT, RRF_K, ENHANCE_TIME_BUDGET, LEG_TIMEOUT, CANDIDATE_DEPTH_START, CANDIDATE_DEPTH_GROWTH, CANDIDATE_DEPTH_MAX, RERANK_CANDIDATE_FACTOR, RERANK_BATCH_SIZE, RERANK_PROCESSES
 from .query_enhancement import enhance_query
 from .rerank import rerank_results
+from .doc_store import DocStore
+from .filters import resolve_filters
+from .fusion import empty_leg, fuse
+from .engines import get_engine
+from .search_daemon import served
+from .result_cache import get_result_cache, index_version
+
+Leg = tuple[np.ndarray, np.ndarray] # (doctor store rows, scores), best first
+
+
+class SearchRun:
+    # State of one search, kept apart from the shared HybridSearch so concurrent searches (e.g. in the search daemon)
+    # do not overwrite each other's leg outcomes, stats or encoded queries
+    def __init__(self) -> None:
+        self.leg_status: dict[str, str] = {} # Outcome of each leg in the last round: "ok", "timeout" or "failed"
+        self.search_stats: dict = {} # Candidate depths, rounds, time and stop reason of the fused search
+        self.query_embeddings: dict[str, np.ndarray] = {} # Encoded queries, reused by every depth round
+
 
 class HybridSearch:
-    def __init__(self, drs_docs: list[dict]) -> None:
+    def __init__(self, drs_docs: DocStore, concurrent: bool = False, leg_timeouts: dict[str, float] = None,
+                 semantic_search: SemanticSearch = None, idx: InvertedIndex = None) -> None:
         self.drs_docs = drs_docs
-        self.semantic_search = SemanticSearch()
-        self.semantic_search.load_or_create_embeddings(drs_docs)
+        self.leg_timeouts = leg_timeouts or {"bm25": LEG_TIMEOUT, "semantic": LEG_TIMEOUT}
+        self.executor = self.__new_executor() if concurrent else None
+        self.executor_lock = threading.Lock()
+        # Already loaded engines (see get_hybrid_search) are shared instead of being loaded again
+        if semantic_search is None:
+            semantic_search = SemanticSearch()
+            semantic_search.load_or_create_embeddings(drs_docs)
+        self.semantic_search = semantic_search
 
-        self.idx = InvertedIndex()
-        self.idx.load()
+        if idx is None:
+            idx = InvertedIndex()
+            idx.load()
+            if any(idx.sync(drs_docs).values()):
+                idx.save()
+        self.idx = idx
 
-        if not os.path.exists(self.idx.index_path) or len(self.idx.docmap) != len(drs_docs):
-            self.idx.build()
-            self.idx.save()
+    def _bm25_top_k(self, query: str, limit: int, mask: np.ndarray = None) -> Leg:
+        return self.idx.bm25_top_k(query, limit, mask)
 
-    def _bm25_search(self, query: str, limit: int) -> list[dict]:
-        return self.idx.bm25_search(query, limit)
+    def _semantic_top_k(self, query: str, limit: int, mask: np.ndarray, run: SearchRun) -> Leg:
+        if query not in run.query_embeddings:
+            run.query_embeddings[query] = self.semantic_search.embed_queries([query])[0]
+        return self.semantic_search.top_k(query, limit, mask, run.query_embeddings[query])
 
-    def weighted_search(self, query: str, alpha: float, limit: int=DEFAULT_SEARCH_LIMIT) -> list[dict]:
-        bm25_results = self._bm25_search(query, limit * 50)
-        semantic_results = self.semantic_search.search(query, limit * 50)
-        bm25_normalized_scores = normalize_command([result["score"] for result in bm25_results])
-        semantic_normalized_scores = normalize_command([result["score"] for result in semantic_results])
+    def __new_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=2, thread_name_prefix="hybrid-leg")
+
+    def _search_legs(self, query: str, limit: int, mask: np.ndarray, run: SearchRun) -> list[Leg]:
+        executor = self.executor
+        if executor is None:
+            run.leg_status = {"bm25": "ok", "semantic": "ok"}
+            return [self._bm25_top_k(query, limit, mask), self._semantic_top_k(query, limit, mask, run)]
+        # Both legs run at the same time (the encoder and NumPy release the GIL), so the latency is the slower leg
+        # instead of the sum. A leg that misses its deadline or fails is dropped and the other one is used alone.
+        start = time.perf_counter()
+        futures = {
+            "bm25": executor.submit(self._bm25_top_k, query, limit, mask),
+            "semantic": executor.submit(self._semantic_top_k, query, limit, mask, run),
+        }
         results = {}
-        for i, result in enumerate(bm25_results):
-            results[result["doc"]["id"]] = {
-                "doc": result["doc"],
-                "bm25_normalized": bm25_normalized_scores[i],
-                "semantic_normalized": semantic_normalized_scores[i],
-                "hybrid_score": self.hybrid_score(bm25_normalized_scores[i], semantic_normalized_scores[i], alpha)
-            }
-        results_sorted = sorted(results.items(), key=lambda item: item[1]["hybrid_score"], reverse=True)
-        return [result[1] for result in results_sorted[:limit]]
+        for leg, future in futures.items():
+            try:
+                results[leg] = future.result(timeout=max(0.0, start + self.leg_timeouts[leg] - time.perf_counter()))
+                run.leg_status[leg] = "ok"
+            except TimeoutError:
+                results[leg] = empty_leg()
+                run.leg_status[leg] = "timeout"
+            except Exception as e:
+                print(f"The {leg} leg failed: {e}")
+                results[leg] = empty_leg()
+                run.leg_status[leg] = "failed"
+        if "timeout" in run.leg_status.values():
+            # A late leg cannot be interrupted: it finishes in the old pool while later searches get fresh workers.
+            # Only the first search to see the pool stalled replaces it.
+            with self.executor_lock:
+                if self.executor is executor:
+                    self.executor = self.__new_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+        if all(status != "ok" for status in run.leg_status.values()):
+            raise TimeoutError(f"No hybrid search leg answered in time: {run.leg_status}")
+        return [results["bm25"], results["semantic"]]
+
+    def _adaptive_fuse(self, query: str, method: str, limit: int, mask: np.ndarray = None, weights: list[float] = None, k: int = RRF_K,
+                       time_budget: float = None, depth: int = None, legs_at: Callable[[int], list[Leg]] = None, run: SearchRun = None) -> dict[str, np.ndarray]:
+        # Starts with shallow legs and widens them while the fused top `limit` still changes from one depth to the
+        # next, so easy queries settle on a few dozen candidates and hard ones go up to limit * CANDIDATE_DEPTH_MAX.
+        # A wider round is skipped when its expected cost (the last round times the growth) would overrun
+        # time_budget. A fixed depth runs a single round, and so does a round where a leg missed its deadline or
+        # failed: widening only helps when both legs answered, and a late leg would wait out its timeout again.
+        run = run or SearchRun()
+        legs_at = legs_at or (lambda current: self._search_legs(query, current, mask, run))
+        start = time.perf_counter()
+        max_depth = limit * CANDIDATE_DEPTH_MAX
+        current = depth or min(limit * CANDIDATE_DEPTH_START, max_depth)
+        depths, previous = [], None
+        while True:
+            round_start = time.perf_counter()
+            legs = legs_at(current)
+            fused = fuse(legs, len(self.drs_docs), method, limit, weights, k)
+            depths.append(current)
+            now = time.perf_counter()
+            if depth:
+                stop = "fixed"
+            elif "timeout" in run.leg_status.values():
+                stop = "timeout"
+            elif "failed" in run.leg_status.values():
+                stop = "failed"
+            elif previous is not None and np.array_equal(previous, fused["rows"]):
+                stop = "stable"
+            elif all(len(rows) < current for rows, _ in legs):
+                stop = "exhausted" # Every leg already returned all of its matches
+            elif current >= max_depth:
+                stop = "max_depth"
+            elif time_budget is not None and now - start + (now - round_start) * CANDIDATE_DEPTH_GROWTH > time_budget:
+                stop = "budget"
+            else:
+                previous = fused["rows"]
+                current = min(current * CANDIDATE_DEPTH_GROWTH, max_depth)
+                continue
+            break
+        run.search_stats = {"depths": depths, "rounds": len(depths), "stop": stop, "seconds": now - start}
+        return fused
+
+    def _adaptive_fuse_many(self, queries: list[str], method: str, limit: int, mask: np.ndarray = None, weights: list[float] = None, k: int = RRF_K,
+                            time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[dict[str, np.ndarray]]:
+        # All queries are encoded in one batch up front, then each one widens its own legs
+        run = run or SearchRun()
+        run.query_embeddings = dict(zip(queries, self.semantic_search.embed_queries(queries)))
+        fused, stats = [], []
+        for query in queries:
+            fused.append(self._adaptive_fuse(query, method, limit, mask, weights, k, time_budget, depth, run=run))
+            stats.append(run.search_stats)
+        run.search_stats = {"queries": stats}
+        return fused
+
+    def fused_search(self, query: str, method: str, limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None, weights: list[float] = None, k: int = RRF_K,
+                     time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[dict]:
+        return self._fused_results(self._adaptive_fuse(query, method, limit, mask, weights, k, time_budget, depth, run=run))
+
+    def _fused_results(self, fused: dict[str, np.ndarray]) -> list[dict]:
+        results = []
+        for i, row in enumerate(fused["rows"].tolist()):
+            bm25_rank, semantic_rank = fused["ranks"][:, i].tolist()
+            results.append({
+                "doc": self.drs_docs[row],
+                "score": float(fused["scores"][i]),
+                "bm25_normalized": float(fused["normalized"][0, i]),
+                "semantic_normalized": float(fused["normalized"][1, i]),
+                "bm25_rank": bm25_rank or None,
+                "semantic_rank": semantic_rank or None,
+            })
+        return results
+
+    def weighted_search(self, query: str, alpha: float, limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None, time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[dict]:
+        return self._weighted_results(self._adaptive_fuse(query, "weighted", limit, mask, [alpha, 1 - alpha], time_budget=time_budget, depth=depth, run=run))
+
+    def weighted_search_many(self, queries: list[str], alpha: float, limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None, time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[list[dict]]:
+        return [self._weighted_results(fused) for fused in self._adaptive_fuse_many(queries, "weighted", limit, mask, [alpha, 1 - alpha], time_budget=time_budget, depth=depth, run=run)]
+
+    def _weighted_results(self, fused: dict[str, np.ndarray]) -> list[dict]:
+        return [{
+            "doc": result["doc"],
+            "bm25_normalized": result["bm25_normalized"],
+            "semantic_normalized": result["semantic_normalized"],
+            "hybrid_score": result["score"],
+        } for result in self._fused_results(fused)]
 
     def hybrid_score(self, bm25_score: float, semantic_score: float, alpha=HYBRID_A) -> float:
             return alpha * bm25_score + (1 - alpha) * semantic_score    
 
-    def rrf_search(self, query, k: int, limit=10) -> list[tuple]:
-        bm25_results = self._bm25_search(query, limit * 50)
-        semantic_results = self.semantic_search.search(query, limit * 50)
-        semantic_map = {ss["id"]: i for i, ss in enumerate(semantic_results, start=1)}
-        results = {}
-        for i, result in enumerate(bm25_results, start=1):
-            doc_id = result["doc"]["id"] 
-            results[doc_id] = {
-                "doc": result["doc"],
-                "bm25_rank": i,
-                "semantic_rank": semantic_map.get("doc_id", 10000),
-                "rrf_score": (1 / (k + i)) + (1 / (k + semantic_map.get("doc_id", 10000)))
-            }
-        return sorted(results.items(), key=lambda item: item[1]["rrf_score"], reverse=True)[:limit]
-
-
-def weighted_search_command(query: str, alpha: float, limit: int) -> list[dict]:
-    drs_docs = load_doctors()
-    hybrid_search = HybridSearch(drs_docs)
-    return hybrid_search.weighted_search(query, alpha, limit)
-
-
-def rrf_search_command(query: str, limit: int, k: int = RRF_K, enhance: str = None, rerank: str = None) -> dict:
-    drs_docs = load_doctors()
-    hybrid_search = HybridSearch(drs_docs)
-    
+    def rrf_search(self, query, k: int, limit=10, mask: np.ndarray = None, time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[tuple]:
+        return self._rrf_results(self._adaptive_fuse(query, "rrf", limit, mask, k=k, time_budget=time_budget, depth=depth, run=run))
+
+    def speculative_rrf_search(self, query: str, enhance: str, k: int, limit=10, mask: np.ndarray = None, budget: float = ENHANCE_TIME_BUDGET,
+                               time_budget: float = None, depth: int = None, run: SearchRun = None) -> tuple[list[tuple], str | None, str]:
+        # The enhancement runs in a worker thread while both legs are retrieved for the raw query, so its latency
+        # overlaps retrieval instead of preceding it. Raw results are returned when the enhancement is late, fails
+        # or changes nothing, and a keyword leg whose terms the enhancement did not change is reused as is.
+        run = run or SearchRun()
+        deadline = time.perf_counter() + budget
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(enhance_query, query, enhance)
+        executor.shutdown(wait=False)
+        raw_bm25_legs = {}
+
+        def raw_legs_at(depth: int) -> list[Leg]:
+            legs = self._search_legs(query, depth, mask, run)
+            raw_bm25_legs[depth] = legs[0]
+            return legs
+
+        raw = self._adaptive_fuse(query, "rrf", limit, mask, k=k, time_budget=time_budget, depth=depth, legs_at=raw_legs_at, run=run)
+        try:
+            enhanced_q = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except TimeoutError:
+            return self._rrf_results(raw), None, "timeout"
+        except Exception as e:
+            print(f"Query enhancement failed, using the original query: {e}")
+            return self._rrf_results(raw), None, "failed"
+        if _normalize_query(enhanced_q) == _normalize_query(query):
+            return self._rrf_results(raw), enhanced_q, "unchanged"
+        legs_at = None
+        if self.idx.query_terms(enhanced_q) == self.idx.query_terms(query):
+            def legs_at(depth: int) -> list[Leg]:
+                if depth not in raw_bm25_legs:
+                    return self._search_legs(enhanced_q, depth, mask, run)
+                return [raw_bm25_legs[depth], self._semantic_top_k(enhanced_q, depth, mask, run)]
+        enhanced = self._adaptive_fuse(enhanced_q, "rrf", limit, mask, k=k, time_budget=time_budget, depth=depth, legs_at=legs_at, run=run)
+        return self._rrf_results(enhanced), enhanced_q, "applied"
+
+    def rrf_search_many(self, queries: list[str], k: int, limit=10, mask: np.ndarray = None, time_budget: float = None, depth: int = None, run: SearchRun = None) -> list[list[tuple]]:
+        return [self._rrf_results(fused) for fused in self._adaptive_fuse_many(queries, "rrf", limit, mask, k=k, time_budget=time_budget, depth=depth, run=run)]
+
+    def _rrf_results(self, fused: dict[str, np.ndarray]) -> list[tuple]:
+        # A rank of None means the leg did not return the doctor, which then only scores through the other leg
+        return [(result["doc"]["id"], {
+            "doc": result["doc"],
+            "bm25_rank": result["bm25_rank"],
+            "semantic_rank": result["semantic_rank"],
+            "rrf_score": result["score"],
+        }) for result in self._fused_results(fused)]
+
+
+def get_hybrid_search(concurrent: bool = False, leg_timeouts: dict[str, float] = None) -> HybridSearch:
+    leg_timeouts = leg_timeouts or {"bm25": LEG_TIMEOUT, "semantic": LEG_TIMEOUT}
+    semantic_search, idx = SemanticSearch(), InvertedIndex()
+    return get_engine(
+        f"hybrid-{concurrent}-{sorted(leg_timeouts.items())}",
+        lambda drs_docs, snapshot: HybridSearch(drs_docs, concurrent, leg_timeouts, get_semantic_search(), get_inverted_index()),
+        [idx.index_path, semantic_search.embeddings_path, semantic_search.manifest_path],
+    )
+
+
+def _cached_response(command: str, query: str, params: dict, use_cache: bool) -> tuple[str | None, str | None, dict | None]:
+    # Key, index version and the cached response, if any. Filters on the current time are never cached.
+    if not use_cache or (params.get("filters") or {}).get("open_now"):
+        return None, None, None
+    result_cache = get_result_cache()
+    version = index_version()
+    key = result_cache.key(command, query, params, version)
+    response, level = result_cache.get(key, version)
+    if response is not None:
+        response["cache"] = level
+    return key, version, response
+
+
+def _store_response(key: str | None, version: str | None, response: dict) -> dict:
+    # Degraded responses (a leg or the enhancement missed its deadline, or the time budget cut the candidate depth)
+    # are returned but not cached, so a slow moment is not replayed afterwards
+    degraded = (any(status != "ok" for status in response["leg_status"].values())
+                or response.get("enhance_status") in ("timeout", "failed")
+                or response["search_stats"].get("stop") == "budget")
+    if key is not None and not degraded:
+        get_result_cache().put(key, version, response)
+    response["cache"] = "miss" if key is not None else None
+    return response
+
+
+@served
+def weighted_search_command(query: str, alpha: float, limit: int, filters: dict = None, concurrent: bool = False, leg_timeout: float = LEG_TIMEOUT,
+                            time_budget: float = None, depth: int = None, cache: bool = True) -> dict:
+    hybrid_search = get_hybrid_search(concurrent, {"bm25": leg_timeout, "semantic": leg_timeout})
+    key, version, response = _cached_response("weighted", query, {"alpha": alpha, "limit": limit, "filters": filters, "depth": depth}, cache)
+    if response is not None:
+        return response
+    run = SearchRun()
+    results = hybrid_search.weighted_search(query, alpha, limit, resolve_filters(hybrid_search.drs_docs, filters), time_budget, depth, run)
+    return _store_response(key, version, {"results": results, "leg_status": run.leg_status, "search_stats": run.search_stats})
+
+
+@served
+def fused_search_command(query: str, method: str, limit: int, alpha: float = HYBRID_A, k: int = RRF_K, filters: dict = None, concurrent: bool = False, leg_timeout: float = LEG_TIMEOUT,
+                         time_budget: float = None, depth: int = None, cache: bool = True) -> dict:
+    hybrid_search = get_hybrid_search(concurrent, {"bm25": leg_timeout, "semantic": leg_timeout})
+    params = {"method": method, "limit": limit, "alpha": alpha, "k": k, "filters": filters, "depth": depth}
+    key, version, response = _cached_response("fused", query, params, cache)
+    if response is not None:
+        return response
+    run = SearchRun()
+    results = hybrid_search.fused_search(query, method, limit, resolve_filters(hybrid_search.drs_docs, filters), [alpha, 1 - alpha], k, time_budget, depth, run)
+    return _store_response(key, version, {"results": results, "leg_status": run.leg_status, "search_stats": run.search_stats})
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+
+@served
+def rrf_search_command(query: str, limit: int, k: int = RRF_K, enhance: str = None, rerank: str = None, filters: dict = None, speculative: bool = False, budget: float = ENHANCE_TIME_BUDGET, concurrent: bool = False, leg_timeout: float = LEG_TIMEOUT,
+                       time_budget: float = None, depth: int = None, cache: bool = True, rerank_batch_size: int = RERANK_BATCH_SIZE, rerank_processes: int = RERANK_PROCESSES) -> dict:
+    hybrid_search = get_hybrid_search(concurrent, {"bm25": leg_timeout, "semantic": leg_timeout})
+    params = {"limit": limit, "k": k, "enhance": enhance, "rerank": rerank, "filters": filters, "speculative": speculative, "depth": depth}
+    key, version, response = _cached_response("rrf", query, params, cache)
+    if response is not None:
+        response["original_query"] = query
+        return response
+    mask = resolve_filters(hybrid_search.drs_docs, filters)
+    # A reranker reorders a wider fused list, the legs themselves only go as deep as the fused top needs
+    candidates = limit * RERANK_CANDIDATE_FACTOR if rerank else limit
+
+    run = SearchRun()
     original_q = query
     enhanced_q = None
-    if enhance:
-        enhanced_q = enhance_query(query, method=enhance)
-        query = enhanced_q
+    enhance_status = None
+    if enhance and speculative:
+        fused, enhanced_q, enhance_status = hybrid_search.speculative_rrf_search(query, enhance, k, candidates, mask, budget, time_budget, depth, run)
+        if enhance_status == "applied":
+            query = enhanced_q
+    else:
+        if enhance:
+            enhanced_q = enhance_query(query, method=enhance)
+            query = enhanced_q
+        fused = hybrid_search.rrf_search(query, k, candidates, mask, time_budget, depth, run)
 
-    results: list[dict] = [result[1] for result in hybrid_search.rrf_search(query, k, limit)]
+    results: list[dict] = [result[1] for result in fused]
 
+    rerank_stats = {} if rerank == "cross_encoder" else None
     if rerank:
-        results = rerank_results(results, query, rerank)
+        results = rerank_results(results, query, rerank, rerank_batch_size, rerank_processes, rerank_stats)[:limit]
 
-    return {
+    return _store_response(key, version, {
         "original_query": original_q,
         "enhanced_query": enhanced_q,
         "enhance_method": enhance,
+        "enhance_status": enhance_status,
+        "leg_status": run.leg_status,
+        "search_stats": run.search_stats,
+        "rerank_stats": rerank_stats,
         "query": query,
         "k": k,
         "results": results,
-    }
+    })
 
 
 def normalize_command(scores: list[float]) -> list[float]:
@@ -0,0 +1,193 @@
+import json
+import os
+import shutil
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import batched
+from .search_utils import cache_path, doctors_json_path, doctor_text, iter_doctors, normalize_rows, BUILD_SHARD_SIZE, INGEST_BATCH_SIZE, BM25_K1, BM25_B, SNAPSHOTS_KEPT
+from .tokenizer import get_tokenizer
+from .keyword_search import InvertedIndex, InvertedIndexWriter
+from .semantic_search import SemanticSearch, MODEL_NAME
+from .doc_store import DocStore, DocStoreWriter, open_doc_store, source_fingerprint
+from .snapshots import Snapshot, publish_snapshot, list_snapshots, current_snapshot_name
+from .spell import build_spell_index, spell_index_path
+from .expansion import expansion_table_matches, expansion_table_path
+
+shards_path = os.path.join(cache_path, "shards")
+
+_worker_model = None
+_worker_store = None
+
+
+def _init_worker(embed: bool, store_path: str) -> None:
+    global _worker_model, _worker_store
+    # Workers map the doctor store themselves and only read their own row range, nothing is pickled to them
+    _worker_store = DocStore(store_path)
+    _worker_store.load()
+    if embed:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        torch.set_num_threads(1) # One process per core already, avoid oversubscribing the CPU
+        _worker_model = SentenceTransformer(MODEL_NAME)
+
+
+def _shard_paths(shard_number: int) -> tuple[str, str]:
+    name = os.path.join(shards_path, f"shard_{shard_number:05d}")
+    return name + ".json", name + ".npy"
+
+
+def _process_shard(shard_number: int, rows: range, embed: bool) -> int:
+    tokens_path, embeddings_path = _shard_paths(shard_number)
+    texts = [doctor_text(_worker_store[row]) for row in rows]
+    word_lemmas = {}
+    tokens = get_tokenizer().tokenize_many(texts, word_lemmas)
+    if embed:
+        np.save(embeddings_path, normalize_rows(_worker_model.encode(texts)))
+    # The token file is written last and atomically: its presence marks the shard as complete
+    tmp_path = tokens_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"hashes": [_worker_store.field(row, "hash") for row in rows], "tokens": tokens, "word_lemmas": word_lemmas, "embedded": embed}, f)
+    os.replace(tmp_path, tokens_path)
+    return shard_number
+
+
+def _is_shard_complete(shard_number: int, hashes: list[str], embed: bool) -> bool:
+    tokens_path, embeddings_path = _shard_paths(shard_number)
+    if not os.path.exists(tokens_path) or (embed and not os.path.exists(embeddings_path)):
+        return False
+    with open(tokens_path, "r") as f:
+        shard = json.load(f)
+    return shard["hashes"] == hashes and shard["embedded"] >= embed
+
+
+def build_all_command(workers: int = None, shard_size: int = BUILD_SHARD_SIZE, embed: bool = True, k1: float = BM25_K1, b: float = BM25_B, publish: bool = True) -> tuple[InvertedIndex, SemanticSearch | None]:
+    # Splits doctors.json into shards that are tokenized (and embedded) in a process pool, then merges them into
+    # the keyword index and the embedding store. Completed shards survive an interruption and are skipped on rerun.
+    drs_docs = open_doc_store()
+    hashes = drs_docs.hashes()
+    shards = [range(start, min(start + shard_size, len(drs_docs))) for start in range(0, len(drs_docs), shard_size)]
+    os.makedirs(shards_path, exist_ok=True)
+
+    pending = [n for n, shard in enumerate(shards) if not _is_shard_complete(n, hashes[shard.start:shard.stop], embed)]
+    done = len(shards) - len(pending)
+    if done:
+        print(f"Resuming: {done}/{len(shards)} shards already complete")
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(embed, drs_docs.path)) as executor:
+            futures = [executor.submit(_process_shard, n, shards[n], embed) for n in pending]
+            for future in as_completed(futures):
+                shard_number = future.result()
+                done += 1
+                print(f"Shard {shard_number} done ({len(shards[shard_number])} doctors) - {done}/{len(shards)}")
+
+    print("Merging shards")
+    idx = InvertedIndex()
+    idx.k1 = k1
+    idx.b = b
+    for n, shard in enumerate(shards):
+        with open(_shard_paths(n)[0], "r") as f:
+            shard_data = json.load(f)
+        for word, lemma in shard_data["word_lemmas"].items():
+            if idx.word_lemmas.setdefault(word, lemma) != lemma:
+                idx.word_lemmas[word] = None
+        for row, tokens in zip(shard, shard_data["tokens"]):
+            idx.add_document(drs_docs[row], tokens)
+    idx.doc_store = drs_docs
+    idx.save()
+    build_spell_index(idx, drs_docs)
+
+    semantic_search = None
+    if embed:
+        semantic_search = SemanticSearch()
+        semantic_search.import_embeddings(drs_docs, [np.load(_shard_paths(n)[1], mmap_mode="r") for n in range(len(shards))])
+    shutil.rmtree(shards_path)
+    if publish and semantic_search is not None:
+        _publish(drs_docs, idx, semantic_search)
+    elif publish:
+        republish_snapshot() # Keyword only: the embeddings are synced by the publish, and only if searches read a snapshot
+    return idx, semantic_search
+
+
+def ingest_command(source: str = doctors_json_path, batch_size: int = INGEST_BATCH_SIZE, k1: float = BM25_K1, b: float = BM25_B, publish: bool = True) -> tuple[InvertedIndex, SemanticSearch]:
+    # One pass over the source (JSON array or JSON Lines): every fixed-size batch of doctors is appended to the
+    # doctor store's column files, tokenized into the keyword postings and encoded into embeddings appended to a
+    # raw file, so only one batch of doctors, text and vectors (plus the keyword vocabulary) is held in memory at a
+    # time. The store, the keyword index and the embeddings are then assembled from their files.
+    writer = DocStoreWriter()
+    idx = InvertedIndex()
+    idx.k1 = k1
+    idx.b = b
+    index_writer = InvertedIndexWriter(idx)
+    semantic_search = SemanticSearch()
+    tokenizer = get_tokenizer()
+    os.makedirs(cache_path, exist_ok=True)
+    raw_path = semantic_search.embeddings_path + ".raw"
+    rows = 0
+    dimensions = semantic_search.model.get_sentence_embedding_dimension()
+    with open(raw_path, "wb") as raw_file:
+        for batch in batched(iter_doctors(source), batch_size):
+            writer.add_many(batch)
+            texts = [doctor_text(doctor) for doctor in batch]
+            index_writer.add_many(batch, tokenizer.tokenize_many(texts, idx.word_lemmas))
+            normalize_rows(semantic_search.model.encode(texts, batch_size=batch_size)).tofile(raw_file)
+            rows += len(batch)
+            print(f"Ingested {rows} doctors")
+    writer.finish(source_fingerprint(source))
+    index_writer.finish()
+    drs_docs = DocStore(writer.path)
+    drs_docs.load()
+    idx.doc_store = drs_docs
+    idx.save()
+    build_spell_index(idx, drs_docs)
+
+    embeddings = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(rows, dimensions)) if rows else np.empty((0, dimensions), dtype=np.float32)
+    semantic_search.import_embeddings(drs_docs, [embeddings])
+    del embeddings
+    os.remove(raw_path)
+    if publish:
+        _publish(drs_docs, idx, semantic_search)
+    return idx, semantic_search
+
+
+def _publish(drs_docs: DocStore, idx: InvertedIndex, semantic_search: SemanticSearch, keep: int = SNAPSHOTS_KEPT) -> Snapshot:
+    files = {
+        "doc_store": drs_docs.path,
+        "keyword_index": idx.index_path,
+        "embeddings": semantic_search.embeddings_path,
+        "embeddings_manifest": semantic_search.manifest_path,
+        "spell_index": spell_index_path,
+    }
+    if expansion_table_matches(drs_docs):
+        files["expansion_table"] = expansion_table_path
+    snapshot = publish_snapshot(files, drs_docs, keep)
+    print(f"Published snapshot {snapshot.name}")
+    return snapshot
+
+
+def publish_snapshot_command(source: str = None, keep: int = SNAPSHOTS_KEPT) -> Snapshot:
+    # Brings the working keyword index and embeddings up to date with the doctors (only changed doctors are
+    # re-indexed), then publishes them with the doctor store as one snapshot
+    drs_docs = open_doc_store(source)
+    idx = InvertedIndex()
+    if os.path.exists(idx.index_path):
+        idx.load()
+    changed = any(idx.sync(drs_docs).values()) or not os.path.exists(idx.index_path)
+    if changed:
+        idx.save()
+    if changed or not os.path.exists(spell_index_path):
+        build_spell_index(idx, drs_docs)
+    semantic_search = SemanticSearch()
+    semantic_search.load_or_create_embeddings(drs_docs)
+    return _publish(drs_docs, idx, semantic_search, keep)
+
+
+def republish_snapshot() -> Snapshot | None:
+    # Once a snapshot is published, searches only read CURRENT, so commands that update the working files (keyword
+    # build and sync, embedding updates) publish them again. Nothing is published while no snapshot exists.
+    if current_snapshot_name() is None:
+        return None
+    return publish_snapshot_command()
+
+
+def list_snapshots_command() -> list[Snapshot]:
+    return list_snapshots()
@@ -1,50 +1,242 @@
-import string
 import os
-import pickle
+import json
 import math
+import shutil
+import heapq
+import numpy as np
+
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate
+from lib.search_utils import cache_path, doctor_text, doctor_hash, BM25_K1, BM25_B, MAXSCORE_FIRST_WINDOW, MAXSCORE_MAX_WINDOW
+from lib.array_file import read_array_file, write_array_file
+from lib.tokenizer import get_tokenizer, TOKENIZE_BATCH_SIZE
+from lib.doc_store import DocStore, DoctorRecord, open_doc_store, ids_and_hashes
+from lib.filters import resolve_filters
+from lib.engines import get_engine
+from lib.snapshots import Snapshot
+from lib.search_daemon import served
+from lib.spell import build_spell_index, spell_index_path
+
+INDEX_FORMAT_VERSION = 5
 
-from collections import Counter, defaultdict
-from nltk import pos_tag
-from nltk.corpus import wordnet
-from nltk.stem import WordNetLemmatizer
-from lib.search_utils import load_doctors, get_stopwords, cache_path, BM25_K1, BM25_B
-
-lemmatizer = WordNetLemmatizer()
 # {"id": "DR210", "name": "Dr. Agatha Christie", "age": 45, "specialty": "Forensic Toxicology", "availability": "Mon-Fri 09:00-17:00", "bio": "Expert in identifying chemical agents and drug interactions in complex cases."}
 class InvertedIndex:
+    # Postings are stored per term as slices of flat arrays: sorted integer doc rows with parallel
+    # term frequencies and precomputed BM25 weights. `term_offsets[t]:term_offsets[t + 1]` is term t's slice.
     def __init__(self) -> None:
-        self.index: defaultdict[str, set[str]] = defaultdict(set) # Tokens to doc_ids
-        self.docmap: dict[str, dict] = {} # doc_ids to full_docs
-        self.term_frequencies: defaultdict[str, Counter[str, int]] = defaultdict(Counter)
-        self.doc_lengths: dict[str, int] = {}
-        self.index_path = os.path.join(cache_path, "index.pkl") 
-        self.docmap_path = os.path.join(cache_path, "docmap.pkl")
-        self.term_frequencies_path = os.path.join(cache_path, "term_frequencies.pkl")
-        self.doc_lengths_path = os.path.join(cache_path, "doc_lengths.pkl")
-
-    def build(self) -> None:
-        doctors_data = load_doctors()
-        for _, doctor in enumerate(doctors_data):
-            self.docmap[doctor["id"]] = doctor
-            doctor_info = f"{doctor["name"]}. {doctor["age"]}. {doctor["specialty"]}. {doctor["bio"]}. {doctor["availability"]}" 
-            self.__add_document(doctor["id"], doctor_info)
+        self.terms: dict[str, int] = {} # Tokens to term ids
+        self.doc_ids: list[str] = [] # Doc rows to doc_ids
+        self.doc_rows: dict[str, int] = {} # doc_ids to doc rows
+        self.doc_store: DocStore | None = None # Doctor records, looked up only for the results that are returned
+        self.doc_hashes: dict[str, str] = {} # doc_ids to content hashes, used to detect edited doctors
+        self.word_lemmas: dict[str, str | None] = {} # Surface words seen at index time to their lemma (None if ambiguous)
+        self.__pending_changes: dict[str, Counter[str] | None] = {} # Doc_ids to their new token counts (None when removed) not yet applied to the arrays
+        self.__store_rows: tuple[DocStore, np.ndarray, np.ndarray] | None = None # Doc rows to doctor store rows (for filter masks) and tie-break keys
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.posting_docs = np.empty(0, dtype=np.int32)
+        self.posting_tfs = np.empty(0, dtype=np.int32)
+        self.posting_weights = np.empty(0, dtype=np.float32)
+        self.term_max_weights = np.empty(0, dtype=np.float32) # Per term BM25 upper bound, used to skip documents at query time
+        self.doc_lengths = np.empty(0, dtype=np.int32)
+        self.k1 = BM25_K1
+        self.b = BM25_B
+        self.avg_doc_length = 0.0
+        self.index_path = os.path.join(cache_path, "keyword_index.bin")
+
+    def build(self, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        self.doc_store = open_doc_store()
+        doctors_data = list(self.doc_store)
+        self.k1 = k1
+        self.b = b
+        self.terms, self.doc_ids, self.doc_rows = {}, [], {}
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.posting_docs = np.empty(0, dtype=np.int32)
+        self.posting_tfs = np.empty(0, dtype=np.int32)
+        self.doc_lengths = np.empty(0, dtype=np.int32)
+        self.doc_hashes = {}
+        self.word_lemmas = {}
+        self.__pending_changes = {}
+        for doctor, tokens in self.__tokenize_batch(doctors_data):
+            self.add_document(doctor, tokens)
+        self.__ensure_frozen()
+
+    def add_document(self, doctor: dict, tokens: list[str] = None) -> None:
+        if doctor["id"] in self.doc_hashes:
+            raise ValueError(f"Doctor {doctor["id"]} is already indexed. Use update_document instead.")
+        self.__set_document(doctor, tokens)
+
+    def update_document(self, doctor: dict, tokens: list[str] = None) -> None:
+        if doctor["id"] not in self.doc_hashes:
+            raise KeyError(f"Doctor {doctor["id"]} is not indexed. Use add_document instead.")
+        self.__set_document(doctor, tokens)
+
+    def remove_document(self, doc_id: str) -> None:
+        if doc_id not in self.doc_hashes:
+            raise KeyError(f"Doctor {doc_id} is not indexed.")
+        self.__pending_changes[doc_id] = None
+        del self.doc_hashes[doc_id]
+
+    def sync(self, drs_docs: DocStore | list[dict]) -> dict[str, int]:
+        # Only doctors whose content hash differs from the indexed one are re-tokenized, and only their postings
+        # are replaced (see __apply_changes)
+        if isinstance(drs_docs, DocStore):
+            self.doc_store = drs_docs
+        ids, hashes = ids_and_hashes(drs_docs)
+        new_hashes = dict(zip(ids, hashes))
+        changes = {"added": 0, "updated": 0, "removed": 0}
+        for doc_id in [doc_id for doc_id in self.doc_hashes if doc_id not in new_hashes]:
+            self.remove_document(doc_id)
+            changes["removed"] += 1
+        changed = [drs_docs[row] for row, doc_id in enumerate(ids) if self.doc_hashes.get(doc_id) != hashes[row]]
+        for doctor, tokens in self.__tokenize_batch(changed):
+            if doctor["id"] in self.doc_hashes:
+                self.update_document(doctor, tokens)
+                changes["updated"] += 1
+            else:
+                self.add_document(doctor, tokens)
+                changes["added"] += 1
+        self.__ensure_frozen()
+        return changes
+
+    def __tokenize_batch(self, doctors: list[dict]) -> list[tuple[dict, list[str]]]:
+        tokenizer = get_tokenizer()
+        pairs = []
+        for start in range(0, len(doctors), TOKENIZE_BATCH_SIZE):
+            batch = doctors[start:start + TOKENIZE_BATCH_SIZE]
+            pairs.extend(zip(batch, tokenizer.tokenize_many([doctor_text(doctor) for doctor in batch], self.word_lemmas)))
+        return pairs
+
+    def __set_document(self, doctor: dict, tokens: list[str] = None) -> None:
+        if tokens is None:
+            tokens = get_tokenizer().tokenize_many([doctor_text(doctor)], self.word_lemmas)[0]
+        self.__pending_changes[doctor["id"]] = Counter(tokens)
+        self.doc_hashes[doctor["id"]] = doctor_hash(doctor)
+
+    def __ensure_frozen(self) -> None:
+        if self.__pending_changes:
+            self.__apply_changes(self.__pending_changes)
+            self.__pending_changes = {}
+
+    def __apply_changes(self, changes: dict[str, Counter[str] | None]) -> None:
+        # Patches the flat arrays instead of rebuilding them: the postings of removed and edited doctors are
+        # dropped, the new postings are merged in at their sorted positions, and the BM25 weights are recomputed
+        # in one vectorized pass since N, avgdl and df change with every edit. Python work is proportional to the
+        # changed doctors (plus the vocabulary when a term disappears), the rest are NumPy passes over the arrays.
+        self.__store_rows = None
+        old_count = len(self.doc_ids)
+        touched = np.zeros(old_count, dtype=bool)
+        touched[[self.doc_rows[doc_id] for doc_id in changes if doc_id in self.doc_rows]] = True
+        kept_rows = np.ones(old_count, dtype=bool)
+        kept_rows[[self.doc_rows[doc_id] for doc_id, counts in changes.items() if counts is None and doc_id in self.doc_rows]] = False
+        row_map = np.cumsum(kept_rows) - 1 # Old doc rows to new ones: removed doctors leave, the others keep their order
+        if not kept_rows.all():
+            self.doc_ids = [doc_id for doc_id, kept in zip(self.doc_ids, kept_rows.tolist()) if kept]
+            self.doc_rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+        added = [doc_id for doc_id, counts in changes.items() if counts is not None and doc_id not in self.doc_rows]
+        for doc_id in added:
+            self.doc_rows[doc_id] = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+        doc_lengths = np.concatenate((self.doc_lengths[kept_rows], np.zeros(len(added), dtype=np.int32)))
+
+        # Unchanged postings, still sorted by (term, row) since the row renumbering keeps the order
+        posting_terms = np.repeat(np.arange(len(self.terms), dtype=np.int64), np.diff(self.term_offsets))
+        kept = ~touched[self.posting_docs]
+        terms, docs, tfs = posting_terms[kept], row_map[self.posting_docs[kept]], self.posting_tfs[kept]
+
+        # Postings of the added and edited doctors; unseen tokens get new term ids after the existing ones
+        new_tokens = sorted({token for counts in changes.values() if counts is not None for token in counts if token not in self.terms})
+        for token in new_tokens:
+            self.terms[token] = len(self.terms)
+        new_terms, new_docs, new_tfs = [], [], []
+        for doc_id, counts in changes.items():
+            if counts is None:
+                continue
+            row = self.doc_rows[doc_id]
+            doc_lengths[row] = sum(counts.values())
+            for token, tf in counts.items():
+                new_terms.append(self.terms[token])
+                new_docs.append(row)
+                new_tfs.append(tf)
+        new_terms, new_docs, new_tfs = np.array(new_terms, dtype=np.int64), np.array(new_docs, dtype=np.int64), np.array(new_tfs, dtype=np.int32)
+        order = np.lexsort((new_docs, new_terms))
+        new_terms, new_docs, new_tfs = new_terms[order], new_docs[order], new_tfs[order]
+
+        document_frequencies = np.bincount(terms, minlength=len(self.terms)) + np.bincount(new_terms, minlength=len(self.terms))
+        if not document_frequencies.all():
+            # Terms no doctor uses anymore are dropped, the others keep their relative order
+            alive = document_frequencies > 0
+            term_map = np.cumsum(alive) - 1
+            self.terms = {token: int(term_map[term_id]) for token, term_id in self.terms.items() if alive[term_id]}
+            terms, new_terms = term_map[terms], term_map[new_terms]
+            document_frequencies = document_frequencies[alive]
+
+        # Both sides are sorted by (term, row) and never share a key, so inserting at the searchsorted positions merges them
+        doc_count = len(self.doc_ids)
+        positions = np.searchsorted(terms * doc_count + docs, new_terms * doc_count + new_docs)
+        self.posting_docs = np.insert(docs, positions, new_docs).astype(np.int32)
+        self.posting_tfs = np.insert(tfs, positions, new_tfs).astype(np.int32)
+        self.term_offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        self.term_offsets[1:] = np.cumsum(document_frequencies)
+        self.doc_lengths = doc_lengths
+        self.__compute_bm25_weights(self.k1, self.b)
+
+    def assemble(self, tokens: list[str], doc_ids: list[str], doc_hashes: list[str], posting_terms: np.ndarray, posting_docs: np.ndarray,
+                 posting_tfs: np.ndarray, doc_lengths: np.ndarray) -> None:
+        # Replaces the whole index with postings already sorted by (term id, doc row), term ids being positions in `tokens`
+        doc_rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+        if len(doc_rows) != len(doc_ids):
+            doc_id, _ = Counter(doc_ids).most_common(1)[0]
+            raise ValueError(f"Doctor {doc_id} appears more than once.")
+        self.terms = {token: term_id for term_id, token in enumerate(tokens)}
+        self.doc_ids, self.doc_rows = doc_ids, doc_rows
+        self.doc_hashes = dict(zip(doc_ids, doc_hashes))
+        self.__pending_changes = {}
+        self.__store_rows = None
+        self.term_offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        self.term_offsets[1:] = np.cumsum(np.bincount(posting_terms, minlength=len(tokens)))
+        self.posting_docs = posting_docs.astype(np.int32)
+        self.posting_tfs = posting_tfs.astype(np.int32)
+        self.doc_lengths = doc_lengths.astype(np.int32)
+        self.__compute_bm25_weights(self.k1, self.b)
+
+    def __compute_bm25_weights(self, k1: float, b: float) -> None:
+        # Every (term, doc) score only depends on corpus statistics, so it is computed once here instead of per query
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = self.__get_avg_doc_length()
+        document_frequencies = np.diff(self.term_offsets)
+        total_doctors = len(self.doc_ids)
+        bm25_idf = np.log((total_doctors - document_frequencies + 0.5) / (document_frequencies + 0.5) + 1)
+        tf = self.posting_tfs.astype(np.float64)
+        length_norm = 1 - b + b * (self.doc_lengths[self.posting_docs] / self.avg_doc_length) if len(tf) else 0.0
+        bm25_tf = (tf * (k1 + 1)) / (tf + k1 * length_norm)
+        self.posting_weights = (bm25_tf * np.repeat(bm25_idf, document_frequencies)).astype(np.float32)
+        if len(self.terms):
+            self.term_max_weights = np.maximum.reduceat(self.posting_weights, self.term_offsets[:-1])
+        else:
+            self.term_max_weights = np.empty(0, dtype=np.float32)
 
     def save(self) -> None:
-        if not os.path.isdir(cache_path):
-            os.mkdir(cache_path)
-        
+        self.__ensure_frozen()
         try:
-            with open(self.index_path, "wb") as f:
-                pickle.dump(self.index, f)
-            
-            with open(self.docmap_path, "wb") as f:
-                pickle.dump(self.docmap, f)
-
-            with open(self.term_frequencies_path, "wb") as f:
-                pickle.dump(self.term_frequencies, f)
-
-            with open(self.doc_lengths_path, "wb") as f:
-                pickle.dump(self.doc_lengths, f)
+            metadata = {
+                "k1": self.k1,
+                "b": self.b,
+                "terms": list(self.terms),
+                "doc_ids": self.doc_ids,
+                "doc_hashes": [self.doc_hashes[doc_id] for doc_id in self.doc_ids],
+                "word_lemmas": self.word_lemmas,
+            }
+            arrays = {
+                "term_offsets": self.term_offsets,
+                "posting_docs": self.posting_docs,
+                "posting_tfs": self.posting_tfs,
+                "posting_weights": self.posting_weights,
+                "term_max_weights": self.term_max_weights,
+                "doc_lengths": self.doc_lengths,
+            }
+            write_array_file(self.index_path, INDEX_FORMAT_VERSION, metadata, arrays)
 
             print(f"Successfully cached hospital data")
 
@@ -53,98 +245,256 @@ class InvertedIndex:
 
     def load(self) -> None:
         try:           
-            with open(self.index_path, "rb") as f:
-                self.index = pickle.load(f)
-
-            with open(self.docmap_path, "rb") as f:
-                self.docmap = pickle.load(f)
-
-            with open(self.term_frequencies_path, "rb") as f:
-                self.term_frequencies = pickle.load(f)
-
-            with open(self.doc_lengths_path, "rb") as f:
-                self.doc_lengths = pickle.load(f)
+            metadata, arrays = read_array_file(self.index_path, INDEX_FORMAT_VERSION)
+            self.k1, self.b = metadata["k1"], metadata["b"]
+            self.terms = {token: term_id for term_id, token in enumerate(metadata["terms"])}
+            self.doc_ids = metadata["doc_ids"]
+            self.doc_rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+            self.__store_rows = None
+            self.doc_hashes = dict(zip(self.doc_ids, metadata["doc_hashes"]))
+            self.word_lemmas = metadata["word_lemmas"]
+            self.__pending_changes = {}
+            self.term_offsets = arrays["term_offsets"]
+            self.posting_docs = arrays["posting_docs"]
+            self.posting_tfs = arrays["posting_tfs"]
+            self.posting_weights = arrays["posting_weights"]
+            self.term_max_weights = arrays["term_max_weights"]
+            self.doc_lengths = arrays["doc_lengths"]
+            self.avg_doc_length = self.__get_avg_doc_length()
             
             print(f"Successfully loaded hospital data")
 
         except Exception as e:
             print(f"Error loading hospital data: {e}")
 
-    def __add_document(self, doc_id: int, text: str) -> None:
-        tokens = tokenization(text)
-        self.doc_lengths[doc_id] = len(tokens)
-        for token in tokens:
-            self.index[token].add(doc_id)
-            self.term_frequencies[doc_id][token] += 1
+    def get_doc_store(self) -> DocStore:
+        if self.doc_store is None:
+            self.doc_store = open_doc_store()
+        return self.doc_store
+
+    def get_doc(self, doc_id: str) -> DoctorRecord:
+        return self.get_doc_store().get(doc_id)
+
+    def __store_row_map(self) -> np.ndarray:
+        # Doc rows to doctor store rows (-1 for a doctor missing from the store)
+        return self.__cached_store_rows()[1]
+
+    def __tie_keys(self) -> np.ndarray:
+        # Equal scores are ranked in doctor store order, like a fresh build, whatever order sync left the doc rows in.
+        # Doctors missing from the store come last.
+        return self.__cached_store_rows()[2]
+
+    def __cached_store_rows(self) -> tuple[DocStore, np.ndarray, np.ndarray]:
+        self.__ensure_frozen()
+        store = self.get_doc_store()
+        if self.__store_rows is None or self.__store_rows[0] is not store:
+            store_rows = {doc_id: row for row, doc_id in enumerate(store.ids())}
+            rows = np.array([store_rows.get(doc_id, -1) for doc_id in self.doc_ids], dtype=np.int64)
+            tie_keys = np.where(rows >= 0, rows, len(store) + np.arange(len(rows)))
+            self.__store_rows = (store, rows, tie_keys)
+        return self.__store_rows
+
+    def __rows_mask(self, mask: np.ndarray) -> np.ndarray:
+        # Maps a mask over doctor store rows onto this index's doc rows
+        rows = self.__store_row_map()
+        return (rows >= 0) & mask[rows]
+
+    def __postings(self, token: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        self.__ensure_frozen()
+        term_id = self.terms.get(token)
+        if term_id is None:
+            return self.posting_docs[:0], self.posting_tfs[:0], self.posting_weights[:0]
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.posting_docs[start:end], self.posting_tfs[start:end], self.posting_weights[start:end]
+
+    def __find_posting(self, doc_id: str, token: str) -> int | None:
+        self.__ensure_frozen()
+        term_id = self.terms.get(token)
+        row = self.doc_rows.get(doc_id)
+        if term_id is None or row is None:
+            return None
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        position = start + np.searchsorted(self.posting_docs[start:end], row)
+        return position if position < end and self.posting_docs[position] == row else None
         
     def __get_avg_doc_length(self) -> float:
         if len(self.doc_lengths) == 0:
             return 0.0
-        length_sum = sum(self.doc_lengths.values())
-        avg_doc_length = length_sum / len(self.doc_lengths)
-        return avg_doc_length
+        return float(self.doc_lengths.mean())
 
     def get_document(self, term: str) -> list[int]:
-        ids_of_term = sorted(self.index[term])
+        docs, _, _ = self.__postings(term)
+        ids_of_term = sorted(self.doc_ids[row] for row in docs)
         return ids_of_term
 
     def get_tf(self, doc_id: str, term: int) -> int:
         token = check_single_term(term)
-        return self.term_frequencies[doc_id][token]
+        position = self.__find_posting(doc_id, token)
+        return 0 if position is None else int(self.posting_tfs[position])
     
     def get_idf(self, term: str) -> float:
         token = check_single_term(term)
-        total_doctors = len(self.docmap)
-        term_match_doctors = len(self.index[token])
+        total_doctors = len(self.doc_ids)
+        term_match_doctors = len(self.__postings(token)[0])
         return math.log((total_doctors + 1) / (term_match_doctors + 1))
     
     def get_bm25_idf(self, term: str) -> float:
         token = check_single_term(term)
-        total_doctors = len(self.docmap)
-        term_match_doctors = len(self.index[token])
+        total_doctors = len(self.doc_ids)
+        term_match_doctors = len(self.__postings(token)[0])
         return math.log((total_doctors - term_match_doctors + 0.5) / (term_match_doctors + 0.5) + 1)
     
     def get_bm25_tf(self, doc_id: str, term: str, k1: float = BM25_K1, b: float = BM25_B) -> float:
-        tf = self.get_tf(doc_id, term)
-        avg_doc_length = self.__get_avg_doc_length()
-        doc_length = self.doc_lengths[doc_id]
-        lenght_norm = 1 - b + b * (doc_length / avg_doc_length)
+        tf = self.get_tf(doc_id, term) # Also applies any pending document changes
+        doc_length = self.doc_lengths[self.doc_rows[doc_id]]
+        lenght_norm = 1 - b + b * (doc_length / self.avg_doc_length)
         bm25_tf = (tf * (k1 + 1)) / (tf + k1 * lenght_norm)
         return bm25_tf
 
     def get_bm25(self, doc_id: str, term: str) -> float:
-        bm25_tf = self.get_bm25_tf(doc_id, term)
-        bm25_idf = self.get_bm25_idf(term)
-        return bm25_tf * bm25_idf
+        token = check_single_term(term)
+        position = self.__find_posting(doc_id, token)
+        return 0.0 if position is None else float(self.posting_weights[position])
     
-    def bm25_search(self, query: str, limit: int) -> list[dict]:
-        tokens = tokenization(query)
-        scores = defaultdict(float)
-        for token in tokens:
-            if token in self.index:
-                for doc_id in self.index[token]:
-                    bm25_score = self.get_bm25(doc_id, token)
-                    scores[doc_id] += bm25_score
-        scores_limited = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+    def query_terms(self, query: str) -> Counter[str]:
+        return Counter(get_tokenizer().tokenize_query(query, self.word_lemmas))
+
+    def bm25_search(self, query: str, limit: int, mask: np.ndarray = None) -> list[dict]:
+        allowed = self.__rows_mask(mask) if mask is not None else None
         results = []
-        for doc_id, score in scores_limited:
+        for row, score in self.__max_score_top_k(self.query_terms(query), limit, allowed):
             formatted_result = {
-                "doc": self.docmap[doc_id],
+                "doc": self.get_doc(self.doc_ids[row]),
                 "score": score
             }
             results.append(formatted_result)
         return results
 
+    def bm25_top_k(self, query: str, limit: int, mask: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        # Doctor store rows and scores of the best matches, without building result dicts
+        allowed = self.__rows_mask(mask) if mask is not None else None
+        top = self.__max_score_top_k(self.query_terms(query), limit, allowed)
+        rows = np.array([row for row, _ in top], dtype=np.int64)
+        return self.__store_row_map()[rows], np.array([score for _, score in top], dtype=np.float64)
+
+    def __max_score_top_k(self, query_terms: Counter[str], limit: int, allowed: np.ndarray = None) -> list[tuple[int, float]]:
+        self.__ensure_frozen()
+        # MaxScore: terms are ordered by their score upper bound. Once the k-th best score beats the summed bounds
+        # of the weakest terms, those terms can no longer produce a new top-k document on their own, so only the
+        # remaining "essential" lists are walked and the weak lists are only probed for candidates that can still make it.
+        # Doc rows are scored a window at a time on NumPy slices of the postings: the essential postings of the window
+        # are added up at once, and the weak lists are searched (np.searchsorted) only at the candidates worth probing,
+        # so a common term's long list is never read in full once a threshold exists.
+        terms = []
+        for token, count in query_terms.items():
+            term_id = self.terms.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            terms.append((float(self.term_max_weights[term_id]) * count, self.posting_docs[start:end], self.posting_weights[start:end], count))
+        if not terms or limit <= 0:
+            return []
+        terms.sort(key=lambda term: term[0])
+        upper_bounds = list(accumulate(term[0] for term in terms))
+        pointers = [0] * len(terms)
+        tie_keys = self.__tie_keys()
+        top_rows, top_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        threshold = -math.inf
+        first_essential = 0
+        window = MAXSCORE_FIRST_WINDOW
+
+        while True:
+            heads = [int(terms[i][1][pointers[i]]) for i in range(first_essential, len(terms)) if pointers[i] < len(terms[i][1])]
+            if not heads:
+                break
+            window_start = min(heads)
+            window_end = window_start + window
+            window = min(window * 2, MAXSCORE_MAX_WINDOW)
+            scores = np.zeros(window_end - window_start)
+            hits = np.zeros(window_end - window_start, dtype=bool)
+            for i in range(first_essential, len(terms)):
+                _, docs, weights, count = terms[i]
+                stop = pointers[i] + int(np.searchsorted(docs[pointers[i]:], window_end))
+                offsets = docs[pointers[i]:stop] - window_start
+                scores[offsets] += weights[pointers[i]:stop].astype(np.float64) * count
+                hits[offsets] = True
+                pointers[i] = stop
+            rows = np.flatnonzero(hits)
+            scores = scores[rows]
+            rows += window_start
+            if allowed is not None:
+                keep = allowed[rows]
+                rows, scores = rows[keep], scores[keep]
+            for i in range(first_essential - 1, -1, -1):
+                # A candidate that can still tie the threshold is probed too, it may win on its tie key
+                probe = np.flatnonzero(scores + upper_bounds[i] >= threshold)
+                if not len(probe):
+                    break
+                _, docs, weights, count = terms[i]
+                docs = docs[np.searchsorted(docs, window_start):]
+                weights = weights[len(weights) - len(docs):]
+                positions = np.minimum(np.searchsorted(docs, rows[probe]), max(len(docs) - 1, 0))
+                found = docs[positions] == rows[probe] if len(docs) else np.zeros(len(probe), dtype=bool)
+                scores[probe[found]] += weights[positions[found]].astype(np.float64) * count
+
+            keep = scores >= threshold
+            rows = np.concatenate((top_rows, rows[keep]))
+            scores = np.concatenate((top_scores, scores[keep]))
+            best = np.lexsort((tie_keys[rows], -scores))[:limit]
+            top_rows, top_scores = rows[best], scores[best]
+            if len(top_rows) == limit:
+                threshold = float(top_scores[-1])
+                while first_essential < len(terms) and upper_bounds[first_essential] < threshold:
+                    first_essential += 1
+
+        return list(zip(top_rows.tolist(), top_scores.tolist()))
+
+
+def _load_inverted_index(drs_docs: DocStore, snapshot: Snapshot | None) -> InvertedIndex:
+    idx = InvertedIndex()
+    if snapshot is not None:
+        # Snapshots are immutable and consistent with their doctor store, so there is nothing to sync
+        idx.index_path = snapshot.file("keyword_index")
+        idx.load()
+        idx.doc_store = drs_docs
+        return idx
+    idx.load()
+    if any(idx.sync(drs_docs).values()):
+        idx.save()
+    return idx
 
-def build_command() -> None:
+
+def get_inverted_index() -> InvertedIndex:
+    return get_engine("keyword", _load_inverted_index, [InvertedIndex().index_path])
+
+
+def build_command(k1: float = BM25_K1, b: float = BM25_B) -> None:
     idx = InvertedIndex()
-    idx.build()
+    idx.build(k1, b)
     idx.save()
+    build_spell_index(idx, idx.doc_store)
+    from lib.index_builder import republish_snapshot # index_builder imports this module
+    republish_snapshot()
 
 
-def search_command(query: str, limit: int) -> list[str]:
+def sync_command() -> dict[str, int]:
     idx = InvertedIndex()
     idx.load()
+    drs_docs = open_doc_store()
+    changes = idx.sync(drs_docs)
+    if any(changes.values()):
+        idx.save()
+    if any(changes.values()) or not os.path.exists(spell_index_path):
+        build_spell_index(idx, drs_docs)
+    if any(changes.values()):
+        from lib.index_builder import republish_snapshot # index_builder imports this module
+        republish_snapshot()
+    return changes
+
+
+@served
+def search_command(query: str, limit: int) -> list[str]:
+    idx = get_inverted_index()
     query_tokens = tokenization(query)
     doc_ids = []
     results = []
@@ -152,77 +502,102 @@ def search_command(query: str, limit: int) -> list[str]:
         doc_ids.extend(idx.get_document(q_token))
         if len(doc_ids) >= limit:
             for doc_id in doc_ids[:limit]:
-                doctor_info = idx.docmap[doc_id]
+                doctor_info = idx.get_doc(doc_id)
                 results.append(f"Name: {doctor_info["name"]}. ID: {doc_id}")
             break
     return results
 
 
+@served
 def tf_command(doc_id: str, term: str) -> int:
-    idx = InvertedIndex()
-    idx.load()
+    idx = get_inverted_index()
     return idx.get_tf(doc_id, term)
 
 
+@served
 def idf_command(term: str) -> float:
-    idx = InvertedIndex()
-    idx.load()
+    idx = get_inverted_index()
     return idx.get_idf(term)
 
 
+@served
 def tfidf_command(doc_id: str, term: str) -> float:
-    idx = InvertedIndex()
-    idx.load()
+    idx = get_inverted_index()
     tf = idx.get_tf(doc_id, term)
     idf = idx.get_idf(term)
     return tf * idf
 
 
+@served
 def bm25idf_command(term: str) -> float:
-    idx = InvertedIndex()
-    idx.load()
+    idx = get_inverted_index()
     return idx.get_bm25_idf(term)
 
 
+@served
 def bm25tf_command(doc_id: str, term: str, k1: float, b: float) -> float:
-    idx = InvertedIndex()
-    idx.load()
+    idx = get_inverted_index()
     return idx.get_bm25_tf(doc_id, term, k1, b)
 
 
-def bm25_search_command(query: str, limit: int) -> list[str]:
-    idx = InvertedIndex()
-    idx.load()
-    results = idx.bm25_search(query, limit)
+@served
+def bm25_search_command(query: str, limit: int, filters: dict = None) -> list[str]:
+    idx = get_inverted_index()
+    results = idx.bm25_search(query, limit, resolve_filters(idx.get_doc_store(), filters))
     return [(f"{i}. {result['doc']['id']} {result['doc']['name']} - Score: {result['score']:.4f}") for i, result in enumerate(results, start=1)]
 
 
 def tokenization(text: str) -> list[str]:
-    lowered_text = text.lower()
-    table = str.maketrans("", "", string.punctuation)
-    normalized_text = lowered_text.translate(table)
-    words = normalized_text.split()
-    stopwords = set(get_stopwords())
-
-    tagged_words = pos_tag(words)
-    
-    tokens = [lemmatizer.lemmatize(word, get_wordnet_pos(pos)) for word, pos in tagged_words if word and word not in stopwords]
-    return tokens
-
-
-def get_wordnet_pos(treebank_tag: str) -> str:
-    if treebank_tag.startswith('J'):
-        return wordnet.ADJ
-    elif treebank_tag.startswith('V'):
-        return wordnet.VERB
-    elif treebank_tag.startswith('N'):
-        return wordnet.NOUN
-    elif treebank_tag.startswith('R'):
-        return wordnet.ADV
-    else:
-        return wordnet.NOUN
+    return get_tokenizer().tokenize(text)
     
 
+class InvertedIndexWriter:
+    # Builds an index one batch of doctors at a time: each batch's postings (provisional term ids, doc rows, term
+    # frequencies), doc lengths and ids with content hashes are appended to spill files, so only the vocabulary and
+    # the word lemmas are held in memory. finish() renumbers the terms in sorted order like a fresh build, sorts the
+    # postings and hands them to the index.
+    def __init__(self, idx: InvertedIndex) -> None:
+        self.idx = idx
+        self.spill_path = idx.index_path + ".postings"
+        shutil.rmtree(self.spill_path, ignore_errors=True)
+        os.makedirs(self.spill_path)
+        self.files = {name: open(os.path.join(self.spill_path, name), "wb") for name in ("terms", "docs", "tfs", "lengths", "ids")}
+        self.tokens: dict[str, int] = {} # Tokens to provisional term ids, in order of first use
+        self.count = 0
+
+    def add_many(self, doctors: list[dict], token_lists: list[list[str]]) -> None:
+        terms, docs, tfs = [], [], []
+        for row, tokens in enumerate(token_lists, self.count):
+            for token, tf in Counter(tokens).items():
+                terms.append(self.tokens.setdefault(token, len(self.tokens)))
+                docs.append(row)
+                tfs.append(tf)
+        np.array(terms, dtype=np.int64).tofile(self.files["terms"])
+        np.array(docs, dtype=np.int32).tofile(self.files["docs"])
+        np.array(tfs, dtype=np.int32).tofile(self.files["tfs"])
+        np.array([len(tokens) for tokens in token_lists], dtype=np.int32).tofile(self.files["lengths"])
+        self.files["ids"].write("".join(json.dumps([doctor["id"], doctor_hash(doctor)]) + "\n" for doctor in doctors).encode("utf-8"))
+        self.count += len(doctors)
+
+    def __column(self, name: str, dtype: type) -> np.ndarray:
+        return np.fromfile(os.path.join(self.spill_path, name), dtype=dtype)
+
+    def finish(self) -> InvertedIndex:
+        for f in self.files.values():
+            f.close()
+        tokens = sorted(self.tokens)
+        term_map = np.empty(len(tokens), dtype=np.int64)
+        term_map[[self.tokens[token] for token in tokens]] = np.arange(len(tokens))
+        posting_terms, posting_docs = term_map[self.__column("terms", np.int64)], self.__column("docs", np.int32)
+        order = np.lexsort((posting_docs, posting_terms))
+        with open(os.path.join(self.spill_path, "ids"), "r") as f:
+            entries = [json.loads(line) for line in f]
+        self.idx.assemble(tokens, [doc_id for doc_id, _ in entries], [content_hash for _, content_hash in entries],
+                          posting_terms[order], posting_docs[order], self.__column("tfs", np.int32)[order], self.__column("lengths", np.int32))
+        shutil.rmtree(self.spill_path)
+        return self.idx
+
+
 def check_single_term(term: str) -> str:
     tokens = tokenization(term)
     if len(tokens) != 1:
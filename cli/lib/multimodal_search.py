@@ -2,13 +2,13 @@ import os
 import numpy as np
 from PIL import Image
 from sentence_transformers import SentenceTransformer
-from .search_utils import cosine_similarity, load_doctors, DEFAULT_SEARCH_LIMIT
+from .search_utils import cosine_similarity, load_doctors, doctor_text, DEFAULT_SEARCH_LIMIT
 
 class MultimodalSearch():
     def __init__(self, drs_docs: list[dict], model_name="clip-ViT-B-32"):
         self.model = SentenceTransformer(model_name)
         self.drs_docs = drs_docs
-        self.text = [f"{dr["name"]}. {dr["age"]}. {dr["specialty"]}. {dr["bio"]}. {dr["availability"]}" for dr in drs_docs]
+        self.text = [doctor_text(dr) for dr in drs_docs]
         self.text_embeddings = self.model.encode(self.text, show_progress_bar=True)
 
     def search_with_image(self, img_path: str) -> list[dict]:
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+from .search_utils import QUANTIZED_RESCORE_FACTOR, normalize_rows, top_k_indices
+
+QUANTIZATION_MODES = ["float16", "int8", "binary"]
+SCAN_CHUNK_SIZE = 65536
+
+
+class QuantizedEmbeddings:
+    # Compressed copy of the embeddings used for a first-pass scan. Only the shortlist it returns
+    # is re-scored against the full precision vectors, which can stay memory-mapped on disk.
+    def __init__(self, mode: str) -> None:
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode '{mode}'. Choose one of: {', '.join(QUANTIZATION_MODES)}")
+        self.mode = mode
+        self.codes = None
+        self.scale = None
+        self.offset = None
+        self.manifest_hash = None # Digest of the embeddings manifest the codes were built from (see SemanticSearch.manifest_digest)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.codes, self.scale, self.offset) if array is not None)
+
+    def build(self, embeddings: np.ndarray) -> None:
+        match self.mode:
+            case "float16":
+                self.codes = normalize_rows(embeddings).astype(np.float16)
+            case "int8":
+                normalized = normalize_rows(embeddings)
+                self.offset = normalized.min(axis=0)
+                self.scale = (normalized.max(axis=0) - self.offset) / 255
+                self.scale[self.scale == 0] = 1.0
+                self.codes = (np.round((normalized - self.offset) / self.scale) - 128).astype(np.int8)
+            case "binary":
+                self.codes = np.packbits(np.asarray(embeddings) > 0, axis=1)
+
+    def scan(self, q_embedding: np.ndarray, shortlist: int) -> np.ndarray:
+        approximate_scores = np.empty(len(self.codes), dtype=np.float32)
+        if self.mode == "binary":
+            q_bits = np.packbits(q_embedding > 0)
+        elif self.mode == "int8":
+            q_scaled = q_embedding * self.scale
+            q_bias = 128 * q_scaled.sum() + q_embedding @ self.offset
+        for start in range(0, len(self.codes), SCAN_CHUNK_SIZE):
+            chunk = self.codes[start:start + SCAN_CHUNK_SIZE]
+            match self.mode:
+                case "float16":
+                    chunk_scores = chunk.astype(np.float32) @ q_embedding
+                case "int8":
+                    chunk_scores = chunk.astype(np.float32) @ q_scaled + q_bias
+                case "binary":
+                    chunk_scores = -np.bitwise_count(chunk ^ q_bits).sum(axis=1, dtype=np.int32)
+            approximate_scores[start:start + len(chunk)] = chunk_scores
+        return top_k_indices(approximate_scores, shortlist)
+
+    def search(self, q_embedding: np.ndarray, embeddings: np.ndarray, limit: int, shortlist: int = None) -> tuple[np.ndarray, np.ndarray]:
+        candidates = np.sort(self.scan(q_embedding, shortlist or limit * QUANTIZED_RESCORE_FACTOR))
+        scores = normalize_rows(np.asarray(embeddings[candidates], dtype=np.float32)) @ q_embedding
+        best = top_k_indices(scores, limit)
+        return candidates[best], scores[best]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {"codes": self.codes, "manifest_hash": self.manifest_hash or ""}
+        if self.mode == "int8":
+            arrays.update(scale=self.scale, offset=self.offset)
+        np.savez(path, **arrays)
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The quantized embeddings were not found at: {path}. Run `quantize --mode {self.mode}` first.")
+        with np.load(path) as data:
+            self.codes = data["codes"]
+            self.manifest_hash = (str(data["manifest_hash"]) or None) if "manifest_hash" in data.files else None
+            if self.mode == "int8":
+                self.scale = data["scale"]
+                self.offset = data["offset"]
+
+    def matches(self, rows: int, manifest_hash: str | None) -> bool:
+        # Codes are per embedding row, only valid for the exact rows they were built from
+        return self.codes is not None and len(self.codes) == rows and self.manifest_hash == manifest_hash
@@ -1,12 +1,6 @@
-import os
-from dotenv import load_dotenv
-from google import genai
-
-load_dotenv()
-api_key = os.environ.get("GEMINI_API_KEY")
-if not api_key:
-    raise RuntimeError("GEMINI_API_KEY environment variable not set")
-client = genai.Client(api_key=api_key)
+from .gemini import get_client
+from .spell import spell_correct_local
+from .expansion import expand_local
 
 
 def spell_correct(query: str) -> str:
@@ -18,7 +12,7 @@ def spell_correct(query: str) -> str:
             User query: "{query}"
             """
     
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     corrected = (response.text or "").strip().strip('"')
     return corrected if corrected else query
@@ -46,7 +40,7 @@ def rewrite(query: str) -> str:
             User query: "{query}"
             """
     
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     rewrote = (response.text or "").strip().strip('"')
     return rewrote if rewrote else query
@@ -70,7 +64,7 @@ def expansion(query: str) -> str:
             User query: "{query}"
             """
     
-    response = client.models.generate_content(
+    response = get_client().models.generate_content(
     model='gemma-3-27b-it', contents=prompt)
     expanded = (response.text or "").strip().strip('"')
     return expanded if expanded else query 
@@ -79,9 +73,13 @@ def enhance_query(query: str, method: str=None):
     match method:
         case "spell":
             return spell_correct(query)
+        case "spell-local":
+            return spell_correct_local(query)
         case "rewrite":
             return rewrite(query)
         case "expand":
             return expansion(query)
+        case "expand-local":
+            return expand_local(query)
         case _:
             return query
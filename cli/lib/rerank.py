@@ -1,13 +1,12 @@
-import os, time, json, torch
-from dotenv import load_dotenv
-from google import genai
-from sentence_transformers import CrossEncoder
-
-load_dotenv()
-api_key = os.environ.get("GEMINI_API_KEY")
-if not api_key:
-    raise RuntimeError("GEMINI_API_KEY environment variable not set")
-client = genai.Client(api_key=api_key)
+import time, json
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .gemini import get_client
+from .search_utils import doctor_hash, RERANK_BATCH_SIZE, RERANK_PROCESSES, RERANK_POOL_MIN_PAIRS, RERANK_CACHE_SIZE
+from .doc_store import DoctorRecord
 
 def individual_rerank(results: list[dict], query: str) -> list[dict]:
     for result in results:
@@ -28,7 +27,7 @@ def individual_rerank(results: list[dict], query: str) -> list[dict]:
 
                 Score:
                 """
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
         model='gemma-3-27b-it', contents=prompt)
         score = (response.text or "").strip().strip('"')
         time.sleep(3)
@@ -66,7 +65,7 @@ def batch_rerank(results: list[dict], query: str) -> list[dict]:
             ["DR502", "DR108", "DR334", "DR21", "DR9"]
 
             Ranking:"""
-        response = client.models.generate_content(
+        response = get_client().models.generate_content(
         model='gemma-3-27b-it', contents=prompt)
         if not response.text:
             print("Error: API returned an empty string!")
@@ -77,32 +76,142 @@ def batch_rerank(results: list[dict], query: str) -> list[dict]:
         return results
 
 
-def cross_encoder(results: list[dict], query: str) -> list[dict]:
-    cross_encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L6-v2")
-    pairs = []
-    for result in results:
-        document_text = (
-                            f"Doctor Name: {result['doc']['name']}. "
-                            f"Specialty: {result['doc']['specialty']}. "
-                            f"Professional Bio: {result['doc']['bio']}. "
-                            f"Age: {result['doc']['age']}. "
-                            f"Available hours: {result['doc']['availability']}."
-                        )
-        pairs.append([query, document_text])
-    scores = cross_encoder.predict(pairs)
-    for i, result in enumerate(results):
-        result["crossencoder_score"] = scores[i]
-    results = sorted(results, key=lambda result: result["crossencoder_score"], reverse=True)
-    return results
-
-def rerank_results(results: list[dict], query: str, method: str) -> list[dict]:
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L6-v2"
+
+
+def cross_encoder_text(doc: dict) -> str:
+    return (
+        f"Doctor Name: {doc['name']}. "
+        f"Specialty: {doc['specialty']}. "
+        f"Professional Bio: {doc['bio']}. "
+        f"Age: {doc['age']}. "
+        f"Available hours: {doc['availability']}."
+    )
+
+
+def _doc_hash(doc: dict) -> str:
+    # Store records carry the hash built at ingest, plain dicts (e.g. from the daemon) are hashed here
+    if isinstance(doc, DoctorRecord):
+        return doc.store.field(doc.row, "hash")
+    return doctor_hash(doc)
+
+
+_worker_model = None
+
+
+def _init_worker(name: str, threads: int) -> None:
+    # Runs once per pool process: each worker loads its own copy of the model and splits the CPU with the others
+    global _worker_model
+    import torch
+    from sentence_transformers import CrossEncoder
+    torch.set_num_threads(threads)
+    _worker_model = CrossEncoder(name)
+
+
+def _predict_in_worker(pairs: list[list[str]], batch_size: int) -> list[float]:
+    return [float(score) for score in _worker_model.predict(pairs, batch_size=batch_size)]
+
+
+class CrossEncoderReranker:
+    # Scores (query, doctor) pairs with a cross-encoder loaded once per process. Scores are cached per
+    # (query, doctor id, doctor hash), so a repeated query only runs the model for doctors it has not scored yet,
+    # and an edited doctor (new hash) is scored again. Large candidate sets can be split across a process pool.
+    def __init__(self, name: str = CROSS_ENCODER_MODEL, batch_size: int = RERANK_BATCH_SIZE, processes: int = RERANK_PROCESSES,
+                 cache_size: int = RERANK_CACHE_SIZE) -> None:
+        self.name = name
+        self.batch_size = batch_size
+        self.processes = processes
+        self.cache_size = cache_size
+        self.scores: OrderedDict[tuple[str, str, str], float] = OrderedDict()
+        self._model = None
+        self._pool = None
+        self.lock = threading.Lock() # Guards the score cache, held only for lookups and inserts
+        self.load_lock = threading.Lock()
+
+    @property
+    def model(self) -> "CrossEncoder":
+        with self.load_lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder # Deferred so that importing the search modules does not load torch
+                self._model = CrossEncoder(self.name)
+            return self._model
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self.load_lock:
+            if self._pool is None:
+                # spawn rather than fork: forking a process that already runs torch threads can deadlock
+                threads = max(1, (os.cpu_count() or 1) // self.processes)
+                self._pool = ProcessPoolExecutor(self.processes, multiprocessing.get_context("spawn"), _init_worker, (self.name, threads))
+            return self._pool
+
+    def predict(self, pairs: list[list[str]], stats: dict = None) -> list[float]:
+        # In this process, or in batch_size chunks spread over the pool when there are enough pairs to pay for it
+        stats = {} if stats is None else stats
+        if self.processes > 1 and len(pairs) >= RERANK_POOL_MIN_PAIRS:
+            chunks = [pairs[i:i + self.batch_size] for i in range(0, len(pairs), self.batch_size)]
+            stats["processes"] = min(self.processes, len(chunks))
+            return [score for scores in self.pool().map(_predict_in_worker, chunks, [self.batch_size] * len(chunks)) for score in scores]
+        stats["processes"] = 1
+        return [float(score) for score in self.model.predict(pairs, batch_size=self.batch_size)]
+
+    def score(self, query: str, docs: list[dict], stats: dict = None) -> list[float]:
+        # stats, when given, receives this call's pair counts, worker processes and time
+        started = time.perf_counter()
+        query_key = " ".join(query.split())
+        keys = [(query_key, doc["id"], _doc_hash(doc)) for doc in docs]
+        found = {}
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.scores:
+                    self.scores.move_to_end(key)
+                    found[key] = self.scores[key]
+                else:
+                    missing.setdefault(key, i)
+        stats = {} if stats is None else stats
+        stats.update({"pairs": len(keys), "cached": len(keys) - len(missing), "scored": len(missing), "processes": 0, "seconds": 0.0})
+        if missing:
+            # The model runs outside the lock, so concurrent searches only wait for each other on the cache
+            scores = self.predict([[query, cross_encoder_text(docs[i])] for i in missing.values()], stats)
+            with self.lock:
+                for key, score in zip(missing, scores):
+                    found[key] = self.scores[key] = score
+                while len(self.scores) > self.cache_size:
+                    self.scores.popitem(last=False)
+        stats["seconds"] = time.perf_counter() - started
+        return [found[key] for key in keys]
+
+    def rerank(self, results: list[dict], query: str, stats: dict = None) -> list[dict]:
+        scores = self.score(query, [result["doc"] for result in results], stats)
+        for result, score in zip(results, scores):
+            result["crossencoder_score"] = score
+        return sorted(results, key=lambda result: result["crossencoder_score"], reverse=True)
+
+
+_rerankers: dict[tuple[int, int], CrossEncoderReranker] = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(batch_size: int = RERANK_BATCH_SIZE, processes: int = RERANK_PROCESSES) -> CrossEncoderReranker:
+    # One per configuration, each keeping its model and score cache for the life of the process (or search daemon)
+    key = (batch_size, processes)
+    with _rerankers_lock:
+        if key not in _rerankers:
+            _rerankers[key] = CrossEncoderReranker(batch_size=batch_size, processes=processes)
+        return _rerankers[key]
+
+
+def cross_encoder(results: list[dict], query: str, batch_size: int = RERANK_BATCH_SIZE, processes: int = RERANK_PROCESSES, stats: dict = None) -> list[dict]:
+    return get_reranker(batch_size, processes).rerank(results, query, stats)
+
+def rerank_results(results: list[dict], query: str, method: str, batch_size: int = RERANK_BATCH_SIZE, processes: int = RERANK_PROCESSES, stats: dict = None) -> list[dict]:
     match method:
         case "individual":
             return individual_rerank(results, query)
         case "batch":
             return batch_rerank(results, query)
         case "cross_encoder":
-            return cross_encoder(results, query)
+            return cross_encoder(results, query, batch_size, processes, stats)
         case _:
             return results
         
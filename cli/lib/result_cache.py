@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from .search_utils import cache_path, RESULT_CACHE_SIZE, RESULT_CACHE_MAX_ROWS
+from .doc_store import source_fingerprint
+from .engines import get_doc_store, get_snapshot
+from .keyword_search import InvertedIndex
+from .semantic_search import SemanticSearch
+from .search_daemon import served, to_json
+
+RESULT_CACHE_FORMAT_VERSION = 1
+result_cache_path = os.path.join(cache_path, "result_cache.sqlite")
+PRUNE_EVERY = 64 # Stores between two trims of the on-disk cache to RESULT_CACHE_MAX_ROWS
+
+
+def index_version() -> str:
+    # Identifies the indexes the results come from: the published snapshot, or the working files when there is none.
+    # Any rebuild changes it, so entries from older indexes are never served.
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return f"{snapshot.name}-{snapshot.manifest['corpus_hash'][:16]}-{snapshot.manifest['created']}"
+    semantic_search = SemanticSearch()
+    paths = [InvertedIndex().index_path, semantic_search.embeddings_path, semantic_search.manifest_path]
+    state = [get_doc_store().source] + [source_fingerprint(path) if os.path.exists(path) else None for path in paths]
+    return "working-" + hashlib.sha256(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+class ResultCache:
+    # Two levels: an in-process LRU of serialized responses in front of a SQLite table shared by every process
+    # (CLIs and the search daemon). Responses are stored as JSON, so a hit returns a fresh copy the caller may mutate.
+    def __init__(self, path: str = result_cache_path, size: int = RESULT_CACHE_SIZE, max_rows: int = RESULT_CACHE_MAX_ROWS) -> None:
+        self.path = path
+        self.size = size
+        self.max_rows = max_rows
+        self.memory: OrderedDict[str, str] = OrderedDict()
+        self.version = None # Index version of the entries held in memory
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, version TEXT NOT NULL, created REAL NOT NULL, value TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def key(self, command: str, query: str, params: dict, version: str) -> str:
+        payload = {"format": RESULT_CACHE_FORMAT_VERSION, "command": command, "query": " ".join(query.split()).casefold(), "params": params, "version": version}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=to_json).encode("utf-8")).hexdigest()
+
+    def __count(self, name: str) -> None:
+        self.stats[name] += 1
+        self.db.execute("INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def __use_version(self, version: str) -> None:
+        # A new index version makes every older entry unreachable, so they are dropped
+        if version != self.version:
+            self.memory.clear()
+            self.db.execute("DELETE FROM results WHERE version != ?", (version,))
+            self.version = version
+
+    def get(self, key: str, version: str) -> tuple[dict | None, str]:
+        # The response and the level that answered: "memory", "disk" or "miss"
+        with self.lock:
+            self.__use_version(version)
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.__count("memory_hits")
+                return json.loads(value), "memory"
+            row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.__count("misses")
+                return None, "miss"
+            self.__remember(key, row[0])
+            self.__count("disk_hits")
+            return json.loads(row[0]), "disk"
+
+    def put(self, key: str, version: str, response: dict) -> None:
+        value = json.dumps(response, default=to_json)
+        with self.lock:
+            self.__use_version(version)
+            self.__remember(key, value)
+            self.db.execute("INSERT OR REPLACE INTO results (key, version, created, value) VALUES (?, ?, ?, ?)", (key, version, time.time(), value))
+            self.__count("stores")
+            if self.stats["stores"] % PRUNE_EVERY == 0:
+                self.db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_rows,))
+
+    def __remember(self, key: str, value: str) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def totals(self) -> dict[str, int]:
+        # Counters summed over every process that used the on-disk cache
+        with self.lock:
+            totals = {name: 0 for name in self.stats}
+            totals.update(dict(self.db.execute("SELECT name, value FROM counters")))
+            totals["entries"] = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            return totals
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+            self.db.execute("DELETE FROM results")
+            self.db.execute("DELETE FROM counters")
+            self.stats = {name: 0 for name in self.stats}
+
+
+_result_cache = None
+
+
+def get_result_cache() -> ResultCache:
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
+
+
+@served
+def result_cache_stats_command() -> dict[str, dict[str, int]]:
+    result_cache = get_result_cache()
+    return {"process": dict(result_cache.stats), "total": result_cache.totals()}
+
+
+@served
+def result_cache_clear_command() -> None:
+    get_result_cache().clear()
@@ -0,0 +1,188 @@
+import builtins
+import functools
+import importlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+from typing import Callable
+from .search_utils import cache_path, SNAPSHOT_POLL_INTERVAL
+from .doc_store import DoctorRecord
+from .snapshots import current_snapshot_name
+from .engines import pin_engines, swap_engines
+
+# The one socket both the daemon and the CLIs use, set SEARCH_DAEMON_SOCKET to move it
+daemon_socket_path = os.environ.get("SEARCH_DAEMON_SOCKET") or os.path.join(cache_path, "search_daemon.sock")
+SERVED_MODULES = ["keyword_search", "semantic_search", "hybrid_search", "filters", "augmented_generation", "evaluation", "result_cache"]
+
+served_commands: dict[str, Callable] = {}
+_in_daemon = False
+
+
+def served(command: Callable) -> Callable:
+    # Marks a read-only *_command as answerable by a running search daemon: the call is sent over the socket when a
+    # daemon is listening and runs in this process otherwise. Results come back as plain JSON values (records as
+    # dicts, tuples as lists), which the CLIs index the same way.
+    name = f"{command.__module__.rsplit('.', 1)[-1]}.{command.__name__}"
+    served_commands[name] = command
+
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        if not _in_daemon:
+            response = request_daemon({"command": name, "args": args, "kwargs": kwargs})
+            if response is not None:
+                if "error" in response:
+                    raise _error_type(response["error_type"])(response["error"])
+                return response["result"]
+        return command(*args, **kwargs)
+    return wrapper
+
+
+def _error_type(name: str) -> type[Exception]:
+    # Built-in errors are raised again as themselves, anything else as a RuntimeError
+    error = getattr(builtins, name, None)
+    return error if isinstance(error, type) and issubclass(error, Exception) else RuntimeError
+
+
+def to_json(value):
+    if isinstance(value, DoctorRecord):
+        return value.to_dict()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, default=to_json).encode() + b"\n"
+
+
+def request_daemon(message: dict, path: str = daemon_socket_path) -> dict | None:
+    # None when no daemon is listening (no socket, or a stale one left by a killed daemon)
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(path)
+            connection.sendall(_encode(message))
+            with connection.makefile("rb") as reader:
+                line = reader.readline()
+    except (ConnectionRefusedError, FileNotFoundError):
+        return None
+    if not line:
+        raise RuntimeError("The search daemon closed the connection without answering.")
+    return json.loads(line)
+
+
+class SearchDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str = daemon_socket_path) -> None:
+        self.path = path
+        self.started = time.time()
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+        self.stopping = threading.Event()
+        super().__init__(path, SearchDaemonHandler)
+
+    def server_bind(self) -> None:
+        # The socket is created owner-only (0600) by the umask, so no other user can connect between bind and a chmod
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def answer(self, message: dict) -> dict:
+        match message.get("command"):
+            case "ping":
+                return {"result": {"pid": os.getpid(), "uptime": time.time() - self.started, "requests": self.requests, "snapshot": current_snapshot_name(), "commands": sorted(served_commands)}}
+            case "shutdown":
+                return {"result": "stopping"} # The handler stops the server once this answer is sent
+        command = served_commands.get(message.get("command"))
+        if command is None:
+            return {"error": f"Unknown command '{message.get('command')}'", "error_type": "ValueError"}
+        # Commands run concurrently, one per connection thread: searches keep their state per call (see SearchRun)
+        with self.requests_lock:
+            self.requests += 1
+        try:
+            return {"result": command(*message.get("args", []), **message.get("kwargs", {}))}
+        except Exception as e:
+            return {"error": str(e), "error_type": type(e).__name__}
+
+
+class SearchDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            message = {}
+            try:
+                message = json.loads(line)
+                response = _encode(self.server.answer(message))
+            except (ValueError, TypeError) as e:
+                response = _encode({"error": f"Bad request: {e}", "error_type": "ValueError"})
+            self.wfile.write(response)
+            self.wfile.flush()
+            if isinstance(message, dict) and message.get("command") == "shutdown":
+                # Only after answering: the process exits as soon as the server stops, cutting off this thread
+                threading.Thread(target=self.server.shutdown).start()
+
+
+def _watch_snapshots(server: SearchDaemon) -> None:
+    # Loads every engine of a newly published snapshot in the background while requests keep using the current
+    # ones, then swaps them in at once (see swap_engines). Requests that are running keep the engines they started with.
+    loaded = current_snapshot_name()
+    while not server.stopping.wait(SNAPSHOT_POLL_INTERVAL):
+        name = current_snapshot_name()
+        if name != loaded:
+            try:
+                snapshot = swap_engines()
+                loaded = snapshot.name if snapshot else None
+                print(f"Switched to snapshot {loaded}")
+            except Exception as e:
+                print(f"Could not load snapshot {name}: {e}")
+
+
+def serve_command(path: str = daemon_socket_path, warm: bool = True) -> None:
+    global _in_daemon
+    _in_daemon = True
+    for module in SERVED_MODULES:
+        importlib.import_module(f"{__package__}.{module}")
+    if request_daemon({"command": "ping"}, path) is not None:
+        raise RuntimeError(f"A search daemon is already listening on {path}")
+    if os.path.exists(path):
+        os.remove(path) # Left by a daemon that did not shut down cleanly
+    pin_engines()
+    if warm:
+        # Loads the store, the keyword index, the embeddings, the sentence model and the cross encoder before the first request
+        from .hybrid_search import get_hybrid_search
+        from .rerank import get_reranker
+        get_hybrid_search().semantic_search.embed_queries(["warm up"])
+        get_reranker().model
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    server = SearchDaemon(path)
+    print(f"Search daemon listening on {path} (pid {os.getpid()})")
+    threading.Thread(target=_watch_snapshots, args=(server,), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def status_command(path: str = daemon_socket_path) -> dict | None:
+    response = request_daemon({"command": "ping"}, path)
+    return response["result"] if response else None
+
+
+def stop_command(path: str = daemon_socket_path) -> bool:
+    return request_daemon({"command": "shutdown"}, path) is not None
@@ -1,12 +1,40 @@
+import hashlib
 import json
 import os
 import numpy as np
+from collections.abc import Iterator
+from itertools import chain
+from typing import TextIO
 
 DEFAULT_SEARCH_LIMIT = 5
 BM25_K1 = 1.5
 BM25_B = 0.75
+MAXSCORE_FIRST_WINDOW = 1024 # Doc rows scored together in the first MaxScore window, before a top-k threshold exists
+MAXSCORE_MAX_WINDOW = 1 << 16 # Windows double up to this many doc rows
 HYBRID_A = 0.5
 RRF_K = 60
+ANN_NLIST = 32
+ANN_NPROBE = 4
+ANN_KMEANS_ITERATIONS = 20
+QUANTIZED_RESCORE_FACTOR = 4
+BUILD_SHARD_SIZE = 1000
+INGEST_BATCH_SIZE = 256
+JSON_READ_CHUNK_SIZE = 1 << 16
+FACET_AGE_BUCKET_SIZE = 10
+LEG_TIMEOUT = 2.0 # Seconds each concurrent hybrid search leg may take before the other leg is used alone
+ENHANCE_TIME_BUDGET = 3.0 # Seconds a speculative search waits for the query enhancement
+CANDIDATE_DEPTH_START = 4 # First per-leg hybrid candidate depth, as a multiple of the result limit
+CANDIDATE_DEPTH_GROWTH = 4 # Depth multiplier of each further round while the fused top results still change
+CANDIDATE_DEPTH_MAX = 50 # Deepest per-leg candidate depth, as a multiple of the result limit
+RERANK_CANDIDATE_FACTOR = 5 # Fused results handed to the reranker per requested result
+RERANK_BATCH_SIZE = 32 # (query, doctor) pairs per cross-encoder forward pass
+RERANK_PROCESSES = 0 # Worker processes the cross-encoder may spread large candidate sets over (0 or 1: none)
+RERANK_POOL_MIN_PAIRS = 256 # Uncached pairs below which scoring stays in the calling process
+RERANK_CACHE_SIZE = 50000 # Cross-encoder (query, doctor id, doctor hash) scores kept in memory per process
+SNAPSHOTS_KEPT = 3 # Published index snapshots kept on disk, the current one included
+SNAPSHOT_POLL_INTERVAL = 1.0 # Seconds between the search daemon's checks for a newly published snapshot
+RESULT_CACHE_SIZE = 256 # Search responses kept in memory per process
+RESULT_CACHE_MAX_ROWS = 10000 # Search responses kept in the on-disk cache
 
 current_path = os.path.abspath(__file__) # abs_path of search_utils.py
 project_root_path = os.path.dirname(os.path.dirname(os.path.dirname(current_path)))
@@ -16,13 +44,50 @@ cache_path = os.path.join(project_root_path, "cache")
 golden_dataset_json_path = os.path.join(project_root_path, "data", "golden_dataset.json")
 
 def load_doctors() -> list[dict]: # Returns a list of dicts with string keys to Any values
-    if not os.path.exists(doctors_json_path):
-        raise FileNotFoundError(f"The doctor database was not found at: {doctors_json_path}")
+    return list(iter_doctors())
 
-    with open(doctors_json_path, "r") as f:
-        data = json.load(f)
 
-    return data
+def iter_doctors(path: str = doctors_json_path) -> Iterator[dict]:
+    # Streams doctors one at a time from either a JSON array or a JSON Lines file, without loading the whole file
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The doctor database was not found at: {path}")
+
+    with open(path, "r") as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        if first_char == "[":
+            yield from _iter_json_array(f)
+        else:
+            first_line = first_char + f.readline()
+            for line in chain([first_line], f):
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _iter_json_array(f: TextIO) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = ""
+    end_of_file = False
+    while True:
+        buffer = buffer.lstrip()
+        if buffer.startswith(","):
+            buffer = buffer[1:].lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            if not buffer:
+                raise json.JSONDecodeError("Need more data", buffer, 0)
+            doctor, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if end_of_file:
+                raise
+            chunk = f.read(JSON_READ_CHUNK_SIZE)
+            end_of_file = not chunk
+            buffer += chunk
+            continue
+        yield doctor
+        buffer = buffer[end:]
 
 
 def load_golden_dataset() -> list[dict]: # Returns a list of dicts with string keys to Any values
@@ -35,6 +100,14 @@ def load_golden_dataset() -> list[dict]: # Returns a list of dicts with string k
     return data["test_cases"]
 
 
+def doctor_text(doctor: dict) -> str:
+    return f"{doctor["name"]}. {doctor["age"]}. {doctor["specialty"]}. {doctor["bio"]}. {doctor["availability"]}"
+
+
+def doctor_hash(doctor: dict) -> str:
+    return hashlib.sha1(doctor_text(doctor).encode("utf-8")).hexdigest()
+
+
 def get_stopwords() -> list[str]:
     with open(stopwords_path, "r") as f:
         stopwords_lines = f.read()
@@ -50,4 +123,25 @@ def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
     if norm1 == 0 or norm2 == 0:
         return 0.0
 
-    return dot_product / (norm1 * norm2)
\ No newline at end of file
+    return dot_product / (norm1 * norm2)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # Same order as a stable descending sort: ties keep the lowest indices first
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth_score)
+        ties = np.flatnonzero(scores == kth_score)[:k - len(above)]
+        candidates = np.sort(np.concatenate((above, ties)))
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
@@ -1,15 +1,51 @@
+import hashlib
+import json
 import numpy as np
 import os
-from sentence_transformers import SentenceTransformer
-from lib.search_utils import cache_path, load_doctors, DEFAULT_SEARCH_LIMIT, cosine_similarity
+import time
+from typing import TYPE_CHECKING
+from lib.search_utils import cache_path, doctor_text, load_golden_dataset, DEFAULT_SEARCH_LIMIT, ANN_NLIST, ANN_NPROBE, ANN_KMEANS_ITERATIONS, normalize_rows, top_k_indices
+from lib.ann_index import IVFIndex
+from lib.quantization import QuantizedEmbeddings, QUANTIZATION_MODES
+from lib.doc_store import DocStore, open_doc_store, ids_and_hashes
+from lib.filters import resolve_filters
+from lib.engines import get_engine
+from lib.snapshots import Snapshot
+from lib.search_daemon import served
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+_models: dict[str, "SentenceTransformer"] = {}
+
+
+def get_model(name: str = MODEL_NAME) -> "SentenceTransformer":
+    # One instance per process, shared by every SemanticSearch. The import is deferred as well, so processes that
+    # never encode (e.g. CLIs answered by the search daemon) skip loading torch
+    if name not in _models:
+        from sentence_transformers import SentenceTransformer
+        _models[name] = SentenceTransformer(name)
+    return _models[name]
+
 
 class SemanticSearch:
     def __init__(self) -> None:
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        self._model = None
         self.embeddings = None
-        self.drs_docs = None
-        self.drs_docs_map = {}
+        self.drs_docs: DocStore | list[dict] | None = None
         self.embeddings_path = os.path.join(cache_path, "drs_embeddings.npy")
+        self.manifest_path = os.path.join(cache_path, "drs_embeddings_manifest.json")
+        self.ann_index = None
+        self.ann_index_path = os.path.join(cache_path, "drs_ann_ivf.npz")
+        self.quantized = None
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        # Loaded on first use so that commands which only read the stored embeddings skip the model startup
+        if self._model is None:
+            self._model = get_model()
+        return self._model
     
     def generate_embedding(self, text: str):
         if not text.strip():
@@ -17,49 +53,296 @@ class SemanticSearch:
         embeddings = self.model.encode([text])
         return embeddings[0]
 
-    def build_embeddings(self, drs_docs: list[dict]) -> np.ndarray:
+    def generate_embeddings(self, texts: list[str]) -> np.ndarray:
+        if not texts or any(not text.strip() for text in texts):
+            raise ValueError("Give a list of texts of at least one word each.")
+        return self.model.encode(texts)
+
+    def build_embeddings(self, drs_docs: DocStore | list[dict]) -> np.ndarray:
         self.drs_docs = drs_docs
-        drs_representations = []
-        for dr in drs_docs:
-            self.drs_docs_map[dr["id"]] = dr
-            drs_representations.append(f"{dr["name"]}. {dr["age"]}. {dr["specialty"]}. {dr["bio"]}. {dr["availability"]}")
-        self.embeddings = self.model.encode(drs_representations, show_progress_bar=True)
-        
-        os.makedirs(os.path.dirname(self.embeddings_path), exist_ok=True)
-        np.save(self.embeddings_path, self.embeddings)
+        return self.update_embeddings(drs_docs, reuse=False)
+
+    def load_or_create_embeddings(self, drs_docs: DocStore | list[dict], storage: str = "float32") -> np.ndarray:
+        self.drs_docs = drs_docs
+        manifest = self._load_manifest()
+        ids, hashes = ids_and_hashes(drs_docs)
+        if manifest is None or manifest["ids"] != ids or manifest["hashes"] != hashes:
+            self.update_embeddings(drs_docs)
+        else:
+            self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+        # With a quantized storage mode the float32 matrix is only touched for re-scoring shortlists
+        if storage != "float32":
+            self.load_quantized(storage)
         return self.embeddings
-    
-    def load_or_create_embeddings(self, drs_docs: list[dict]) -> np.ndarray:
+
+    def update_embeddings(self, drs_docs: DocStore | list[dict], reuse: bool = True) -> np.ndarray:
+        # Rows are stored normalized and keyed by a content hash, so only added or edited doctors are re-encoded
+        manifest = self._load_manifest() if reuse else None
+        old_rows = {}
+        if manifest is not None:
+            old_rows = {(doc_id, doc_hash): row for row, (doc_id, doc_hash) in enumerate(zip(manifest["ids"], manifest["hashes"]))}
+        ids, hashes = ids_and_hashes(drs_docs)
+        reused = [(row, old_rows[key]) for row, key in enumerate(zip(ids, hashes)) if key in old_rows]
+        reused_rows = {row for row, _ in reused}
+        to_encode = [row for row in range(len(drs_docs)) if row not in reused_rows]
+
+        os.makedirs(cache_path, exist_ok=True)
+        tmp_path = self.embeddings_path + ".tmp.npy"
+        dimensions = self.model.get_sentence_embedding_dimension()
+        new_embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(drs_docs), dimensions))
+        if reused:
+            old_embeddings = np.load(self.embeddings_path, mmap_mode="r")
+            new_rows, old_rows_used = (np.array(rows) for rows in zip(*reused))
+            new_embeddings[new_rows] = old_embeddings[old_rows_used]
+            del old_embeddings
+        if to_encode:
+            encoded = self.model.encode([doctor_text(drs_docs[row]) for row in to_encode], show_progress_bar=True)
+            new_embeddings[to_encode] = normalize_rows(encoded)
+        new_embeddings.flush()
+        del new_embeddings
+        self._publish_store(tmp_path, ids, hashes)
+
+        old_ids = set(manifest["ids"]) if manifest is not None else set()
+        new_ids = set(ids)
+        added = len(new_ids - old_ids)
+        print(f"Embeddings updated: {added} added, {len(to_encode) - added} changed, {len(old_ids - new_ids)} removed, {len(reused)} reused")
+        return self.embeddings
+
+    def import_embeddings(self, drs_docs: DocStore | list[dict], blocks: list[np.ndarray]) -> np.ndarray:
+        # Stores already encoded and normalized row blocks (e.g. from a sharded build) in drs_docs order
         self.drs_docs = drs_docs
-        for dr in drs_docs:
-            self.drs_docs_map[dr["id"]] = dr
-        if os.path.exists(self.embeddings_path):
-            self.embeddings = np.load(self.embeddings_path)
-            if len(self.embeddings) == len(drs_docs):
-                return self.embeddings
-        
-        return self.build_embeddings(drs_docs)
-
-    def search(self, query: str, limit:int=DEFAULT_SEARCH_LIMIT) -> list[dict]:
+        if sum(len(block) for block in blocks) != len(drs_docs):
+            raise ValueError("The embedding blocks do not match the number of doctors.")
+        os.makedirs(cache_path, exist_ok=True)
+        tmp_path = self.embeddings_path + ".tmp.npy"
+        dimensions = blocks[0].shape[1] if blocks else self.model.get_sentence_embedding_dimension()
+        new_embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(drs_docs), dimensions))
+        row = 0
+        for block in blocks:
+            new_embeddings[row:row + len(block)] = block
+            row += len(block)
+        new_embeddings.flush()
+        del new_embeddings
+        self._publish_store(tmp_path, *ids_and_hashes(drs_docs))
+        return self.embeddings
+
+    def _publish_store(self, tmp_path: str, ids: list[str], hashes: list[str]) -> None:
+        os.replace(tmp_path, self.embeddings_path)
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"model": MODEL_NAME, "ids": ids, "hashes": hashes}, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+
+    def _load_manifest(self) -> dict | None:
+        if not os.path.exists(self.manifest_path) or not os.path.exists(self.embeddings_path):
+            return None
+        with open(self.manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("model") != MODEL_NAME:
+            return None
+        return manifest
+
+    def manifest_digest(self) -> str | None:
+        # Changes whenever a doctor is added, removed, edited or moved to another row
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def quantized_path(self, mode: str) -> str:
+        return os.path.join(cache_path, f"drs_embeddings_{mode}.npz")
+
+    def load_quantized(self, mode: str) -> QuantizedEmbeddings:
+        path = self.quantized_path(mode)
+        self.quantized = QuantizedEmbeddings(mode)
+        # The file is shared by the working embeddings and every snapshot, so it is rebuilt unless it was built
+        # from these exact embedding rows
+        digest = self.manifest_digest()
+        if os.path.exists(path):
+            self.quantized.load(path)
+            if self.quantized.matches(len(self.embeddings), digest):
+                return self.quantized
+        self.quantized.build(self.embeddings)
+        self.quantized.manifest_hash = digest
+        self.quantized.save(path)
+        return self.quantized
+
+    def search(self, query: str, limit:int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None) -> list[dict]:
+        rows, scores = self.top_k(query, limit, mask)
+        return [self._format_result(score, self.drs_docs[row]) for row, score in zip(rows, scores)]
+
+    def search_many(self, queries: list[str], limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None) -> list[list[dict]]:
+        return [[self._format_result(score, self.drs_docs[row]) for row, score in zip(rows, scores)] for rows, scores in self.top_k_many(queries, limit, mask)]
+
+    def top_k(self, query: str, limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None, q_embedding: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        # Rows of drs_docs and scores of the best matches, without building result dicts.
+        # q_embedding skips encoding the query again when it was already encoded (see embed_queries)
+        if self.embeddings is None or self.embeddings.size == 0:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        if q_embedding is None:
+            q_embedding = normalize_rows(self.generate_embedding(query))
+        return self._top_k(q_embedding, limit, mask)
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        return normalize_rows(self.generate_embeddings(queries))
+
+    def top_k_many(self, queries: list[str], limit: int=DEFAULT_SEARCH_LIMIT, mask: np.ndarray = None) -> list[tuple[np.ndarray, np.ndarray]]:
+        if self.embeddings is None or self.embeddings.size == 0:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        q_embeddings = self.embed_queries(queries)
+        if mask is None and (self.quantized is not None or self.ann_index is not None):
+            top = [self._top_k(q_embedding, limit) for q_embedding in q_embeddings]
+        else:
+            candidates = np.flatnonzero(mask) if mask is not None else None
+            embeddings = self.embeddings if candidates is None else self.embeddings[candidates]
+            top = []
+            for q_scores in q_embeddings @ embeddings.T:
+                best = top_k_indices(q_scores, limit)
+                top.append((best if candidates is None else candidates[best], q_scores[best]))
+        return top
+
+    def _top_k(self, q_embedding: np.ndarray, limit: int, mask: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        if mask is not None:
+            # A filter already narrows the candidates, so only those rows are scored exactly
+            candidates = np.flatnonzero(mask)
+            scores = self.embeddings[candidates] @ q_embedding
+            best = top_k_indices(scores, limit)
+            return candidates[best], scores[best]
+        if self.quantized is not None:
+            return self.quantized.search(q_embedding, self.embeddings, limit)
+        if self.ann_index is not None:
+            return self.ann_index.search(q_embedding, self.embeddings, limit)
+        scores = self.embeddings @ q_embedding
+        best = top_k_indices(scores, limit)
+        return best, scores[best]
+
+    def build_ann_index(self, nlist: int = ANN_NLIST, nprobe: int = ANN_NPROBE, iterations: int = ANN_KMEANS_ITERATIONS) -> IVFIndex:
         if self.embeddings is None or self.embeddings.size == 0:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
-        q_embedding = self.generate_embedding(query)
-        scores = []
-        for i, dr_embedding in enumerate(self.embeddings):
-            similarity_score = cosine_similarity(q_embedding, dr_embedding)
-            document = self.drs_docs[i]
-            scores.append((similarity_score, document))
-        sorted_scores = sorted(scores, key= lambda item: item[0], reverse=True)[:limit]
-        return [{"score": ss[0], "name": ss[1]['name'], "id": ss[1]['id'], "dr_info": f"Age: {ss[1]['age']}. Specialty: {ss[1]['specialty']}. Bio: {ss[1]['bio']} Availability: {ss[1]['availability']}"} for ss in sorted_scores]
-        
-
-def search_command(query: str, limit: int) -> list[dict]:
+        self.ann_index = IVFIndex(nlist, nprobe)
+        self.ann_index.build(self.embeddings, iterations)
+        self.ann_index.manifest_hash = self.manifest_digest()
+        self.ann_index.save(self.ann_index_path)
+        return self.ann_index
+
+    def load_ann_index(self, nprobe: int = None) -> IVFIndex:
+        self.ann_index = IVFIndex()
+        self.ann_index.load(self.ann_index_path)
+        if not self.ann_index.matches(len(self.embeddings), self.manifest_digest()):
+            # The embeddings were updated since (doctors added, removed or reordered), so its rows would point at
+            # the wrong doctors or past the end of the matrix. Rebuilt with the same number of cells.
+            print("The ANN index is out of date with the embeddings, rebuilding it")
+            self.build_ann_index(self.ann_index.nlist, self.ann_index.nprobe)
+        if nprobe:
+            self.ann_index.nprobe = nprobe
+        return self.ann_index
+
+    def _format_result(self, score: float, dr: dict) -> dict:
+        return {"score": score, "name": dr['name'], "id": dr['id'], "doc": dr, "dr_info": f"Age: {dr['age']}. Specialty: {dr['specialty']}. Bio: {dr['bio']} Availability: {dr['availability']}"}
+
+
+def get_semantic_search(storage: str = "float32") -> SemanticSearch:
+    def load(drs_docs: DocStore, snapshot: Snapshot | None) -> SemanticSearch:
+        semantic_search = SemanticSearch()
+        if snapshot is not None:
+            semantic_search.embeddings_path = snapshot.file("embeddings")
+            semantic_search.manifest_path = snapshot.file("embeddings_manifest")
+        semantic_search.load_or_create_embeddings(drs_docs, storage)
+        return semantic_search
     semantic_search = SemanticSearch()
-    drs_docs = load_doctors()
-    semantic_search.load_or_create_embeddings(drs_docs)
+    watched = [semantic_search.embeddings_path, semantic_search.manifest_path]
+    if storage != "float32":
+        watched.append(semantic_search.quantized_path(storage))
+    return get_engine(f"semantic-{storage}", load, watched)
+
+
+@served
+def search_command(query: str, limit: int, storage: str = "float32", filters: dict = None) -> list[dict]:
+    semantic_search = get_semantic_search(storage)
+    return semantic_search.search(query, limit, resolve_filters(semantic_search.drs_docs, filters))
+
+
+@served
+def search_many_command(queries: list[str], limit: int, filters: dict = None) -> list[list[dict]]:
+    if not queries:
+        return [] # Nothing to embed, and no need to load the embeddings
+    semantic_search = get_semantic_search()
+    return semantic_search.search_many(queries, limit, resolve_filters(semantic_search.drs_docs, filters))
+
+
+def _working_semantic_search() -> SemanticSearch:
+    # The working embeddings in cache/, brought up to date with the doctors. Searches read the CURRENT snapshot once
+    # one is published, so an update is published as a new snapshot instead of only changing the working files.
+    semantic_search = SemanticSearch()
+    digest = semantic_search.manifest_digest()
+    semantic_search.load_or_create_embeddings(open_doc_store())
+    if semantic_search.manifest_digest() != digest:
+        from lib.index_builder import republish_snapshot # index_builder imports this module
+        republish_snapshot()
+    return semantic_search
+
+
+def ann_build_command(nlist: int, nprobe: int, iterations: int) -> IVFIndex:
+    semantic_search = _working_semantic_search()
+    return semantic_search.build_ann_index(nlist, nprobe, iterations)
+
+
+def ann_search_command(query: str, limit: int, nprobe: int) -> list[dict]:
+    semantic_search = _working_semantic_search()
+    semantic_search.load_ann_index(nprobe)
     return semantic_search.search(query, limit)
 
 
+def ann_report_command(limit: int, nprobes: list[int]) -> list[dict]:
+    semantic_search = _working_semantic_search()
+    ann_index = semantic_search.load_ann_index()
+    q_embeddings = normalize_rows(semantic_search.generate_embeddings([case["query"] for case in load_golden_dataset()]))
+    embeddings = semantic_search.embeddings
+
+    start = time.perf_counter()
+    exact = [set(top_k_indices(embeddings @ q_embedding, limit).tolist()) for q_embedding in q_embeddings]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(q_embeddings)
+
+    report = [{"method": "exact", "nprobe": None, "recall": 1.0, "latency_ms": exact_ms}]
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approximate = [set(ann_index.search(q_embedding, embeddings, limit, nprobe)[0].tolist()) for q_embedding in q_embeddings]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(q_embeddings)
+        recall = sum(len(a & e) / len(e) for a, e in zip(approximate, exact)) / len(exact)
+        report.append({"method": "ivf", "nprobe": min(nprobe, ann_index.nlist), "recall": recall, "latency_ms": latency_ms})
+    return report
+
+
+def quantize_command(mode: str) -> tuple[int, int]:
+    semantic_search = _working_semantic_search()
+    embeddings = semantic_search.embeddings
+    quantized = QuantizedEmbeddings(mode)
+    quantized.build(embeddings)
+    quantized.manifest_hash = semantic_search.manifest_digest()
+    quantized.save(semantic_search.quantized_path(mode))
+    return embeddings.nbytes, quantized.nbytes
+
+
+def quantize_report_command(limit: int) -> list[dict]:
+    semantic_search = _working_semantic_search()
+    embeddings = semantic_search.embeddings
+    q_embeddings = normalize_rows(semantic_search.generate_embeddings([case["query"] for case in load_golden_dataset()]))
+
+    start = time.perf_counter()
+    exact = [set(top_k_indices(semantic_search.embeddings @ q_embedding, limit).tolist()) for q_embedding in q_embeddings]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(q_embeddings)
+
+    report = [{"mode": "float32", "bytes": embeddings.nbytes, "compression": 1.0, "recall": 1.0, "latency_ms": exact_ms}]
+    for mode in QUANTIZATION_MODES:
+        quantized = semantic_search.load_quantized(mode)
+        start = time.perf_counter()
+        approximate = [set(quantized.search(q_embedding, embeddings, limit)[0].tolist()) for q_embedding in q_embeddings]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(q_embeddings)
+        recall = sum(len(a & e) / len(e) for a, e in zip(approximate, exact)) / len(exact)
+        report.append({"mode": mode, "bytes": quantized.nbytes, "compression": embeddings.nbytes / quantized.nbytes, "recall": recall, "latency_ms": latency_ms})
+    return report
+
+
 def embed_text(text: str) -> np.ndarray:
     semantic_search = SemanticSearch()
     embedding = semantic_search.generate_embedding(text)
@@ -74,10 +357,9 @@ def verify_model() -> None:
 
 
 def verify_embeddings() -> None:
-    semantic_search = SemanticSearch()
-    drs_docs = load_doctors()
-    embeddings = semantic_search.load_or_create_embeddings(drs_docs)
-    print(f"Number of docs:   {len(drs_docs)}")
+    semantic_search = _working_semantic_search()
+    embeddings = semantic_search.embeddings
+    print(f"Number of docs:   {len(semantic_search.drs_docs)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
 
 
@@ -0,0 +1,123 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from .search_utils import cache_path, SNAPSHOTS_KEPT
+from .doc_store import DocStore
+
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_FILES = {
+    "doc_store": "doctors_store.bin",
+    "keyword_index": "keyword_index.bin",
+    "embeddings": "drs_embeddings.npy",
+    "embeddings_manifest": "drs_embeddings_manifest.json",
+    "spell_index": "spell_index.json",
+}
+OPTIONAL_SNAPSHOT_FILES = {
+    "expansion_table": "expansion_table.bin", # Only built on demand (build-expansions)
+}
+snapshots_path = os.path.join(cache_path, "snapshots")
+current_pointer_path = os.path.join(snapshots_path, "CURRENT")
+
+
+class Snapshot:
+    # An immutable, self-consistent set of search files: the doctor store, the keyword index, its spell index, the
+    # embeddings and the query expansion table (when one was built) that were all built from the same corpus.
+    # Searchers read the snapshot named by CURRENT and never the loose files the builders keep updating in cache/.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Snapshot {self.name} has format version {self.manifest.get('format_version')}, expected {SNAPSHOT_FORMAT_VERSION}. Publish a new one.")
+
+    def file(self, part: str) -> str:
+        return os.path.join(self.path, SNAPSHOT_FILES.get(part) or OPTIONAL_SNAPSHOT_FILES[part])
+
+    def has(self, part: str) -> bool:
+        return part in self.manifest["files"]
+
+
+def corpus_hash(drs_docs: DocStore) -> str:
+    digest = hashlib.sha256()
+    for doc_id, doc_hash in zip(drs_docs.ids(), drs_docs.hashes()):
+        digest.update(f"{doc_id}\0{doc_hash}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def current_snapshot_name() -> str | None:
+    try:
+        with open(current_pointer_path, "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_snapshot() -> Snapshot | None:
+    name = current_snapshot_name()
+    return Snapshot(os.path.join(snapshots_path, name)) if name else None
+
+
+def list_snapshots() -> list[Snapshot]:
+    if not os.path.isdir(snapshots_path):
+        return []
+    names = sorted(name for name in os.listdir(snapshots_path) if name.startswith("v") and os.path.isdir(os.path.join(snapshots_path, name)))
+    return [Snapshot(os.path.join(snapshots_path, name)) for name in names]
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    # The builders replace their files (write to a temporary file, then rename) instead of writing in place,
+    # so a hard link keeps the published content even after the next build
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def publish_snapshot(files: dict[str, str], drs_docs: DocStore, keep: int = SNAPSHOTS_KEPT) -> Snapshot:
+    # The files are staged in a hidden directory, which is renamed to the next version once complete, and only then
+    # is CURRENT switched to it (both renames are atomic). Readers see either the old snapshot or the new one.
+    os.makedirs(snapshots_path, exist_ok=True)
+    with open(os.path.join(snapshots_path, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # One publisher at a time, so versions are never reused
+        versions = [int(name[1:]) for name in os.listdir(snapshots_path) if name.startswith("v") and name[1:].isdigit()]
+        name = f"v{max(versions, default=0) + 1:06d}"
+        staging = os.path.join(snapshots_path, f".staging-{name}-{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        parts = SNAPSHOT_FILES | {part: filename for part, filename in OPTIONAL_SNAPSHOT_FILES.items() if files.get(part)}
+        for part, filename in parts.items():
+            _link_or_copy(files[part], os.path.join(staging, filename))
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "name": name,
+            "created": time.time(),
+            "corpus": drs_docs.source,
+            "corpus_hash": corpus_hash(drs_docs),
+            "doctors": len(drs_docs),
+            "files": {part: {"name": filename, "size": os.path.getsize(os.path.join(staging, filename))} for part, filename in parts.items()},
+        }
+        _write_atomic(os.path.join(staging, "manifest.json"), json.dumps(manifest, indent=2))
+        os.rename(staging, os.path.join(snapshots_path, name))
+        _write_atomic(current_pointer_path, name)
+        _prune(name, keep)
+    return Snapshot(os.path.join(snapshots_path, name))
+
+
+def _prune(current: str, keep: int) -> None:
+    # Searchers still answering from an older snapshot keep their memory maps, which stay valid after the removal
+    names = sorted(name for name in os.listdir(snapshots_path) if name.startswith("v") and name != current)
+    for name in names[:max(0, len(names) - (keep - 1))]:
+        shutil.rmtree(os.path.join(snapshots_path, name), ignore_errors=True)
@@ -0,0 +1,158 @@
+import calendar
+import json
+import os
+import re
+import numpy as np
+from collections import Counter
+from typing import TYPE_CHECKING
+from .search_utils import cache_path, get_stopwords
+from .doc_store import DocStore, source_fingerprint
+from .engines import get_engine
+from .snapshots import Snapshot
+
+if TYPE_CHECKING:
+    from .keyword_search import InvertedIndex
+
+SPELL_INDEX_FORMAT_VERSION = 1
+MAX_EDIT_DISTANCE = 2
+PREFIX_LENGTH = 7
+MIN_WORD_LENGTH = 4 # Shorter words are too ambiguous to correct without context
+WORD_PATTERN = re.compile(r"[A-Za-z]+")
+spell_index_path = os.path.join(cache_path, "spell_index.json")
+
+
+def _deletes(word: str, max_distance: int) -> set[str]:
+    # Every string reachable from `word` by removing up to max_distance characters
+    results = set()
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {candidate[:i] + candidate[i + 1:] for candidate in frontier for i in range(len(candidate))} - results
+        results |= frontier
+    return results
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    # Optimal string alignment distance (adjacent transpositions count as one edit), max_distance + 1 when above it
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class SpellCorrector:
+    # SymSpell: every vocabulary word is indexed under the deletes of its first PREFIX_LENGTH characters, so a
+    # lookup only generates the deletes of the query word and verifies the few words sharing one of them.
+    # Ties on edit distance go to the word found in more doctors.
+    def __init__(self, path: str = spell_index_path) -> None:
+        self.path = path
+        self.source = None
+        self.words: list[str] = []
+        self.counts: list[int] = []
+        self.word_ids: dict[str, int] = {}
+        self.deletes: dict[str, list[int]] = {}
+        self.stopwords = set(get_stopwords())
+
+    def build(self, idx: "InvertedIndex", drs_docs: DocStore) -> None:
+        # Vocabulary: the surface words seen by the keyword index, weighted by the document frequency of their
+        # lemma, plus the words of the doctor names and the weekday names used in availability queries
+        document_frequencies = np.diff(idx.term_offsets).tolist() if idx.term_offsets is not None else []
+        counts = Counter()
+        for word, lemma in idx.word_lemmas.items():
+            term_id = idx.terms.get(lemma or word)
+            counts[word] = document_frequencies[term_id] if term_id is not None else 1
+        for doctor in drs_docs:
+            for word in WORD_PATTERN.findall(doctor["name"].lower()):
+                counts[word] += 1
+        for day in calendar.day_name:
+            counts[day.lower()] = max(counts.values(), default=1)
+        self.words = sorted(word for word in counts if word.isalpha() and word not in self.stopwords)
+        self.counts = [counts[word] for word in self.words]
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+        deletes: dict[str, list[int]] = {}
+        for word_id, word in enumerate(self.words):
+            prefix = word[:PREFIX_LENGTH]
+            for key in _deletes(prefix, MAX_EDIT_DISTANCE) | {prefix}:
+                deletes.setdefault(key, []).append(word_id)
+        self.deletes = deletes
+        self.source = source_fingerprint(idx.index_path) if os.path.exists(idx.index_path) else None
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": SPELL_INDEX_FORMAT_VERSION, "source": self.source, "words": self.words, "counts": self.counts, "deletes": self.deletes}, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"The spell index was not found at: {self.path}. Build or sync the keyword index first (`keyword_search_cli.py build` or `sync`).")
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        if data["version"] != SPELL_INDEX_FORMAT_VERSION:
+            raise ValueError(f"{self.path} has format version {data['version']}, expected {SPELL_INDEX_FORMAT_VERSION}. Rebuild it.")
+        self.source = data["source"]
+        self.words = data["words"]
+        self.counts = data["counts"]
+        self.deletes = data["deletes"]
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+
+    def correct_word(self, word: str) -> str:
+        lowered = word.lower()
+        if lowered in self.word_ids or lowered in self.stopwords or len(lowered) < MIN_WORD_LENGTH:
+            return word
+        max_distance = 1 if len(lowered) < 6 else MAX_EDIT_DISTANCE
+        prefix = lowered[:PREFIX_LENGTH]
+        candidates = set()
+        for key in _deletes(prefix, max_distance) | {prefix}:
+            candidates.update(self.deletes.get(key, ()))
+        best = None
+        for word_id in candidates:
+            distance = edit_distance(lowered, self.words[word_id], max_distance)
+            if distance > max_distance:
+                continue
+            rank = (distance, -self.counts[word_id], self.words[word_id])
+            if best is None or rank < best:
+                best = rank
+        if best is None:
+            return word
+        corrected = best[2]
+        return corrected.capitalize() if word[0].isupper() else corrected
+
+    def correct(self, query: str) -> str:
+        return WORD_PATTERN.sub(lambda match: self.correct_word(match.group()), query)
+
+
+def build_spell_index(idx: "InvertedIndex", drs_docs: DocStore) -> SpellCorrector:
+    # Run by every command that writes the keyword index (build, sync, build-all, ingest, publish-snapshot),
+    # so a spell-local search only ever loads the deletion index
+    corrector = SpellCorrector()
+    corrector.build(idx, drs_docs)
+    corrector.save()
+    return corrector
+
+
+def _load_spell_corrector(drs_docs: DocStore, snapshot: Snapshot | None) -> SpellCorrector:
+    # A snapshot carries the spell index built with its keyword index
+    corrector = SpellCorrector(snapshot.file("spell_index") if snapshot is not None else spell_index_path)
+    corrector.load()
+    return corrector
+
+
+def get_spell_corrector() -> SpellCorrector:
+    # Loaded once per process and again when a build or sync rewrites the working file (or a new snapshot is current)
+    return get_engine("spell", _load_spell_corrector, [spell_index_path])
+
+
+def spell_correct_local(query: str) -> str:
+    return get_spell_corrector().correct(query)
@@ -0,0 +1,74 @@
+import string
+from functools import lru_cache
+from nltk import pos_tag, pos_tag_sents
+from nltk.corpus import wordnet
+from nltk.stem import WordNetLemmatizer
+from .search_utils import get_stopwords
+
+LEMMA_CACHE_SIZE = 65536
+TOKENIZE_BATCH_SIZE = 256
+
+
+class Tokenizer:
+    # Loads stopwords, the punctuation table and the lemmatizer once and memoizes (word, POS) -> lemma
+    def __init__(self, lemma_cache_size: int = LEMMA_CACHE_SIZE) -> None:
+        self.stopwords = set(get_stopwords())
+        self.punctuation_table = str.maketrans("", "", string.punctuation)
+        self.lemmatizer = WordNetLemmatizer()
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(self.lemmatizer.lemmatize)
+
+    def words(self, text: str) -> list[str]:
+        return text.lower().translate(self.punctuation_table).split()
+
+    def tokenize(self, text: str) -> list[str]:
+        return self.__lemmas(pos_tag(self.words(text)))
+
+    def tokenize_many(self, texts: list[str], word_lemmas: dict[str, str | None] = None) -> list[list[str]]:
+        # Tags every text in one call. If `word_lemmas` is given, it records which lemma each surface word got,
+        # marking words that got different lemmas in different contexts as ambiguous (None)
+        tokens = []
+        for start in range(0, len(texts), TOKENIZE_BATCH_SIZE):
+            for tagged_words in pos_tag_sents([self.words(text) for text in texts[start:start + TOKENIZE_BATCH_SIZE]]):
+                lemmas = self.__lemmas(tagged_words)
+                if word_lemmas is not None:
+                    kept_words = [word for word, _ in tagged_words if word not in self.stopwords]
+                    for word, lemma in zip(kept_words, lemmas):
+                        if word_lemmas.setdefault(word, lemma) != lemma:
+                            word_lemmas[word] = None
+                tokens.append(lemmas)
+        return tokens
+
+    def tokenize_query(self, text: str, word_lemmas: dict[str, str | None]) -> list[str]:
+        # Fast path: when every word of the query always got the same lemma in the indexed corpus, that lemma is
+        # reused and the POS tagger is skipped. Anything unknown or ambiguous falls back to the full pipeline.
+        words = [word for word in self.words(text) if word not in self.stopwords]
+        lemmas = [word_lemmas.get(word) for word in words]
+        if all(lemmas):
+            return lemmas
+        return self.tokenize(text)
+
+    def __lemmas(self, tagged_words: list[tuple[str, str]]) -> list[str]:
+        return [self.lemmatize(word, get_wordnet_pos(pos)) for word, pos in tagged_words if word and word not in self.stopwords]
+
+
+def get_wordnet_pos(treebank_tag: str) -> str:
+    if treebank_tag.startswith('J'):
+        return wordnet.ADJ
+    elif treebank_tag.startswith('V'):
+        return wordnet.VERB
+    elif treebank_tag.startswith('N'):
+        return wordnet.NOUN
+    elif treebank_tag.startswith('R'):
+        return wordnet.ADV
+    else:
+        return wordnet.NOUN
+
+
+_tokenizer = None
+
+
+def get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer
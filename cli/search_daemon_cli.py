@@ -0,0 +1,37 @@
+import argparse
+from lib.search_daemon import serve_command, status_command, stop_command, daemon_socket_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=f"Search Daemon CLI: keeps the indexes and models loaded so the other CLIs answer without startup cost. Listens on {daemon_socket_path} (set SEARCH_DAEMON_SOCKET to change it).")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser("serve", help="Load the search engines and answer the CLIs over the socket until stopped (Ctrl+C)")
+    serve_parser.add_argument("--no-warm", action="store_true", help="Load the engines on the first request instead of at startup")
+
+    subparsers.add_parser("status", help="Show whether a daemon is running")
+    subparsers.add_parser("stop", help="Stop the running daemon")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            serve_command(warm=not args.no_warm)
+
+        case "status":
+            status = status_command()
+            if status is None:
+                print(f"No search daemon is listening on {daemon_socket_path}")
+            else:
+                print(f"Search daemon pid {status["pid"]}: up {status["uptime"]:.0f}s, {status["requests"]} requests served, snapshot {status["snapshot"] or "none (working files)"}")
+                print(f"Commands: {", ".join(status["commands"])}")
+
+        case "stop":
+            print("Search daemon stopped" if stop_command() else f"No search daemon is listening on {daemon_socket_path}")
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
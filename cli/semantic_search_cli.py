@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
+import numpy as np
 
-from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search_command
-from lib.search_utils import DEFAULT_SEARCH_LIMIT
+from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search_command, search_many_command, ann_build_command, ann_search_command, ann_report_command, quantize_command, quantize_report_command
+from lib.quantization import QUANTIZATION_MODES
+from lib.filters import add_filter_arguments, filters_from_args
+from lib.search_utils import DEFAULT_SEARCH_LIMIT, ANN_NLIST, ANN_NPROBE, ANN_KMEANS_ITERATIONS
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -22,6 +26,33 @@ def main():
     search_parser = subparsers.add_parser("search", help="Semantic search")
     search_parser.add_argument("query", type=str, help="Text query to search")
     search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Optional results limit")
+    search_parser.add_argument("--storage", type=str, choices=["float32"] + QUANTIZATION_MODES, default="float32", help="Embedding storage: scan compressed codes and re-score a shortlist at full precision")
+    add_filter_arguments(search_parser)
+
+    search_many_parser = subparsers.add_parser("search_many", help="Semantic search for many queries in one batch (one query per line)")
+    search_many_parser.add_argument("--file", type=str, help="File with one query per line (default: read from stdin)")
+    search_many_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Optional results limit per query")
+    add_filter_arguments(search_many_parser)
+
+    ann_build_parser = subparsers.add_parser("ann_build", help="Build the approximate nearest-neighbour (IVF) index and save it to disk")
+    ann_build_parser.add_argument("--nlist", type=int, default=ANN_NLIST, help="Number of k-means cells (more cells = faster, lower recall)")
+    ann_build_parser.add_argument("--nprobe", type=int, default=ANN_NPROBE, help="Default number of cells scanned per query")
+    ann_build_parser.add_argument("--iterations", type=int, default=ANN_KMEANS_ITERATIONS, help="k-means iterations")
+
+    ann_search_parser = subparsers.add_parser("ann_search", help="Semantic search using the saved ANN index")
+    ann_search_parser.add_argument("query", type=str, help="Text query to search")
+    ann_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Optional results limit")
+    ann_search_parser.add_argument("--nprobe", type=int, help="Cells scanned per query (more cells = higher recall, slower)")
+
+    ann_report_parser = subparsers.add_parser("ann_report", help="Recall vs latency of the ANN index compared with exact search")
+    ann_report_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="k for recall@k")
+    ann_report_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="nprobe values to compare")
+
+    quantize_parser = subparsers.add_parser("quantize", help="Build compressed embedding codes and save them to disk")
+    quantize_parser.add_argument("--mode", type=str, choices=QUANTIZATION_MODES, default="int8", help="Quantization mode")
+
+    quantize_report_parser = subparsers.add_parser("quantize_report", help="Memory, recall and latency of each quantization mode compared with float32")
+    quantize_report_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="k for recall@k")
 
     args = parser.parse_args()
 
@@ -38,9 +69,45 @@ def main():
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            results = search_command(args.query, args.limit)
+            results = search_command(args.query, args.limit, args.storage, filters_from_args(args))
+            for i, result in enumerate(results, start=1):
+                print(f"{i}. Name: {result['name']} (score: {result['score']:.4f})\n{result['dr_info']}\n")
+        case "search_many":
+            if args.file:
+                with open(args.file, "r") as f:
+                    lines = f.read().splitlines()
+            else:
+                lines = sys.stdin.read().splitlines()
+            queries = [line.strip() for line in lines if line.strip()]
+            if not queries:
+                print("No queries given, nothing to search")
+            all_results = search_many_command(queries, args.limit, filters_from_args(args))
+            for query, results in zip(queries, all_results):
+                print(f"Query: {query}")
+                for i, result in enumerate(results, start=1):
+                    print(f"{i}. Name: {result['name']} (score: {result['score']:.4f})\n{result['dr_info']}\n")
+        case "ann_build":
+            ann_index = ann_build_command(args.nlist, args.nprobe, args.iterations)
+            sizes = np.diff(ann_index.list_offsets)
+            print(f"ANN index built: {ann_index.nlist} cells, {sizes.min()}-{sizes.max()} doctors per cell, nprobe={ann_index.nprobe}")
+        case "ann_search":
+            results = ann_search_command(args.query, args.limit, args.nprobe)
             for i, result in enumerate(results, start=1):
                 print(f"{i}. Name: {result['name']} (score: {result['score']:.4f})\n{result['dr_info']}\n")
+        case "ann_report":
+            report = ann_report_command(args.limit, args.nprobe)
+            print(f"Recall@{args.limit} vs latency (golden dataset queries):")
+            for row in report:
+                nprobe = "-" if row["nprobe"] is None else row["nprobe"]
+                print(f"- {row['method']:<5} nprobe={nprobe:<4} recall={row['recall']:.4f} latency={row['latency_ms']:.3f} ms/query")
+        case "quantize":
+            full_bytes, quantized_bytes = quantize_command(args.mode)
+            print(f"Quantized embeddings ({args.mode}): {quantized_bytes / 1024:.1f} KiB vs {full_bytes / 1024:.1f} KiB float32 ({full_bytes / quantized_bytes:.1f}x smaller)")
+        case "quantize_report":
+            report = quantize_report_command(args.limit)
+            print(f"Recall@{args.limit}, memory and latency per storage mode (golden dataset queries):")
+            for row in report:
+                print(f"- {row['mode']:<8} {row['bytes'] / 1024:>9.1f} KiB ({row['compression']:.1f}x) recall={row['recall']:.4f} latency={row['latency_ms']:.3f} ms/query")
         case _:
             parser.print_help()
             
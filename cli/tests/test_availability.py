@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from lib.availability import DAYS, SLOT_MINUTES, SLOTS_PER_DAY, WEEK_SLOTS, parse_availability, time_window
+
+
+def slots(*ranges: tuple[str, str, str, str]) -> np.ndarray:
+    # Expected slots from (first day, "HH:MM", last day, "HH:MM") ranges, end exclusive and wrapping around the week
+    expected = np.zeros(WEEK_SLOTS, dtype=bool)
+    for first_day, start, last_day, end in ranges:
+        first = DAYS.index(first_day) * SLOTS_PER_DAY + (int(start[:2]) * 60 + int(start[3:])) // SLOT_MINUTES
+        last = DAYS.index(last_day) * SLOTS_PER_DAY + (int(end[:2]) * 60 + int(end[3:])) // SLOT_MINUTES
+        expected[np.arange(first, last if last > first else last + WEEK_SLOTS) % WEEK_SLOTS] = True
+    return expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Mon-Wed 08:00-12:00", slots(("Mon", "08:00", "Mon", "12:00"), ("Tue", "08:00", "Tue", "12:00"), ("Wed", "08:00", "Wed", "12:00"))),
+    # Overnight shifts run into the next day
+    ("Tue 20:00-02:00", slots(("Tue", "20:00", "Wed", "02:00"))),
+    ("Mon-Tue 22:00-06:00", slots(("Mon", "22:00", "Tue", "06:00"), ("Tue", "22:00", "Wed", "06:00"))),
+    ("Wed 18:00-00:00", slots(("Wed", "18:00", "Thu", "00:00"))),
+    # Sunday night wraps around to Monday morning
+    ("Sun 22:00-06:00", slots(("Sun", "22:00", "Mon", "06:00"))),
+    # Day ranges wrap around the week
+    ("Fri-Mon 09:00-17:00", slots(("Fri", "09:00", "Fri", "17:00"), ("Sat", "09:00", "Sat", "17:00"), ("Sun", "09:00", "Sun", "17:00"), ("Mon", "09:00", "Mon", "17:00"))),
+    ("Sat-Sun 23:00-01:00", slots(("Sat", "23:00", "Sun", "01:00"), ("Sun", "23:00", "Mon", "01:00"))),
+    ("Saturday-Monday 20:00-08:00", slots(("Sat", "20:00", "Sun", "08:00"), ("Sun", "20:00", "Mon", "08:00"), ("Mon", "20:00", "Tue", "08:00"))),
+    # Several schedules, partial slots rounded outwards
+    ("Mon 08:10-09:20, Thu 13:00-14:00", slots(("Mon", "08:00", "Mon", "09:30"), ("Thu", "13:00", "Thu", "14:00"))),
+])
+def test_parse_availability(text, expected):
+    assert np.array_equal(parse_availability(text), expected)
+
+
+def test_parse_availability_without_schedule():
+    assert parse_availability("Rotating Shifts") is None
+    assert parse_availability("24/7 on call").all()
+
+
+def test_overnight_shift_matches_early_morning_window():
+    schedule = parse_availability("Sun 22:00-06:00")
+    assert (schedule & time_window("Mon", "05:45")).any()
+    assert not (schedule & time_window("Mon", "06:00")).any()
+    assert (schedule & time_window("Sun", "23:00-23:30")).any()
+    assert not (schedule & time_window("Sat", "23:00")).any()
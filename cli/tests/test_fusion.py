@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from lib.fusion import empty_leg, fuse
+
+
+def reference_rrf(legs: list[tuple[np.ndarray, np.ndarray]], k: int) -> dict[int, float]:
+    # score(d) = sum over the legs that returned d of 1 / (k + rank of d in that leg), ranks starting at 1
+    scores = {}
+    for rows, _ in legs:
+        for rank, row in enumerate(rows.tolist(), start=1):
+            scores[row] = scores.get(row, 0.0) + 1 / (k + rank)
+    return scores
+
+
+def random_leg(rng: np.random.Generator, size: int, length: int) -> tuple[np.ndarray, np.ndarray]:
+    return rng.choice(size, length, replace=False), np.sort(rng.random(length))[::-1]
+
+
+@pytest.mark.parametrize("k", [1, 60])
+@pytest.mark.parametrize("limit", [1, 10, 500])
+def test_rrf_matches_reference(k, limit):
+    rng = np.random.default_rng(k * 1000 + limit)
+    for _ in range(20):
+        legs = [random_leg(rng, 200, rng.integers(0, 60)), random_leg(rng, 200, rng.integers(0, 60))]
+        fused = fuse(legs, 200, "rrf", limit, k=k)
+        expected = reference_rrf(legs, k)
+        # Best first, equal scores in row order
+        expected_rows = sorted(expected, key=lambda row: (-expected[row], row))[:limit]
+        assert fused["rows"].tolist() == expected_rows
+        assert fused["scores"].tolist() == pytest.approx([expected[row] for row in expected_rows])
+        for leg, (rows, _) in enumerate(legs):
+            ranks = {row: rank for rank, row in enumerate(rows.tolist(), start=1)}
+            assert fused["ranks"][leg].tolist() == [ranks.get(row, 0) for row in expected_rows]
+
+
+def test_rrf_with_an_empty_leg():
+    rows = np.array([4, 2, 9])
+    fused = fuse([(rows, np.array([3.0, 2.0, 1.0])), empty_leg()], 10, "rrf", 10, k=60)
+    assert fused["rows"].tolist() == [4, 2, 9]
+    assert fused["scores"].tolist() == pytest.approx([1 / 61, 1 / 62, 1 / 63])
+    assert fused["ranks"][1].tolist() == [0, 0, 0]
+
+
+def test_rrf_ties_break_by_row():
+    # Row 7 is first in one leg and row 3 first in the other: same score, the lower row wins
+    fused = fuse([(np.array([7, 3]), np.array([2.0, 1.0])), (np.array([3, 7]), np.array([2.0, 1.0]))], 10, "rrf", 2, k=60)
+    assert fused["rows"].tolist() == [3, 7]
+    assert fused["scores"][0] == fused["scores"][1]
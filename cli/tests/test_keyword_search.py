@@ -0,0 +1,154 @@
+import random
+import numpy as np
+import pytest
+from lib import keyword_search
+from lib.doc_store import DocStore
+from lib.keyword_search import InvertedIndex, InvertedIndexWriter
+from lib.search_utils import iter_doctors, doctor_text
+from lib.tokenizer import get_tokenizer
+
+QUERIES = ["heart rhythm", "knee pain sports injury", "child fever", "skin cancer surgery", "anxiety depression therapy", "pain"]
+
+
+@pytest.fixture
+def doctors() -> list[dict]:
+    doctors = list(iter_doctors())[:80]
+    # Copies under other ids score exactly like their original, so the top-k has ties to break
+    return doctors + [dict(doctor, id=f"COPY{i:03d}") for i, doctor in enumerate(doctors[:20])]
+
+
+def store_of(tmp_path, name: str, doctors: list[dict]) -> DocStore:
+    store = DocStore(str(tmp_path / f"{name}.bin"))
+    store.build(doctors)
+    return store
+
+
+def indexed(store: DocStore) -> InvertedIndex:
+    idx = InvertedIndex()
+    idx.sync(store)
+    return idx
+
+
+def brute_force_top_k(idx: InvertedIndex, store: DocStore, query: str, limit: int) -> tuple[np.ndarray, np.ndarray]:
+    # Every doctor scored term by term, best first and ties in doctor store order
+    query_terms = idx.query_terms(query)
+    scores = np.zeros(len(store))
+    for row, doc_id in enumerate(store.ids()):
+        for token, count in query_terms.items():
+            scores[row] += count * idx.get_bm25(doc_id, token)
+    order = np.argsort(-scores, kind="stable")
+    order = order[scores[order] > 0][:limit]
+    return order, scores[order]
+
+
+def postings(idx: InvertedIndex) -> dict[str, dict[str, tuple[int, float]]]:
+    # token -> doc_id -> (term frequency, BM25 weight), independent of term ids and doc rows
+    result = {}
+    for token, term_id in idx.terms.items():
+        start, end = idx.term_offsets[term_id], idx.term_offsets[term_id + 1]
+        result[token] = {idx.doc_ids[row]: (int(tf), float(weight)) for row, tf, weight in zip(idx.posting_docs[start:end].tolist(), idx.posting_tfs[start:end].tolist(), idx.posting_weights[start:end].tolist())}
+    return result
+
+
+@pytest.fixture(params=[(1024, 1 << 16), (4, 16), (1, 1)], ids=["one-window", "small-windows", "row-by-row"])
+def windows(request, monkeypatch):
+    # Small windows make MaxScore set a threshold early and prune the weak lists within a small corpus
+    first, largest = request.param
+    monkeypatch.setattr(keyword_search, "MAXSCORE_FIRST_WINDOW", first)
+    monkeypatch.setattr(keyword_search, "MAXSCORE_MAX_WINDOW", largest)
+
+
+@pytest.mark.parametrize("limit", [1, 5, 10, 30, 1000])
+def test_max_score_matches_brute_force(tmp_path, doctors, windows, limit):
+    store = store_of(tmp_path, "store", doctors)
+    idx = indexed(store)
+    for query in QUERIES:
+        rows, scores = idx.bm25_top_k(query, limit)
+        expected_rows, expected_scores = brute_force_top_k(idx, store, query, limit)
+        assert rows.tolist() == expected_rows.tolist(), query
+        assert scores == pytest.approx(expected_scores, rel=1e-5)
+
+
+def test_max_score_ties_keep_store_order(tmp_path, doctors, windows):
+    store = store_of(tmp_path, "store", doctors)
+    idx = indexed(store)
+    rows, scores = idx.bm25_top_k(doctors[0]["bio"], 2)
+    assert [store.ids()[row] for row in rows] == [doctors[0]["id"], "COPY000"]
+    assert scores[0] == scores[1]
+    # The same index synced to a store listing the copy first ranks the copy first
+    reordered = store_of(tmp_path, "reordered", [doctors[80]] + doctors[:80] + doctors[81:])
+    idx.sync(reordered)
+    rows, _ = idx.bm25_top_k(doctors[0]["bio"], 1)
+    assert [reordered.ids()[row] for row in rows] == ["COPY000"]
+
+
+def test_max_score_with_mask(tmp_path, doctors, windows):
+    store = store_of(tmp_path, "store", doctors)
+    idx = indexed(store)
+    mask = np.arange(len(store)) % 3 != 0
+    for query in QUERIES:
+        rows, _ = idx.bm25_top_k(query, 10, mask)
+        expected_rows, _ = brute_force_top_k(idx, store, query, len(store))
+        assert rows.tolist() == [row for row in expected_rows.tolist() if mask[row]][:10], query
+
+
+def test_sync_matches_fresh_build(tmp_path, monkeypatch, doctors):
+    rng = random.Random(7)
+    idx = indexed(store_of(tmp_path, "before", doctors))
+    current = list(doctors)
+    for step in range(4):
+        current = [doctor for doctor in current if rng.random() > 0.1] # Removed
+        for i in rng.sample(range(len(current)), 5): # Edited
+            current[i] = dict(current[i], bio=current[i]["bio"] + f" Also treats migraine case {step}.")
+        current += [dict(doctor, id=f"NEW{step}{i:02d}") for i, doctor in enumerate(rng.sample(doctors, 5))] # Added
+        rng.shuffle(current)
+        store = store_of(tmp_path, f"step{step}", current)
+        idx.sync(store)
+
+        monkeypatch.setattr(keyword_search, "open_doc_store", lambda: store)
+        fresh = InvertedIndex()
+        fresh.build()
+        assert sorted(idx.doc_ids) == sorted(fresh.doc_ids)
+        synced_postings, fresh_postings = postings(idx), postings(fresh)
+        assert synced_postings.keys() == fresh_postings.keys()
+        for token, docs in fresh_postings.items():
+            assert synced_postings[token].keys() == docs.keys(), token
+            for doc_id, (tf, weight) in docs.items():
+                assert synced_postings[token][doc_id] == (tf, pytest.approx(weight, rel=1e-5)), (token, doc_id)
+        assert {doc_id: int(idx.doc_lengths[row]) for row, doc_id in enumerate(idx.doc_ids)} == {doc_id: int(fresh.doc_lengths[row]) for row, doc_id in enumerate(fresh.doc_ids)}
+        assert idx.avg_doc_length == pytest.approx(fresh.avg_doc_length)
+        for query in QUERIES:
+            rows, scores = idx.bm25_top_k(query, 10)
+            fresh_rows, fresh_scores = fresh.bm25_top_k(query, 10)
+            assert scores == pytest.approx(fresh_scores, rel=1e-5), query
+            assert rows.tolist() == fresh_rows.tolist(), query
+
+
+def written(tmp_path, doctors: list[dict], batch_size: int) -> InvertedIndex:
+    idx = InvertedIndex()
+    idx.index_path = str(tmp_path / "keyword_index.bin")
+    writer = InvertedIndexWriter(idx)
+    for start in range(0, len(doctors), batch_size):
+        batch = doctors[start:start + batch_size]
+        writer.add_many(batch, get_tokenizer().tokenize_many([doctor_text(doctor) for doctor in batch], idx.word_lemmas))
+    return writer.finish()
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_writer_matches_fresh_build(tmp_path, monkeypatch, doctors, batch_size):
+    store = store_of(tmp_path, "store", doctors)
+    idx = written(tmp_path, doctors, batch_size)
+    monkeypatch.setattr(keyword_search, "open_doc_store", lambda: store)
+    fresh = InvertedIndex()
+    fresh.build()
+    assert idx.terms == fresh.terms
+    assert idx.doc_ids == fresh.doc_ids
+    assert idx.doc_hashes == fresh.doc_hashes
+    for name in ("term_offsets", "posting_docs", "posting_tfs", "posting_weights", "term_max_weights", "doc_lengths"):
+        assert np.array_equal(getattr(idx, name), getattr(fresh, name)), name
+    assert not (tmp_path / "keyword_index.bin.postings").exists()
+
+
+def test_writer_rejects_duplicate_ids(tmp_path, doctors):
+    with pytest.raises(ValueError, match=doctors[3]["id"]):
+        written(tmp_path, doctors[:10] + [doctors[3]], 4)
@@ -0,0 +1,51 @@
+import io
+import json
+import pytest
+from lib import search_utils
+from lib.search_utils import _iter_json_array, iter_doctors
+
+DOCTORS = [
+    {"id": "DR001", "name": "Dr. A", "bio": "Uses [brackets], {braces} and \"quotes\" in text", "age": 45},
+    {"id": "DR002", "name": "Dr. Ünicode Ø", "bio": "", "age": 1234567890},
+    {"id": "DR003", "name": "Dr. C", "bio": "Trailing comma,] inside a string", "tags": [1, [2, 3], {"x": None}]},
+]
+
+
+def read_array(text: str) -> list[dict]:
+    f = io.StringIO(text)
+    assert f.read(1) == "[" # iter_doctors consumes the opening bracket before handing the file over
+    return list(_iter_json_array(f))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_json_array_across_chunk_boundaries(monkeypatch, chunk_size, indent):
+    monkeypatch.setattr(search_utils, "JSON_READ_CHUNK_SIZE", chunk_size)
+    assert read_array(json.dumps(DOCTORS, indent=indent, ensure_ascii=False)) == DOCTORS
+    assert read_array(json.dumps(DOCTORS, separators=(",", ":"))) == DOCTORS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5])
+def test_json_array_edge_cases(monkeypatch, chunk_size):
+    monkeypatch.setattr(search_utils, "JSON_READ_CHUNK_SIZE", chunk_size)
+    assert read_array("[]") == []
+    assert read_array("[ \n ]") == []
+    assert read_array('[{"id": "DR001"}]\n') == [{"id": "DR001"}]
+    assert read_array('[\n\n{"id": "DR001"}\n,\n{"id": "DR002"}\n\n]') == [{"id": "DR001"}, {"id": "DR002"}]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4])
+def test_json_array_truncated(monkeypatch, chunk_size):
+    monkeypatch.setattr(search_utils, "JSON_READ_CHUNK_SIZE", chunk_size)
+    with pytest.raises(json.JSONDecodeError):
+        read_array(json.dumps(DOCTORS)[:-10])
+
+
+def test_iter_doctors_reads_arrays_and_json_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(search_utils, "JSON_READ_CHUNK_SIZE", 3)
+    array_path = tmp_path / "doctors.json"
+    array_path.write_text("\n  " + json.dumps(DOCTORS, indent=2))
+    lines_path = tmp_path / "doctors.jsonl"
+    lines_path.write_text("\n".join(json.dumps(doctor) for doctor in DOCTORS) + "\n\n")
+    assert list(iter_doctors(str(array_path))) == DOCTORS
+    assert list(iter_doctors(str(lines_path))) == DOCTORS